@@ -0,0 +1,115 @@
+#!/usr/bin/python -OO
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+### START Library location
+# Set import Library to ../socketrpc in dev mode
+import sys
+import os
+if os.path.exists(os.path.join(os.path.dirname(sys.argv[0]), os.pardir, 'socketrpc')):
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), os.pardir))
+### END library location
+
+from socketrpc import __version__, set_serializer2, COMPRESSORS
+
+import time
+import random
+from optparse import OptionParser
+
+
+def payloads():
+    """ (name, reply envelope) pairs of typical results.
+    """
+    rows = []
+    for i in xrange(2000):
+        rows.append({'id': i, 'name': 'user%d' % i, 'email': 'user%d@example.com' % i,
+                     'active': i % 3 == 0, 'score': i * 1.5})
+
+    noise = ''.join(chr(random.randint(0, 255)) for i in xrange(256 * 1024))
+
+    return [('echo', {'reply': [0, {'g': 'is', 'e': 'fast', 'n': 'and', 't': 'sexy!'}, 1]}),
+            ('rows', {'reply': [0, rows, 1]}),
+            ('zeros', {'reply': [0, '\0' * 1024 * 1024, 1]}),
+            ('random', {'reply': [0, noise.decode('latin-1'), 1]}),
+           ]
+
+
+def timed(func, data, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        result = func(data)
+
+    return (time.time() - start) / rounds, result
+
+
+def parse_commandline(parser=None):
+    if parser is None:
+        parser = OptionParser(usage="""%prog [-v] [-r <rounds>] [-s <serializers>]
+
+Shows per serializer and compressor how much a frame shrinks and what
+it costs. "break-even" is the link speed below which compressing a
+frame is faster than sending it uncompressed.""")
+
+    parser.add_option("-v", "--version", dest="print_version",
+                        help="print current Version", action="store_true")
+    parser.add_option("-r", "--rounds", dest="rounds", default=10,
+                  help="NUMBER of rounds per case. Default: 10", metavar="NUMBER")
+    parser.add_option("-s", "--serializers", dest="serializers", default='bson,jsonlib,json,msgpack,marshal,pickle2',
+                  help="Comma separated SERIALIZERS. Default: bson,jsonlib,json,msgpack,marshal,pickle2", metavar="SERIALIZERS")
+
+    (options, args) = parser.parse_args()
+    if options.print_version:
+        print "%s: %s" % ('socketrpc', __version__)
+        sys.exit(0)
+
+    return {'rounds': int(options.rounds),
+            'serializers': options.serializers.split(','),
+           }
+
+
+def start(options):
+    rounds = options['rounds']
+    cases = payloads()
+
+    print '%-8s %-7s %-5s %10s %10s %7s %10s %10s %14s' % ('serial.', 'payload', 'codec', 'bytes', 'compr.',
+                                                          'ratio', 'compress', 'decompr.', 'break-even')
+    for serializer in options['serializers']:
+        gls = {}
+        try:
+            set_serializer2(serializer, gls=gls)
+        except ImportError, e:
+            print '%-8s skipped: %s' % (serializer, e)
+            continue
+
+        for name, payload in cases:
+            data = gls['encode'](payload)
+            if not isinstance(data, str):
+                print '%-8s %-7s cannot encode: %s' % (serializer, name, data)
+                continue
+
+            for codec, (compress, decompress) in sorted(COMPRESSORS.items()):
+                ctime, compressed = timed(compress, data, rounds)
+                dtime, ign = timed(decompress, compressed, rounds)
+
+                saved = len(data) - len(compressed)
+                if saved > 0:
+                    # Mbit/s at which the saved bytes take as long as the CPU work
+                    breakeven = '%10.1f Mbit' % (saved * 8 / (ctime + dtime) / 1e6)
+                else:
+                    breakeven = 'never'
+
+                print '%-8s %-7s %-5s %10d %10d %6.1f%% %8.2fms %8.2fms %14s' % (
+                        serializer, name, codec, len(data), len(compressed),
+                        100.0 * len(compressed) / len(data), ctime * 1000, dtime * 1000, breakeven)
+
+if __name__ == '__main__':
+    options = parse_commandline()
+    start(options)
@@ -0,0 +1,99 @@
+#!/usr/bin/python -OO
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+### START Library location
+# Set import Library to ../socketrpc in dev mode
+import sys
+import os
+if os.path.exists(os.path.join(os.path.dirname(sys.argv[0]), os.pardir, 'socketrpc')):
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), os.pardir))
+### END library location
+
+from socketrpc import __version__, set_serializer2, encode_message, decode_message
+
+import time
+from optparse import OptionParser
+
+
+def roundtrip(gls, version, params, calls):
+    """ Encodes and decodes calls call/reply pairs,
+    returns (<seconds per call>, <bytes per call>).
+    """
+    encode = gls['encode']
+    decode = gls['decode']
+    documents = gls['documents']
+
+    size = 0
+    start = time.time()
+    for id in xrange(1, calls + 1):
+        call = encode_message(encode, 'call', ['echo', [params], {}, id], version, documents)
+        transaction, obj = decode_message(decode, call, version, documents)
+
+        reply = encode_message(encode, 'reply', [0, obj[1][0], id], version, documents)
+        transaction, obj = decode_message(decode, reply, version, documents)
+
+        size = len(call) + len(reply)
+
+    return (time.time() - start) / calls, size
+
+
+def parse_commandline(parser=None):
+    if parser is None:
+        parser = OptionParser(usage="""%prog [-v] [-r <# of calls>] [-s <serializers>]
+
+Compares the per call CPU time and bytes of the version 1 envelope
+({"call": [...]}) with the version 2 binary message header.""")
+
+    parser.add_option("-v", "--version", dest="print_version",
+                        help="print current Version", action="store_true")
+    parser.add_option("-r", "--requests", dest="requests", default=100000,
+                  help="NUMBER of calls per case. Default: 100000", metavar="NUMBER")
+    parser.add_option("-s", "--serializers", dest="serializers", default='bson,jsonlib,json,msgpack,marshal,pickle2',
+                  help="Comma separated SERIALIZERS. Default: bson,jsonlib,json,msgpack,marshal,pickle2", metavar="SERIALIZERS")
+
+    (options, args) = parser.parse_args()
+    if options.print_version:
+        print "%s: %s" % ('socketrpc', __version__)
+        sys.exit(0)
+
+    return {'requests': int(options.requests),
+            'serializers': options.serializers.split(','),
+           }
+
+
+def start(options):
+    # The params of examples/gevent_srpc.py
+    params = {'g': 'is',
+              'e': 'very',
+              'v': 'cool',
+              'e': 'fast',
+              'n': 'and',
+              't': 'sexy!'}
+
+    print '%-8s %10s %10s %8s %8s %8s' % ('serial.', 'v1 us/call', 'v2 us/call', 'v1 bytes', 'v2 bytes', 'saved')
+    for serializer in options['serializers']:
+        gls = {}
+        try:
+            set_serializer2(serializer, gls=gls)
+        except ImportError, e:
+            print '%-8s skipped: %s' % (serializer, e)
+            continue
+
+        v1_time, v1_size = roundtrip(gls, 1, params, options['requests'])
+        v2_time, v2_size = roundtrip(gls, 2, params, options['requests'])
+
+        print '%-8s %10.2f %10.2f %8d %8d %7.1f%%' % (serializer, v1_time * 1e6, v2_time * 1e6,
+                                                      v1_size, v2_size, 100.0 - 100.0 * v2_size / v1_size)
+
+if __name__ == '__main__':
+    options = parse_commandline()
+    start(options)
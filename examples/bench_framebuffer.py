@@ -0,0 +1,134 @@
+#!/usr/bin/python -OO
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+### START Library location
+# Set import Library to ../socketrpc in dev mode
+import sys
+import os
+if os.path.exists(os.path.join(os.path.dirname(sys.argv[0]), os.pardir, 'socketrpc')):
+    sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), os.pardir))
+### END library location
+
+from socketrpc import __version__, FrameBuffer, STRUCT_INT, struct_error
+
+try:
+    from cStringIO import StringIO
+except ImportError, e:
+    from StringIO import StringIO
+
+import time
+from optparse import OptionParser
+
+
+class StringIOBuffer(object):
+    """ The (StringIO, blen, offset, need) buffer twisted_srpc used
+    before FrameBuffer, kept here as the baseline.
+    """
+    def __init__(self):
+        self._buffer = (StringIO(), 0, 0, 0,)
+
+    def feed(self, data):
+        buffer, blen, offset, need = self._buffer
+        buffer.write(data)
+        blen += len(data)
+
+        result = []
+        while blen > offset:
+            if need == 0:
+                try:
+                    buffer.seek(offset)
+                    need = STRUCT_INT.unpack(buffer.read(4))[0]
+                    offset += 4
+                    buffer.seek(blen)
+                except struct_error:
+                    self._buffer = (StringIO(), 0, 0, 0,)
+                    return result
+
+            if blen - offset >= need:
+                buffer.seek(offset)
+                result.append(buffer.read(need))
+                offset += need
+                need = 0
+            else:
+                break
+
+        if need == 0:
+            data = buffer.read()
+            buffer.seek(0)
+            buffer.truncate()
+            buffer.write(data)
+            blen = len(data)
+            offset = 0
+
+        self._buffer = (buffer, blen, offset, need,)
+        return result
+
+
+def make_chunks(frame_size, frames, chunk_size):
+    frame = STRUCT_INT.pack(frame_size) + 'x' * frame_size
+    data = frame * frames
+    return [data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size)]
+
+
+def run(buffer_class, chunks, rounds):
+    frames = 0
+    start = time.time()
+    for i in xrange(rounds):
+        buf = buffer_class()
+        for chunk in chunks:
+            for frame in buf.feed(chunk):
+                frames += 1
+
+    return time.time() - start, frames
+
+
+def parse_commandline(parser=None):
+    if parser is None:
+        parser = OptionParser(usage="""%prog [-v] [-r <rounds>]
+
+Compares the twisted_srpc framing buffers, the old StringIO
+seek/truncate buffer against socketrpc.FrameBuffer.""")
+
+    parser.add_option("-v", "--version", dest="print_version",
+                        help="print current Version", action="store_true")
+    parser.add_option("-r", "--rounds", dest="rounds", default=20,
+                  help="NUMBER of rounds per case. Default: 20", metavar="NUMBER")
+
+    (options, args) = parser.parse_args()
+    if options.print_version:
+        print "%s: %s" % ('socketrpc', __version__)
+        sys.exit(0)
+
+    return {'rounds': int(options.rounds)}
+
+
+def start(options):
+    # (frame size, frames, chunk size as read by the reactor)
+    cases = [(60, 20000, 65536),
+             (60, 20000, 1460),
+             (4096, 2000, 65536),
+             (1024 * 1024, 8, 65536),
+            ]
+
+    print '%-10s %-8s %-8s %12s %12s %8s' % ('frame', 'frames', 'chunk', 'StringIO', 'FrameBuffer', 'speedup')
+    for frame_size, frames, chunk_size in cases:
+        chunks = make_chunks(frame_size, frames, chunk_size)
+
+        old, old_frames = run(StringIOBuffer, chunks, options['rounds'])
+        new, new_frames = run(FrameBuffer, chunks, options['rounds'])
+        assert old_frames == new_frames
+
+        print '%-10d %-8d %-8d %11.3fs %11.3fs %7.1fx' % (frame_size, frames, chunk_size, old, new, old / new)
+
+if __name__ == '__main__':
+    options = parse_commandline()
+    start(options)
@@ -22,19 +22,19 @@ from gevent import monkey; monkey.patch_all()
 from gevent.pool import Pool
 
 from socketrpc import __version__
-from socketrpc.gevent_srpc import SocketRPCProtocol, SocketRPCServer, SocketRPCClient, set_serializer
+from socketrpc.gevent_srpc import SocketRPCProtocol, SocketRPCServer, SocketRPCPreforkServer, SocketRPCClient, set_serializer
 
 import logging
 from optparse import OptionParser
 
 def parse_commandline(parser=None):
     if parser is None:
-        parser = OptionParser(usage="""%prog [-v] [-s <serializer>] [-H <host>] [-p <port>] [-r <# of requests>] MODE
+        parser = OptionParser(usage="""%prog [-v] [-s <serializer>] [-H <host>] [-p <port>] [-r <# of requests>] [-w <# of workers>] MODE
 
 Use this to test/benchmark socketrpc on gevent or to learn using it.
   
 Available MODEs:
-    server:         Run a single thread server,
+    server:         Run a single thread server (-w for more processes),
                     you need to start this before you can do client* calls.
     clientbounce:   Run a single request on the server.
     clientlarge:    Request 1mb of zeros from the server
@@ -48,9 +48,11 @@ Available MODEs:
     parser.add_option("-p", "--port", dest="port", default='9990',
                       help="PORT to connect/listen. Default: 9990", metavar="PORT")
     parser.add_option("-s", "--serializer", dest="serializer", default='pickle2',
-                      help="Use serializer SERIALIZER, available are: bson, json and pickle2. Default: pickle2", metavar="SERIALIZER")
+                      help="Use serializer SERIALIZER, available are: bson, jsonlib, json, marshal, msgpack and pickle2. Default: pickle2", metavar="SERIALIZER")
     parser.add_option("-r", "--requests", dest="requests", default=100000,
                   help="NUMBER of parallel/serial requests. Default: 100000", metavar="NUMBER")
+    parser.add_option("-w", "--workers", dest="workers", default=1,
+                  help="NUMBER of server worker processes. Default: 1", metavar="NUMBER")
     parser.add_option("-d", "--debug", dest="debug", default=False,
                         help="Debug print lots of data? Default: False", action="store_true")
 
@@ -73,6 +75,7 @@ Available MODEs:
       'host': options.host,
       'port': int(options.port),
       'debug': options.debug,
+      'workers': int(options.workers),
     }
 
     return result
@@ -101,7 +104,11 @@ def start(options):
                 """
                 return self.call(args[0], args[1]).get()
 
-        SocketRPCServer((options['host'], options['port']), ServerProtocol, backlog=2048).serve_forever()
+        if options['workers'] > 1:
+            SocketRPCPreforkServer((options['host'], options['port']), ServerProtocol,
+                                   workers=options['workers'], backlog=2048).serve_forever()
+        else:
+            SocketRPCServer((options['host'], options['port']), ServerProtocol, backlog=2048).serve_forever()
 
     elif mode.startswith('client'):
         # The test data to transfer
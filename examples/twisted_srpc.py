@@ -55,7 +55,7 @@ Available MODEs:
     parser.add_option("-p", "--port", dest="port", default='9990',
                       help="PORT to connect/listen. Default: 9990", metavar="PORT")
     parser.add_option("-s", "--serializer", dest="serializer", default='pickle2',
-                      help="Use serializer SERIALIZER, available are: bson, json and pickle2. Default: pickle2", metavar="SERIALIZER")
+                      help="Use serializer SERIALIZER, available are: bson, jsonlib, json, marshal, msgpack and pickle2. Default: pickle2", metavar="SERIALIZER")
     parser.add_option("-r", "--requests", dest="requests", default=100000,
                   help="NUMBER of parallel/serial requests. Default: 100000", metavar="NUMBER")
     parser.add_option("-d", "--debug", dest="debug", default=False,
@@ -11,7 +11,7 @@ setup(
     author_email = 'rene@jrit.at',
     description = 'simple socket rpc client/server for gevent and twisted',
     url = 'http://github.com/pcdummy/socketrpc',
-    packages = ['socketrpc'],    
+    packages = ['socketrpc', 'socketrpc.bench'],    
     classifiers = [
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
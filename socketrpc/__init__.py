@@ -4,7 +4,7 @@
 ###############################################################################
 #
 # This file is part of socketrpc, it is a compat library for shared data
-# between twisted_srpc and gevent_srpc
+# between twisted_srpc, gevent_srpc and asyncio_srpc (Python 3)
 #
 # Copyright (C) 2011  Rene Jochum <rene@jrit.at>
 #
@@ -12,11 +12,40 @@
 
 __version__ = '0.0.2'
 
-import xmlrpclib
 import struct
+import zlib
+import json
+import time
+import heapq
+import random
+import bisect
+import mmap
+import os
+import socket
+import tempfile
+import uuid
+from collections import OrderedDict, deque
+
+try:
+    import xmlrpclib
+except ImportError:
+    import xmlrpc.client as xmlrpclib
+
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
 
 struct_error = struct.error
 
+# dict.iteritems on Python 2
+iteritems = getattr(dict, 'iteritems', None) or (lambda d: iter(d.items()))
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 # -32768 - 32000 is reserved for RPC errors
 # @see: http://xmlrpc-epi.sourceforge.net/specs/rfc.fault_codes.php
 # Ranges of errors
@@ -35,14 +64,474 @@ METHOD_NOT_FOUND = xmlrpclib.METHOD_NOT_FOUND
 #INVALID_METHOD_PARAMS = xmlrpclib.INVALID_METHOD_PARAMS
 #INTERNAL_ERROR = xmlrpclib.INTERNAL_ERROR
 
+# Calls which timed out or have been cancelled by the caller
+TIMEOUT_ERROR = TRANSPORT_ERROR - 1
+CANCELLED_ERROR = TRANSPORT_ERROR - 2
+# Calls rejected because the connection's window was full
+OVERLOADED_ERROR = TRANSPORT_ERROR - 3
+
 STATUS_OK = 0
 
 Fault = xmlrpclib.Fault
-SUPPORTED_TRANSACTIONS = set(('call', 'reply'))
+SUPPORTED_TRANSACTIONS = set(('call', 'reply', 'batch', 'stream', 'stream_end', 'stream_credit'))
 
 STRUCT_INT = struct.Struct("!I")
 
-def set_serializer2(predefined=None, encode=None, decode=None, gls=None):
+# Version 2 messages start with a fixed header instead of the
+# {<transaction>: [...]} envelope:
+#   [(uint8_t)type][(uint8_t)flags][(uint32_t)call id][(int32_t)status][serialized body]
+MESSAGE_HEADER = struct.Struct("!BBIi")
+MESSAGE_TYPES = {'call': 1,
+                 'reply': 2,
+                 'batch': 3,
+                 'stream': 4,
+                 'stream_end': 5,
+                 'stream_credit': 6,
+                }
+MESSAGE_NAMES = dict((v, k) for k, v in iteritems(MESSAGE_TYPES))
+
+# A "stream_credit" of STREAM_CANCEL tells the sender of a stream that
+# the receiver gave up on it, the sender stops without a "stream_end"
+STREAM_CANCEL = -1
+
+# The high bits of the STRUCT_INT length mark special frames
+FRAME_COMPRESSED = 0x80000000
+FRAME_CONTROL = 0x40000000
+FRAME_FLAGS = 0xc0000000
+# Both flags: the payload is a SHM_DESCRIPTOR of a message in the
+# sender's shared memory segment (see ShmSegment)
+FRAME_SHM = FRAME_COMPRESSED | FRAME_CONTROL
+FRAME_LENGTH = 0x3fffffff
+
+
+""" Addresses are (<host>, <port>) tuples or
+"unix:<path>" strings for Unix domain sockets.
+"""
+UNIX_PREFIX = 'unix:'
+
+def unix_path(address):
+    """ Returns the path of a "unix:<path>" address, None for others.
+    """
+    if isinstance(address, string_types) and address.startswith(UNIX_PREFIX):
+        return address[len(UNIX_PREFIX):]
+
+    return None
+
+def address_tuple(address):
+    """ Returns address as (<host>, <port>) or ("unix", <path>),
+    the form the protocols log and keep as their address.
+    """
+    path = unix_path(address)
+    if path is not None:
+        return ('unix', path)
+
+    return tuple(address[:2])
+
+def peer_address(sock):
+    """ Returns the address_tuple of the peer of sock, peers of a
+    listening Unix socket are unnamed and get its path.
+    """
+    name = sock.getpeername()
+    if isinstance(name, tuple):
+        return name[:2]
+
+    return ('unix', name or sock.getsockname())
+
+
+class FrameBuffer(object):
+    """ Incremental parser for STRUCT_INT sized frames,
+    yields (<flags>, <payload>) tuples.
+
+    Frames which are completely inside a chunk passed to feed are
+    yielded as memoryview slices of that chunk without copying,
+    only the tail of a chunk (a partial frame) gets copied into
+    the pending buffer, once per feed call.
+    """
+
+    def __init__(self):
+        self._pending = bytearray()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def feed(self, data):
+        """ Generator over the payloads of all frames completed by data.
+        """
+        unpack_from = STRUCT_INT.unpack_from
+        view = memoryview(data)
+        size = len(data)
+        offset = 0
+
+        pending = self._pending
+        if pending:
+            # Complete the frame which has been started by a previous chunk
+            while True:
+                if len(pending) < 4:
+                    need = 4
+                else:
+                    need = (unpack_from(pending)[0] & FRAME_LENGTH) + 4
+                    if len(pending) >= need:
+                        break
+
+                if offset == size:
+                    return
+
+                take = min(need - len(pending), size - offset)
+                pending += view[offset:offset + take]
+                offset += take
+
+            self._pending = bytearray()
+            yield unpack_from(pending)[0] & FRAME_FLAGS, memoryview(pending)[4:]
+
+        while size - offset >= 4:
+            word = unpack_from(data, offset)[0]
+            need = (word & FRAME_LENGTH) + 4
+            if size - offset < need:
+                break
+
+            yield word & FRAME_FLAGS, view[offset + 4:offset + need]
+            offset += need
+
+        if offset < size:
+            self._pending = bytearray(view[offset:])
+
+""" Frame compressors, format:
+    {<name>: (<compress>, <decompress>)}
+"""
+COMPRESSORS = {}
+
+def register_compressor(name, compress, decompress):
+    """ Registers a codec for frame compression, both
+    peers need to know it under the same name.
+    """
+    COMPRESSORS[name] = (compress, decompress)
+
+register_compressor('zlib', lambda data: zlib.compress(data, 1), zlib.decompress)
+
+try:
+    import lz4.frame
+    register_compressor('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+""" Functions which decide on a connection option, called
+with (<our offer>, <peer offer>) they return a dict of
+options to send frames with.
+"""
+NEGOTIATORS = []
+
+def negotiator(func):
+    NEGOTIATORS.append(func)
+    return func
+
+@negotiator
+def negotiate_compression(offer, peer):
+    """ Our most preferred compressor the peer knows.
+    """
+    known = peer.get('compression') or ()
+    for name in offer.get('compression') or ():
+        if name in known and name in COMPRESSORS:
+            return {'compression': name}
+
+    return {}
+
+
+class Handshake(object):
+    """ Connect time negotiation of per connection options.
+
+    Both peers send a "hello" control frame with their offer.
+    On the peer's hello each side picks the options it will send
+    with (see NEGOTIATORS) and announces them with a "use" control
+    frame, the receiver applies them to every frame after it.
+
+    Peers without an offer (or from before the handshake) never
+    send a hello, so nothing changes for them.
+    """
+
+    def __init__(self, offer):
+        self.offer = offer
+        self.peer = None
+
+        # Options for the frames we send / receive
+        self.send = {}
+        self.recv = {}
+        # Got the peer's "use"
+        self.used = False
+
+    def hello(self):
+        """ Returns our hello control frame or None without an offer.
+        """
+        if not self.offer:
+            return None
+
+        return json.dumps({'hello': self.offer}).encode('utf-8')
+
+    def received(self, data):
+        """ Handles a control frame, returns the "use" control frame
+        to send (switch to self.send right after) or None.
+        """
+        try:
+            message = json.loads(tobytes(data))
+        except ValueError:
+            return None
+
+        if 'hello' in message:
+            if not self.offer:
+                return None
+
+            self.peer = message['hello']
+            send = {}
+            for func in NEGOTIATORS:
+                send.update(func(self.offer, self.peer))
+
+            self.send = send
+            return json.dumps({'use': send}).encode('utf-8')
+
+        elif 'use' in message:
+            self.recv = message['use']
+            self.used = True
+
+        return None
+
+    def withdraw(self, name):
+        """ Drops option name from what we send with, returns the "use"
+        control frame to send instead of the one received() returned.
+        """
+        self.send.pop(name, None)
+        return json.dumps({'use': self.send}).encode('utf-8')
+
+
+@negotiator
+def negotiate_version(offer, peer):
+    """ The highest message version both peers speak.
+    """
+    version = min(offer.get('version', 1), peer.get('version', 1))
+    if version > 1:
+        return {'version': version}
+
+    return {}
+
+
+def oversized(length):
+    """ Returns a Fault if a message of length bytes doesn't fit into
+    a frame, the high bits of its length word are the FRAME_ flags.
+    """
+    if length > FRAME_LENGTH:
+        return Fault(NOT_WELLFORMED_ERROR, 'Message of %d bytes exceeds the frame limit.' % length)
+
+    return None
+
+def encode_message(encode, transaction, obj, version=1, documents=False):
+    """ Encodes the transaction obj (in the version 1 layout) as message
+    of version. documents is for serializers which only encode mappings.
+    Messages which don't fit into a frame fail with a Fault.
+    """
+    if version == 1:
+        data = encode({transaction: obj})
+        if isinstance(data, Fault):
+            return data
+
+        return oversized(len(data)) or data
+
+    body = None
+    status = 0
+    if transaction == 'call':
+        id = obj[3]
+        body = list(obj[:3]) + list(obj[4:])
+    elif transaction == 'reply' or transaction == 'stream_end':
+        status, body, id = obj
+    elif transaction == 'stream':
+        id, body = obj
+    elif transaction == 'stream_credit':
+        id, status = obj
+    else:
+        id = 0
+        body = obj
+
+    header = MESSAGE_HEADER.pack(MESSAGE_TYPES[transaction], 0, id or 0, status)
+    if body is None:
+        return header
+
+    if documents:
+        body = {'b': body}
+
+    data = encode(body)
+    if isinstance(data, Fault):
+        return data
+
+    fault = oversized(MESSAGE_HEADER.size + len(data))
+    if fault is not None:
+        return fault
+
+    return header + data
+
+def decode_message(decode, data, version=1, documents=False):
+    """ Returns (<transaction>, <obj in the version 1 layout>)
+    for a message of version or a Fault.
+    """
+    if version == 1:
+        data = decode(data)
+        if isinstance(data, Fault):
+            return data
+
+        return next(iteritems(data))
+
+    try:
+        type, flags, id, status = MESSAGE_HEADER.unpack_from(data)
+    except struct_error:
+        return Fault(NOT_WELLFORMED_ERROR, 'Haven\'t got a message header.')
+
+    transaction = MESSAGE_NAMES.get(type)
+    if transaction is None:
+        return Fault(NOT_WELLFORMED_ERROR, 'Unknown message type: %d' % type)
+
+    body = None
+    if len(data) > MESSAGE_HEADER.size:
+        body = decode(data[MESSAGE_HEADER.size:])
+        if isinstance(body, Fault):
+            return body
+
+        if documents:
+            body = body['b']
+
+    if transaction == 'call':
+        obj = body[:3] + [id] + body[3:]
+    elif transaction == 'reply' or transaction == 'stream_end':
+        obj = [status, body, id]
+    elif transaction == 'stream':
+        obj = [id, body]
+    elif transaction == 'stream_credit':
+        obj = [id, status]
+    else:
+        obj = body
+
+    return transaction, obj
+
+
+def call_deadline(obj, received=None):
+    """ Returns the local deadline of a received "call" obj or None,
+    callers send their remaining timeout (in seconds) after the id.
+    """
+    if len(obj) > 4 and obj[4] is not None:
+        return (received or time.time()) + obj[4]
+
+    return None
+
+
+def rpcmethod(name=None, inline=False, offload=False):
+    """ Decorator for RPC methods.
+
+        name    -   Additional (dotted) name the method can be called by,
+                    methods don't need a "docall_" prefix with it.
+        inline  -   The method never blocks, the gevent backend runs
+                    it directly in the read loop instead of spawning.
+        offload -   The method returns large results, its replies get
+                    encoded in a worker thread (see offloadThreshold).
+    """
+    def decorate(func):
+        func.srpc_name = name
+        func.srpc_inline = inline
+        func.srpc_offload = offload
+        return func
+
+    return decorate
+
+_dispatch_tables = {}
+
+def dispatch_table(cls):
+    """ Returns {<name>: (<attribute>, <inline>, <offload>)} for all "docall_"
+    and @rpcmethod methods of cls, built once per class.
+    """
+    try:
+        return _dispatch_tables[cls]
+    except KeyError:
+        pass
+
+    table = {}
+    for attribute in dir(cls):
+        func = getattr(cls, attribute, None)
+        if not callable(func):
+            continue
+
+        inline = getattr(func, 'srpc_inline', False)
+        offload = getattr(func, 'srpc_offload', False)
+        if attribute.startswith('docall_'):
+            table[attribute[7:]] = (attribute, inline, offload)
+
+        name = getattr(func, 'srpc_name', None)
+        if name:
+            table[name] = (attribute, inline, offload)
+
+    _dispatch_tables[cls] = table
+    return table
+
+def bind_dispatch(obj):
+    """ Returns the dispatch table of obj with bound methods:
+    {<name>: (<bound method>, <inline>, <offload>)}
+    """
+    dispatch = {}
+    for name, (attribute, inline, offload) in iteritems(dispatch_table(obj.__class__)):
+        dispatch[name] = (getattr(obj, attribute), inline, offload)
+
+    return dispatch
+
+def is_stream(result):
+    """ Should result be sent as a streamed reply?
+    True for generators and other iterators.
+    """
+    return isinstance(result, Iterator)
+
+def tobytes(data):
+    """ Returns data as a str, memoryview slices
+    of a receive buffer get copied out.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+
+    return data
+
+def _bytes_decoder(decode):
+    """ Wraps decode so it always receives a str.
+    """
+    def bytes_decode(data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        return decode(data)
+
+    bytes_decode.__doc__ = decode.__doc__
+    return bytes_decode
+
+""" Message serializers, format:
+    {<name>: (<encode>, <decode>, <documents>)}
+"""
+SERIALIZERS = {}
+
+def register_serializer(name, encode, decode, buffers=False, documents=False):
+    """ Registers a serializer for set_serializer2 and the
+    per connection negotiation, both peers need to know
+    it under the same name.
+
+    @see: set_serializer2 for buffers and documents
+    """
+    if not buffers:
+        decode = _bytes_decoder(decode)
+
+    SERIALIZERS[name] = (encode, decode, documents)
+
+@negotiator
+def negotiate_serializer(offer, peer):
+    """ Our most preferred serializer the peer knows.
+    """
+    known = peer.get('serializers') or ()
+    for name in offer.get('serializers') or ():
+        if name in known and name in SERIALIZERS:
+            return {'serializer': name}
+
+    return {}
+
+def set_serializer2(predefined=None, encode=None, decode=None, gls=None, buffers=False, documents=False):
     """ Sets the serializer for the gls globals.
     
     set a serializer by:
@@ -50,113 +539,1001 @@ def set_serializer2(predefined=None, encode=None, decode=None, gls=None):
     or your own implementation:
         ser_serializer(encode=<your encoder>, decode=<your decoder>, gls=globals())
     
-    Currently it supports 3 predefined serializers:
+    The predefined serializers (see SERIALIZERS, the ones
+    whose module is installed):
+        <msgpack>   -   With its C extension the fastest secure one, needs msgpack >= 0.5.2.
         <bson>      -   As fast as "cPickle/2" and secure.
         <jsonlib>   -   Same as "bson" but utilizes a higher network load.
-        <pickle2>   -   The fastest but insecure, great to transfer objects internally.
+        <json>      -   The stdlib json module, slower than jsonlib.
+        <pickle2>   -   Fast but insecure, great to transfer objects internally.
+        <marshal>   -   Faster than "pickle2" for builtin types, insecure as well.
         
     Own serializer notes:
         Please make sure to translate the serializers exception to Fault exceptions!
+        The backends hand memoryview slices of their receive buffer to decode,
+        pass "buffers=True" if your decoder accepts them, else they get
+        copied to a str first.
+        Pass "documents=True" if your encoder only takes mappings (like BSON).
+        Use register_serializer to make it available by name.
     """
     if gls is None:
         gls = globals()
 
     if encode and decode:
+        if not buffers:
+            decode = _bytes_decoder(decode)
+
         gls['encode'] = encode
         gls['decode'] = decode
+        gls['documents'] = documents
+        gls['serializer_name'] = 'custom'
 
     elif predefined is not None:
-        if predefined == 'bson':
-            import bson
-            def encode(data):
-                """
-                Encodes data returns a BSON object or
-                a Fault
-                """
-                try:
-                    return bson.BSON.encode(data)
-                except bson.errors.InvalidBSON, e:
-                    return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data: %s' % e)
-                except bson.errors.InvalidDocument, e:
-                    return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data: %s' % e)
-                except bson.errors.InvalidStringData, e:
-                    return Fault(UNSUPPORTED_ENCODING, 'Non UTF-8 BSON Data: %s' % e)
-
-            def decode(data):
-                """
-                A proxy method for BSON.decode
-                TODO: This will block if a lot data has been received!
-                """
-                try:
-                    return bson.BSON(data).decode()
-                except bson.errors.InvalidBSON:
-                    return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data')
-                except bson.errors.InvalidDocument:
-                    return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data')
-                except bson.errors.InvalidStringData:
-                    return Fault(UNSUPPORTED_ENCODING, 'Non UTF-8 BSON Data')
-
-            set_serializer2(encode=encode, decode=decode, gls=gls)
-
-        elif predefined == 'jsonlib':
-            import jsonlib
-
-            def encode(data):
-                """
-                Encodes data returns a BSON object or
-                a Fault
-                """
-                try:
-                    return jsonlib.dumps(data)
-                except Exception, e:
-                    msg = 'Invalid JSON Data, got: %s:%s' % (e.__class__.__name__, e)
-                    return Fault(NOT_WELLFORMED_ERROR, msg)
-
-            def decode(data):
-                """
-                A proxy method for BSON.decode
-                TODO: This will block if a lot data has been received!
-                """
-                try:
-                    return jsonlib.loads(data)
-                except Exception, e:
-                    msg = 'Invalid JSON Data, got: %s:%s' % (e.__class__.__name__, e)
-                    return Fault(NOT_WELLFORMED_ERROR, msg)
-
-            set_serializer2(encode=encode, decode=decode, gls=gls)
-
-        elif predefined == 'pickle2':
+        try:
+            gls['encode'], gls['decode'], gls['documents'] = SERIALIZERS[predefined]
+        except KeyError:
+            raise ImportError('Serializer "%s" is not available' % predefined)
+
+        gls['serializer_name'] = predefined
+
+
+try:
+    import bson
+except ImportError:
+    pass
+else:
+    def encode(data):
+        """
+        Encodes data returns a BSON object or
+        a Fault
+        """
+        try:
+            return bson.BSON.encode(data)
+        except bson.errors.InvalidBSON as e:
+            return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data: %s' % e)
+        except bson.errors.InvalidDocument as e:
+            return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data: %s' % e)
+        except bson.errors.InvalidStringData as e:
+            return Fault(UNSUPPORTED_ENCODING, 'Non UTF-8 BSON Data: %s' % e)
+
+    def decode(data):
+        """
+        A proxy method for BSON.decode
+        """
+        try:
+            return bson.BSON(data).decode()
+        except bson.errors.InvalidBSON:
+            return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data')
+        except bson.errors.InvalidDocument:
+            return Fault(NOT_WELLFORMED_ERROR, 'Invalid BSON Data')
+        except bson.errors.InvalidStringData:
+            return Fault(UNSUPPORTED_ENCODING, 'Non UTF-8 BSON Data')
+
+    register_serializer('bson', encode, decode, documents=True)
+
+try:
+    import jsonlib
+except ImportError:
+    pass
+else:
+    def encode(data):
+        """
+        Encodes data returns a JSON string or
+        a Fault
+        """
+        try:
+            return jsonlib.dumps(data)
+        except Exception as e:
+            msg = 'Invalid JSON Data, got: %s:%s' % (e.__class__.__name__, e)
+            return Fault(NOT_WELLFORMED_ERROR, msg)
+
+    def decode(data):
+        """
+        A proxy method for jsonlib.loads
+        """
+        try:
+            return jsonlib.loads(data)
+        except Exception as e:
+            msg = 'Invalid JSON Data, got: %s:%s' % (e.__class__.__name__, e)
+            return Fault(NOT_WELLFORMED_ERROR, msg)
+
+    register_serializer('jsonlib', encode, decode)
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle as pickle
+
+def encode(data):
+    """
+    Encodes data returns a pickle string or
+    a Fault
+    """
+    try:
+        return pickle.dumps(data, 2)
+    except pickle.PicklingError as e:
+        msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+    except EOFError as e:
+        msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+
+def decode(data):
+    """
+    A proxy method for pickle.loads
+    """
+    try:
+        return pickle.loads(data)
+    except pickle.UnpicklingError as e:
+        msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+    except EOFError as e:
+        msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+
+register_serializer('pickle2', encode, decode)
+
+import marshal
+
+def encode(data):
+    """
+    Encodes data returns a marshal string or
+    a Fault, only builtin types are supported
+    """
+    try:
+        return marshal.dumps(data, 2)
+    except ValueError as e:
+        msg = 'Invalid marshal Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+
+def decode(data):
+    """
+    A proxy method for marshal.loads, never
+    use it with untrusted peers
+    """
+    try:
+        return marshal.loads(data)
+    except (ValueError, EOFError, TypeError) as e:
+        msg = 'Invalid marshal Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+
+register_serializer('marshal', encode, decode)
+
+def encode(data):
+    """
+    Encodes data returns a JSON string or
+    a Fault
+    """
+    try:
+        data = json.dumps(data, separators=(',', ':'))
+    except (TypeError, ValueError) as e:
+        msg = 'Invalid JSON Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+
+    if not isinstance(data, bytes):
+        # Python 3
+        data = data.encode('utf-8')
+
+    return data
+
+def decode(data):
+    """
+    A proxy method for json.loads
+    """
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        msg = 'Invalid JSON Data, got: %s:%s' % (e.__class__.__name__, e)
+        return Fault(NOT_WELLFORMED_ERROR, msg)
+
+register_serializer('json', encode, decode)
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    def encode(data):
+        """
+        Encodes data returns a msgpack string or
+        a Fault
+        """
+        try:
+            return msgpack.packb(data, use_bin_type=True)
+        except Exception as e:
+            msg = 'Invalid msgpack Data, got: %s:%s' % (e.__class__.__name__, e)
+            return Fault(NOT_WELLFORMED_ERROR, msg)
+
+    def decode(data):
+        """
+        A proxy method for msgpack.unpackb,
+        takes receive buffer slices as they are
+        """
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            msg = 'Invalid msgpack Data, got: %s:%s' % (e.__class__.__name__, e)
+            return Fault(NOT_WELLFORMED_ERROR, msg)
+
+    register_serializer('msgpack', encode, decode, buffers=True)
+
+del encode, decode
+
+
+class ResultCache(object):
+    """ Client side cache for the results of idempotent methods.
+
+        methods     -   {<method name>: <ttl in seconds>}, only the
+                        results of these methods get cached.
+        max_entries -   LRU eviction beyond this many results.
+        max_bytes   -   LRU eviction beyond this many bytes of results,
+                        as measured by sizeof (default: pickled length).
+
+    Cached results are shared between the callers, don't modify them.
+    The backends keep the requests of cache misses in "pending",
+    concurrent misses for the same key share one request.
+    """
+
+    def __init__(self, methods, max_entries=1024, max_bytes=None, sizeof=None, clock=time.time):
+        self.methods = dict(methods)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda result: len(pickle.dumps(result, 2)))
+        self.clock = clock
+
+        # {<key>: (<expires>, <result>, <size>)}, least recently used first
+        self._entries = OrderedDict()
+        self.bytes = 0
+
+        # {<key>: <backend specific pending request>}
+        self.pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl(self, method):
+        """ Returns the ttl of method, None if it doesn't get cached.
+        """
+        return self.methods.get(method)
+
+    def key(self, method, args, kwargs):
+        """ Returns the cache key of a call, args and kwargs
+        get encoded canonically (with sorted keys).
+        """
+        try:
+            return '%s:%s' % (method, json.dumps([args, kwargs], sort_keys=True, separators=(',', ':')))
+        except (TypeError, ValueError, UnicodeDecodeError):
+            return '%s:%r' % (method, (args, sorted(kwargs.items())))
+
+    def get(self, key):
+        """ Returns (True, <result>) for a hit, else (False, None).
+        """
+        entries = self._entries
+        entry = entries.get(key)
+        if entry is not None:
+            if entry[0] > self.clock():
+                # Mark as most recently used
+                del entries[key]
+                entries[key] = entry
+
+                self.hits += 1
+                return True, entry[1]
+
+            del entries[key]
+            self.bytes -= entry[2]
+            self.expired += 1
+
+        self.misses += 1
+        return False, None
+
+    def set(self, key, method, result):
+        """ Stores the result of method for key, evicts the least
+        recently used results beyond max_entries or max_bytes.
+        """
+        ttl = self.methods.get(method)
+        if not ttl:
+            return
+
+        size = 0
+        if self.max_bytes is not None:
+            size = self.sizeof(result)
+            if size > self.max_bytes:
+                return
+
+        entries = self._entries
+        old = entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+
+        entries[key] = (self.clock() + ttl, result, size)
+        self.bytes += size
+
+        while len(entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            key, entry = entries.popitem(last=False)
+            self.bytes -= entry[2]
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """ Returns the counters, "joined" are the misses
+        which shared the request of another miss.
+        """
+        return {'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'joined': self.joined,
+                'evictions': self.evictions,
+                'expired': self.expired,
+               }
+
+
+class DeadlineHeap(object):
+    """ Deadlines of the pending calls of a connection, a heap of
+    (<deadline>, <id>) so a single timer per connection is enough.
+
+    Entries of calls which finished in time stay until they are due
+    or the heap gets compacted, expired() only returns the ids.
+    """
+
+    def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, deadline, id):
+        """ Adds the deadline of call id, returns True if it
+        is earlier than all others (the timer needs a reset).
+        """
+        heap = self._heap
+        heapq.heappush(heap, (deadline, id))
+
+        return heap[0][1] == id
+
+    def earliest(self):
+        """ Returns the earliest deadline or None.
+        """
+        heap = self._heap
+        return heap and heap[0][0] or None
+
+    def expired(self, now):
+        """ Removes and returns the ids of all deadlines up to now.
+        """
+        heap = self._heap
+        ids = []
+        while heap and heap[0][0] <= now:
+            ids.append(heapq.heappop(heap)[1])
+
+        return ids
+
+    def compact(self, pending):
+        """ Drops the entries of ids which aren't in pending anymore.
+        """
+        self._heap = [entry for entry in self._heap if entry[1] in pending]
+        heapq.heapify(self._heap)
+
+    def clear(self):
+        self._heap = []
+
+
+# Upper bounds in seconds of the latency histogram buckets,
+# the last bucket counts everything slower
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics(object):
+    """ Counters of a connection, cheap enough to stay on:
+
+        - count, errors and a latency histogram per method, of the calls
+          we sent ("client") and of the calls we ran ("server").
+        - bytes and frames in and out.
+        - encode and decode time per serializer.
+
+    merge() sums up the counters of many connections.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, clock=time.time):
+        self.buckets = buckets
+        self.clock = clock
+
+        # {(<side>, <method>): [<count>, <errors>, <seconds>, <max>, [<bucket>, ...]]}
+        self.methods = {}
+        # {<serializer>: [<encoded>, <seconds>, <decoded>, <seconds>]}
+        self.serializers = {}
+        # Our pending calls, {<id>: (<method>, <sent at>)}
+        self.started = {}
+
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.framesIn = 0
+        self.framesOut = 0
+
+    def observe(self, side, method, seconds, error=False):
+        """ Counts a finished call of method which took seconds.
+        """
+        stats = self.methods.get((side, method))
+        if stats is None:
+            stats = self.methods[(side, method)] = [0, 0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+
+        stats[0] += 1
+        if error:
+            stats[1] += 1
+        stats[2] += seconds
+        if seconds > stats[3]:
+            stats[3] = seconds
+        stats[4][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def call_sent(self, id, method):
+        self.started[id] = (method, self.clock())
+
+    def call_finished(self, id, error=False):
+        """ Observes our call id as "client", if it is still pending.
+        """
+        started = self.started.pop(id, None)
+        if started is not None:
+            self.observe('client', started[0], self.clock() - started[1], error)
+
+    def calls_lost(self):
+        """ Observes all pending calls as failed.
+        """
+        for id in list(self.started):
+            self.call_finished(id, True)
+
+    def serialized(self, name, seconds, encoded=True):
+        stats = self.serializers.get(name)
+        if stats is None:
+            stats = self.serializers[name] = [0, 0.0, 0, 0.0]
+
+        if encoded:
+            stats[0] += 1
+            stats[1] += seconds
+        else:
+            stats[2] += 1
+            stats[3] += seconds
+
+    def received(self, frames, bytes):
+        self.framesIn += frames
+        self.bytesIn += bytes
+
+    def sent(self, frames, bytes):
+        self.framesOut += frames
+        self.bytesOut += bytes
+
+    def merge(self, other):
+        """ Adds the counters of other (with the same buckets).
+        """
+        for key, (count, errors, seconds, slowest, buckets) in iteritems(other.methods):
+            stats = self.methods.get(key)
+            if stats is None:
+                stats = self.methods[key] = [0, 0, 0.0, 0.0, [0] * len(buckets)]
+
+            stats[0] += count
+            stats[1] += errors
+            stats[2] += seconds
+            stats[3] = max(stats[3], slowest)
+            stats[4] = [a + b for a, b in zip(stats[4], buckets)]
+
+        for name, counters in iteritems(other.serializers):
+            stats = self.serializers.setdefault(name, [0, 0.0, 0, 0.0])
+            self.serializers[name] = [a + b for a, b in zip(stats, counters)]
+
+        self.received(other.framesIn, other.bytesIn)
+        self.sent(other.framesOut, other.bytesOut)
+
+    def snapshot(self):
+        """ Returns the counters as plain (serializable) dicts.
+        """
+        methods = {'client': {}, 'server': {}}
+        for (side, method), (count, errors, seconds, slowest, buckets) in iteritems(self.methods):
+            methods[side][method] = {'count': count,
+                                     'errors': errors,
+                                     'seconds': seconds,
+                                     'max': slowest,
+                                     'histogram': list(buckets),
+                                    }
+
+        serializers = {}
+        for name, (encoded, encode_seconds, decoded, decode_seconds) in iteritems(self.serializers):
+            serializers[name] = {'encoded': encoded,
+                                 'encode_seconds': encode_seconds,
+                                 'decoded': decoded,
+                                 'decode_seconds': decode_seconds,
+                                }
+
+        return {'client': methods['client'],
+                'server': methods['server'],
+                'buckets': list(self.buckets),
+                'serializers': serializers,
+                'bytes_in': self.bytesIn,
+                'bytes_out': self.bytesOut,
+                'frames_in': self.framesIn,
+                'frames_out': self.framesOut,
+               }
+
+
+""" Directory of the shared memory segments, a tmpfs if there is one.
+"""
+SHM_DIRECTORY = os.path.isdir('/dev/shm') and '/dev/shm' or tempfile.gettempdir()
+
+# (<offset>, <length>, <generation>) of a message in a segment
+SHM_DESCRIPTOR = struct.Struct("!QQI")
+# Record in front of every message: (<state>, <generation>, <length>)
+SHM_RECORD = struct.Struct("!IIQ")
+SHM_STATE = struct.Struct("!I")
+SHM_WRITTEN = 1
+SHM_FREE = 2
+# The segment starts with its token, records follow
+SHM_HEADER_SIZE = 64
+
+_host_id = None
+
+def host_id():
+    """ Returns an id of this host and boot, peers with
+    different ids never share memory.
+    """
+    global _host_id
+    if _host_id is None:
+        try:
+            boot = open('/proc/sys/kernel/random/boot_id').read().strip()
+        except IOError:
+            boot = ''
+
+        _host_id = '%s/%s' % (socket.gethostname(), boot)
+
+    return _host_id
+
+
+class ShmSegment(object):
+    """ The sending side of a shared memory channel, a ring of records
+    in a file mapped by both peers. write() copies a message into the
+    ring and returns the descriptor to send instead, the receiver
+    marks the record free once it has read it (see ShmReader) and
+    the ring reuses it.
+
+    Records get reclaimed in the order they were written, a full
+    ring makes write() return None and the message goes through
+    the socket as usual.
+    """
+
+    def __init__(self, size, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix='socketrpc-', dir=directory or SHM_DIRECTORY)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        except:
+            os.close(fd)
+            os.unlink(self.path)
+            raise
+
+        os.close(fd)
+
+        self.size = size
+        self.token = uuid.uuid4().hex
+        self.map[:len(self.token)] = self.token.encode('ascii')
+        self.linked = True
+
+        self.head = SHM_HEADER_SIZE
+        self.generation = 0
+        # (<offset>, <size>) of the records in use, oldest first
+        self.records = deque()
+
+        # Messages written and the ones which didn't fit
+        self.written = 0
+        self.fallbacks = 0
+
+    def offer(self):
+        """ Returns the "shm" hello offer of this segment.
+        """
+        return {'host': host_id(), 'path': self.path, 'token': self.token}
+
+    def reclaim(self):
+        """ Drops the records the peer has read from the front of the ring.
+        """
+        records = self.records
+        unpack_from = SHM_STATE.unpack_from
+        while records and unpack_from(self.map, records[0][0])[0] == SHM_FREE:
+            records.popleft()
+
+    def _place(self, size):
+        """ Returns the offset for a record of size or None if it doesn't fit.
+        """
+        records = self.records
+        if not records:
+            self.head = SHM_HEADER_SIZE
+
+        head = self.head
+        if not records or head > records[0][0]:
+            # Free behind head and in front of the oldest record
+            if head + size <= self.size:
+                return head
+            if records and SHM_HEADER_SIZE + size <= records[0][0]:
+                return SHM_HEADER_SIZE
+        elif head < records[0][0] and head + size <= records[0][0]:
+            return head
+
+        return None
+
+    def write(self, data):
+        """ Copies data into the ring, returns its SHM_DESCRIPTOR
+        or None if the ring is full.
+        """
+        if self.map is None:
+            return None
+
+        length = len(data)
+        # Records are 8 byte aligned
+        size = (SHM_RECORD.size + length + 7) & ~7
+
+        self.reclaim()
+        offset = self._place(size)
+        if offset is None:
+            self.fallbacks += 1
+            return None
+
+        generation = self.generation = (self.generation + 1) & 0xffffffff
+
+        start = offset + SHM_RECORD.size
+        self.map[start:start + length] = data
+        SHM_RECORD.pack_into(self.map, offset, SHM_WRITTEN, generation, length)
+
+        self.records.append((offset, size))
+        self.head = offset + size
+        self.written += 1
+
+        return SHM_DESCRIPTOR.pack(offset, length, generation)
+
+    def unlink(self):
+        """ Removes the file, the mappings stay valid.
+        """
+        if self.linked:
+            self.linked = False
             try:
-                import cPickle as pickle
-            except ImportError:
-                import pickle as pickle
-
-            def encode(data):
-                """
-                Encodes data returns a BSON object or
-                a Fault
-                """
-                try:
-                    return pickle.dumps(data, 2)
-                except pickle.PicklingError, e:
-                    msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
-                    return Fault(NOT_WELLFORMED_ERROR, msg)
-                except EOFError, e:
-                    msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
-                    return Fault(NOT_WELLFORMED_ERROR, msg)
-
-            def decode(data):
-                """
-                A proxy method for BSON.decode
-                TODO: This will block if a lot data has been received!
-                """
-                try:
-                    return pickle.loads(data)
-                except pickle.UnpicklingError, e:
-                    msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
-                    return Fault(NOT_WELLFORMED_ERROR, msg)
-                except EOFError, e:
-                    msg = 'Invalid pickle Data, got: %s:%s' % (e.__class__.__name__, e)
-                    return Fault(NOT_WELLFORMED_ERROR, msg)
-
-            set_serializer2(encode=encode, decode=decode, gls=gls)
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def close(self):
+        self.unlink()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def stats(self):
+        return {'size': self.size,
+                'records': len(self.records),
+                'written': self.written,
+                'fallbacks': self.fallbacks,
+               }
+
+
+class ShmReader(object):
+    """ The receiving side of a peer's ShmSegment.
+    """
+
+    def __init__(self, path, token):
+        """ Maps the segment at path, raises EnvironmentError
+        if it can't or ValueError if its token differs.
+        """
+        with open(path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), size)
+
+        self.size = size
+        if self.map[:len(token)] != token.encode('ascii'):
+            self.close()
+            raise ValueError('Shared memory token mismatch')
+
+    def read(self, descriptor):
+        """ Returns a copy of the message of descriptor and frees its
+        record, a Fault if the descriptor doesn't match the record.
+        """
+        try:
+            offset, length, generation = SHM_DESCRIPTOR.unpack(tobytes(descriptor))
+        except struct_error:
+            return Fault(NOT_WELLFORMED_ERROR, 'Broken shared memory descriptor.')
+
+        start = offset + SHM_RECORD.size
+        if self.map is None or offset < SHM_HEADER_SIZE or start + length > self.size:
+            return Fault(NOT_WELLFORMED_ERROR, 'Shared memory descriptor out of range.')
+
+        if SHM_RECORD.unpack_from(self.map, offset) != (SHM_WRITTEN, generation, length):
+            return Fault(NOT_WELLFORMED_ERROR, 'Stale shared memory descriptor.')
+
+        data = self.map[start:start + length]
+        SHM_STATE.pack_into(self.map, offset, SHM_FREE)
+
+        return data
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+@negotiator
+def negotiate_shm(offer, peer):
+    """ Confirms the peer's segment if both are on the same host and
+    we can map it, the peer sends large messages through it then.
+    """
+    ours = offer.get('shm')
+    theirs = peer.get('shm')
+    if not ours or not theirs or theirs.get('host') != ours['host']:
+        return {}
+
+    try:
+        ShmReader(theirs['path'], theirs['token']).close()
+    except (EnvironmentError, ValueError):
+        return {}
+
+    return {'shm': theirs['path']}
+
+
+# Routing policies of a cluster client
+ROUTING_POLICIES = ('outstanding', 'ewma')
+
+class Replica(object):
+    """ Health and latency of one endpoint of a cluster client.
+
+    Failing replicas leave the rotation and get probed with the
+    backoff of the client class (initialDelay, factor, jitter,
+    maxDelay and maxRetries), a successful probe brings them back.
+    """
+
+    # Weight of the latest latency in the moving average
+    decay = 0.3
+
+    def __init__(self, address, client):
+        self.address = address
+        self.client = client
+
+        self.healthy = True
+        # Moving average of the latency in seconds, None before the first reply
+        self.ewma = None
+        # Transport errors and timeouts in a row
+        self.failures = 0
+
+        # Seconds until the next probe and probes so far
+        self.delay = None
+        self.retries = 0
+
+        self.calls = 0
+        self.errors = 0
+        self.removed = 0
+
+    def succeeded(self, seconds):
+        """ Counts a reply which took seconds, Faults the
+        peer sent count as well, the replica answered.
+        """
+        self.calls += 1
+        self.failures = 0
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma += self.decay * (seconds - self.ewma)
+
+    def failed(self):
+        """ Counts a transport error or timeout, returns
+        the number of them in a row.
+        """
+        self.calls += 1
+        self.errors += 1
+        self.failures += 1
+
+        return self.failures
+
+    def down(self, backoff):
+        """ Takes the replica out of rotation, returns the
+        seconds until the next probe or None to give up.
+        """
+        if self.healthy:
+            self.healthy = False
+            self.removed += 1
+            self.delay = None
+            self.retries = 0
+
+        self.retries += 1
+        if backoff.maxRetries is not None and self.retries > backoff.maxRetries:
+            return None
+
+        if self.delay is None:
+            self.delay = backoff.initialDelay
+        else:
+            self.delay = min(self.delay * backoff.factor, backoff.maxDelay)
+            if backoff.jitter:
+                self.delay = random.normalvariate(self.delay, self.delay * backoff.jitter)
+
+        return self.delay
+
+    def up(self):
+        """ Puts the replica back into rotation after a successful probe.
+        """
+        self.healthy = True
+        self.failures = 0
+        self.delay = None
+        self.retries = 0
+
+    def score(self, outstanding, policy):
+        """ Returns the load of the replica, lower is better. "ewma" weighs
+        the latency by the calls in flight so a fast replica doesn't get
+        all of them, replicas without a reply yet come first.
+        """
+        if policy == 'ewma':
+            return (self.ewma or 0.0) * (outstanding + 1)
+
+        return outstanding
+
+    def stats(self):
+        return {'healthy': self.healthy,
+                'ewma': self.ewma,
+                'calls': self.calls,
+                'errors': self.errors,
+                'removed': self.removed,
+               }
+
+
+class ReplicaSet(object):
+    """ The replicas of a cluster client and the routing between them.
+    """
+
+    def __init__(self, policy='outstanding'):
+        if policy not in ROUTING_POLICIES:
+            raise ValueError('Unknown routing policy: %s' % policy)
+
+        self.policy = policy
+        self.replicas = []
+        self._next = 0
+
+    def __iter__(self):
+        return iter(self.replicas)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def add(self, address, client):
+        replica = Replica(address, client)
+        self.replicas.append(replica)
+
+        return replica
+
+    def choose(self, outstanding, exclude=None):
+        """ Returns the healthy replica with the lowest score, other
+        than exclude, or None. outstanding(replica) returns its calls
+        in flight or None if it isn't connected. Ties go round robin.
+        """
+        replicas = self.replicas
+        count = len(replicas)
+        if not count:
+            return None
+
+        start = self._next
+        self._next = (start + 1) % count
+
+        policy = self.policy
+        best = None
+        best_score = None
+        for i in range(count):
+            replica = replicas[(start + i) % count]
+            if not replica.healthy or replica is exclude:
+                continue
+
+            calls = outstanding(replica)
+            if calls is None:
+                continue
+
+            score = replica.score(calls, policy)
+            if best is None or score < best_score:
+                best = replica
+                best_score = score
+
+        return best
+
+    def stats(self):
+        """ Returns the stats of every replica by address.
+        """
+        return dict(('%s:%s' % address_tuple(replica.address), replica.stats()) for replica in self.replicas)
+
+
+class HedgePolicy(object):
+    """ Which calls of a cluster client get hedged: if there is no reply
+    after the method's delay the call gets sent to a second replica as
+    well, the first reply wins and the other call gets cancelled.
+
+        HedgePolicy({'get_user': None, 'search': 0.05}, max_ratio=0.05)
+
+    A delay of None hedges after the percentile of the method's recent
+    latencies (once it has minSamples of them), a number after that
+    many seconds. Only list idempotent methods.
+
+    Every call adds max_ratio to a budget of up to burst hedges and
+    every hedge takes one, so hedges stay below max_ratio of the calls
+    even when all replicas are slow.
+    """
+
+    # Recent latencies per method and how many of
+    # them the percentile needs, recomputed every
+    # "refresh" latencies
+    window = 256
+    minSamples = 20
+    refresh = 16
+
+    def __init__(self, methods, percentile=0.95, max_ratio=0.05, burst=10):
+        self.methods = dict(methods)
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.budget = float(burst)
+
+        # {<method>: [deque([<seconds>, ...]), <new since refresh>, <delay>]}
+        self._latencies = {}
+
+        self.calls = 0
+        self.hedged = 0
+        self.won = 0
+        self.throttled = 0
+
+    def delay(self, method):
+        """ Returns the seconds to wait before hedging a call of
+        method, None if it doesn't get hedged (yet). Counts the call.
+        """
+        if method not in self.methods:
+            return None
+
+        self.calls += 1
+        self.budget = min(self.budget + self.max_ratio, self.burst)
+
+        delay = self.methods[method]
+        if delay is not None:
+            return delay
+
+        latencies = self._latencies.get(method)
+        if latencies is None:
+            return None
+
+        return latencies[2]
+
+    def observe(self, method, seconds):
+        """ Adds the latency of a reply of method.
+        """
+        if method not in self.methods:
+            return
+
+        latencies = self._latencies.get(method)
+        if latencies is None:
+            latencies = self._latencies[method] = [deque(maxlen=self.window), 0, None]
+
+        samples = latencies[0]
+        samples.append(seconds)
+        latencies[1] += 1
+        if latencies[1] >= self.refresh and len(samples) >= self.minSamples:
+            latencies[1] = 0
+            ordered = sorted(samples)
+            latencies[2] = ordered[min(int(len(ordered) * self.percentile), len(ordered) - 1)]
+
+    def allow(self):
+        """ Takes a hedge from the budget, False if it is used up.
+        """
+        if self.budget < 1.0:
+            self.throttled += 1
+            return False
+
+        self.budget -= 1.0
+        self.hedged += 1
+        return True
+
+    def stats(self):
+        return {'calls': self.calls,
+                'hedged': self.hedged,
+                'won': self.won,
+                'throttled': self.throttled,
+                'delays': dict((method, latencies[2]) for method, latencies in iteritems(self._latencies)),
+               }
@@ -0,0 +1,1324 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+###############################################################################
+#
+# This file is part of socketrpc, the asyncio backend (Python >= 3.7).
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+from socketrpc import set_serializer2, Fault, STRUCT_INT, rpcmethod, bind_dispatch, is_stream
+from socketrpc import FRAME_COMPRESSED, FRAME_CONTROL, FRAME_FLAGS, FRAME_LENGTH, COMPRESSORS, SERIALIZERS, Handshake
+from socketrpc import encode_message, decode_message, tobytes, DeadlineHeap, Metrics, call_deadline
+from socketrpc import STATUS_OK, NOT_WELLFORMED_ERROR, METHOD_NOT_FOUND, APPLICATION_ERROR, TRANSPORT_ERROR
+from socketrpc import TIMEOUT_ERROR, CANCELLED_ERROR, STREAM_CANCEL, unix_path, address_tuple, peer_address
+
+import asyncio
+import inspect
+import logging
+import random
+import socket
+import time
+
+
+# For pylint
+def decode(data):
+    pass
+def encode(obj):
+    pass
+documents = False
+serializer_name = None
+
+def set_serializer(predefined=None, encode=None, decode=None, buffers=False, documents=False):
+    """ Sets the serializer for this class.
+    @see: socketrpc.set_serializer2
+    """
+    set_serializer2(predefined, encode, decode, globals(), buffers, documents)
+
+
+def is_async_stream(result):
+    """ Should result be sent as a streamed reply? True for
+    iterators (see socketrpc.is_stream) and async iterators.
+    """
+    return is_stream(result) or hasattr(result, '__aiter__')
+
+
+class SocketRPCProtocol(asyncio.BufferedProtocol):
+    """ The socketrpc wire format on asyncio, docall_ methods may
+    return a value, an awaitable or an (async) iterator which gets
+    streamed. call() returns an asyncio Future.
+    """
+
+    debug = False
+
+    # Without it a call to "a.b" falls back to "ab" if there
+    # is no method named "a.b"
+    allow_dotted_attributes = False
+
+    # Compressors to offer the peer (most preferred first), frames
+    # of at least compressThreshold bytes get compressed
+    compression = None
+    compressThreshold = 4096
+
+    # Highest message version to offer the peer, 2 replaces
+    # the envelope dict by a fixed binary header
+    messageVersion = 1
+
+    # Advertise the docall_ methods with integer ids and call the
+    # peer's methods by id once it advertised them
+    internMethods = False
+
+    # Serializers to offer the peer (fastest first), until the
+    # handshake is done the one of set_serializer gets used
+    serializers = None
+
+    # Chunks of a streamed reply which may be in flight
+    streamWindow = 16
+
+    # Default timeout in seconds of our calls, the remaining time
+    # gets sent along so the peer can skip calls we gave up on
+    callTimeout = None
+
+    # Initial size of the per connection receive buffer
+    recvBufferSize = 65536
+
+    def __init__(self):
+        """ Sets up instance only variables
+        """
+        self.id = 0
+        self.calls = {}
+
+        # {<name>: (<bound docall_ method>, <inline>, <offload>)}
+        self._dispatch = bind_dispatch(self)
+        # Interned method ids index _methodNames and _methods
+        self._methodNames = sorted(self._dispatch)
+        self._methods = [self._dispatch[name] for name in self._methodNames]
+
+        # SocketRPCServer or SocketRPCClient, told about
+        # connection_made and connection_lost
+        self.factory = None
+        self.transport = None
+        self.address = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.connected = asyncio.Event()
+        # Cleared while the transport's write buffer is full
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+        # The receive buffer, frames get parsed from
+        # _start to _end, _need bytes complete the next one
+        self._buffer = bytearray(self.recvBufferSize)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._need = 4
+
+        # Streamed replies we send, {<id>: <credit Semaphore>}, None
+        # while the method runs (see dispatch_call)
+        self._streams = {}
+        # Chunks received for plain calls, {<id>: [<chunk>, ...]}
+        self._chunks = {}
+        # Consumed chunks not yet granted as credit, {<id>: <count>}
+        self._consumed = {}
+
+        # Negotiated connection options
+        self.handshake = None
+        self._compress = None
+        self._decompress = None
+        self._sendVersion = 1
+        self._recvVersion = 1
+        self._sendSerializer = None
+        self._recvSerializer = None
+        # {<name>: <id>} of the peer's interned methods
+        self._methodIds = {}
+
+        # Deadlines of our pending calls and the timer for the earliest
+        self._deadlines = DeadlineHeap()
+        self._timer = None
+        self._timerAt = None
+
+        # Calls which timed out, got cancelled, their replies
+        # which came too late and received calls we skipped
+        self.callsExpired = 0
+        self.callsCancelled = 0
+        self.lateReplies = 0
+        self.callsSkipped = 0
+
+        # Tasks running the peer's calls
+        self.handlers = set()
+
+        # Latency, byte and serializer counters
+        self.metrics = Metrics()
+
+    def connection_made(self, transport):
+        """ Sets up per connection vars
+        """
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        self.address = sock is not None and peer_address(sock) or ('', 0)
+        self.logger = logging.getLogger("%s.%s:%s" % (self.__class__.__name__, self.address[0], self.address[1]))
+
+        self._start = self._end = 0
+        self._need = 4
+        self._writable.set()
+
+        self._compress = None
+        self._decompress = None
+        self._sendVersion = 1
+        self._recvVersion = 1
+        self._sendSerializer = None
+        self._recvSerializer = None
+        self._methodIds = {}
+        self.handshake = Handshake(self.hello_offer())
+        hello = self.handshake.hello()
+        if hello is not None:
+            self.write_frame(FRAME_CONTROL, hello)
+
+        self.connected.set()
+        self.logger.info('New connection from %s:%s' % self.address[:2])
+
+        if self.factory is not None:
+            self.factory.protocol_connected(self)
+
+    def connection_lost(self, exc):
+        self.connected.clear()
+        self.logger.info('Lost connection from %s:%s' % self.address[:2])
+
+        # Wake up streams waiting for credit, they see the lost connection
+        streams = self._streams
+        self._streams = {}
+        for credit in streams.values():
+            if credit is not None:
+                credit.release()
+        self._chunks = {}
+        self._consumed = {}
+        self._writable.set()
+
+        for task in list(self.handlers):
+            task.cancel()
+
+        # Fail our pending calls, nobody would answer them
+        self._deadlines.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        calls = self.calls
+        self.calls = {}
+        self.metrics.calls_lost()
+        for finished in calls.values():
+            if not finished.done():
+                finished.set_exception(Fault(TRANSPORT_ERROR, 'Connection lost.'))
+
+        self.transport = None
+        if self.factory is not None:
+            self.factory.protocol_lost(self)
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    async def drain(self):
+        """ Waits until the transport's write buffer is
+        below its high-water mark.
+        """
+        await self._writable.wait()
+
+    def hello_offer(self):
+        """ Returns the options to offer the peer on connect,
+        an empty offer skips the handshake.
+        """
+        offer = {}
+        if self.compression:
+            offer['compression'] = list(self.compression)
+        if self.messageVersion > 1:
+            offer['version'] = self.messageVersion
+        if self.internMethods:
+            offer['methods'] = self._methodNames
+        if self.serializers:
+            offer['serializers'] = [name for name in self.serializers if name in SERIALIZERS]
+
+        return offer
+
+    def get_buffer(self, sizehint):
+        """ Returns the free tail of the receive buffer, compacts or
+        grows it first if the next frame doesn't fit behind _start.
+        """
+        buf = self._buffer
+        start = self._start
+        end = self._end
+        need = self._need
+
+        if start == end:
+            # Nothing pending, start over (and shrink after a large frame)
+            start = end = 0
+            if len(buf) > self.recvBufferSize and need <= self.recvBufferSize:
+                buf = self._buffer = bytearray(self.recvBufferSize)
+                self._view = memoryview(buf)
+
+        elif len(buf) - start < need:
+            pending = end - start
+            if need <= len(buf):
+                buf[:pending] = buf[start:end]
+            else:
+                grown = bytearray(max(need, len(buf) * 2))
+                grown[:pending] = self._view[start:end]
+                buf = self._buffer = grown
+                self._view = memoryview(buf)
+            start, end = 0, pending
+
+        self._start = start
+        self._end = end
+
+        return self._view[end:]
+
+    def buffer_updated(self, nbytes):
+        """ Dispatches every frame completed by nbytes, their
+        payloads are slices of the receive buffer.
+        """
+        unpack_from = STRUCT_INT.unpack_from
+        buf = self._buffer
+        view = self._view
+        start = self._start
+        end = self._end = self._end + nbytes
+
+        need = 4
+        while end - start >= 4:
+            word = unpack_from(buf, start)[0]
+            need = (word & FRAME_LENGTH) + 4
+            if end - start < need:
+                break
+
+            self.frame_received(word & FRAME_FLAGS, view[start + 4:start + need])
+            start += need
+            need = 4
+
+        self._start = start
+        self._need = need
+
+    def frame_received(self, flags, data):
+        self.metrics.received(1, len(data) + 4)
+
+        if flags & FRAME_CONTROL:
+            self.control_received(data)
+            return
+
+        message = self.decode_frame(flags, data)
+        if isinstance(message, Fault):
+            self.fault_received(message)
+            return
+
+        transaction, obj = message
+
+        # Dispatch the transaction
+        if transaction == 'call':
+            # Until it runs, a cancel of the caller removes it (see dispatch_call)
+            self._streams[obj[3]] = None
+            self.spawn_handler(self.dispatch_call(obj[0], obj[3], obj[1], obj[2], call_deadline(obj)))
+        elif transaction == 'reply':
+            self.dispatch_reply(obj[0], obj[1], obj[2])
+        elif transaction == 'batch':
+            self.spawn_handler(self.dispatch_batch(obj, time.time()))
+        elif transaction == 'stream':
+            self.dispatch_stream(obj[0], obj[1])
+        elif transaction == 'stream_end':
+            self.dispatch_stream_end(obj[0], obj[1], obj[2])
+        elif transaction == 'stream_credit':
+            self.dispatch_stream_credit(obj[0], obj[1])
+        else:
+            self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Unknown transaction: %s' % transaction))
+
+    def control_received(self, data):
+        """ Handles handshake control frames.
+        """
+        handshake = self.handshake
+        use = handshake.received(data)
+        if use is not None:
+            # Frames after "use" get sent with the new options
+            self.write_frame(FRAME_CONTROL, use)
+
+            compression = handshake.send.get('compression')
+            self._compress = compression and COMPRESSORS[compression][0] or None
+            self._sendVersion = handshake.send.get('version', 1)
+            self._sendSerializer = handshake.send.get('serializer')
+            self._methodIds = dict((name, id) for id, name in enumerate(handshake.peer.get('methods') or ()))
+
+        compression = handshake.recv.get('compression')
+        self._decompress = compression and COMPRESSORS[compression][1] or None
+        self._recvVersion = handshake.recv.get('version', 1)
+        self._recvSerializer = handshake.recv.get('serializer')
+
+    def encode_message(self, transaction, obj):
+        """ Encodes transaction obj with the negotiated serializer
+        and message version.
+        """
+        name = self._sendSerializer
+        if name is None:
+            name, func, docs = serializer_name, encode, documents
+        else:
+            func, decoder, docs = SERIALIZERS[name]
+
+        start = time.time()
+        data = encode_message(func, transaction, obj, self._sendVersion, docs)
+        self.metrics.serialized(name, time.time() - start)
+
+        return data
+
+    def decode_message(self, data):
+        """ Returns (<transaction>, <obj>) of a received message or a Fault.
+        """
+        name = self._recvSerializer
+        if name is None:
+            name, func, docs = serializer_name, decode, documents
+        else:
+            encoder, func, docs = SERIALIZERS[name]
+
+        start = time.time()
+        message = decode_message(func, data, self._recvVersion, docs)
+        self.metrics.serialized(name, time.time() - start, encoded=False)
+
+        return message
+
+    def decode_frame(self, flags, data):
+        """ Returns (<transaction>, <obj>) of a (compressed)
+        frame or a Fault.
+        """
+        if flags & FRAME_COMPRESSED:
+            if self._decompress is None:
+                return Fault(NOT_WELLFORMED_ERROR, 'Compressed frame without a compressor.')
+
+            data = self._decompress(tobytes(data))
+
+        return self.decode_message(data)
+
+    def encode_frame(self, transaction, obj):
+        """ Returns the (<flags>, <data>) frame of transaction obj or a Fault.
+        """
+        data = self.encode_message(transaction, obj)
+        if isinstance(data, Fault):
+            return data
+
+        return self.compress_frame(data)
+
+    def compress_frame(self, data):
+        """ Returns the (<flags>, <data>) frame of data, compressed
+        when negotiated and at least compressThreshold bytes long.
+        """
+        compress = self._compress
+        if compress is not None and len(data) >= self.compressThreshold:
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                return (FRAME_COMPRESSED, compressed)
+
+        return (0, data)
+
+    def send_frame(self, data):
+        """ Writes data as a frame, see compress_frame.
+        """
+        self.write_frame(*self.compress_frame(data))
+
+    def write_frame(self, flags, data):
+        transport = self.transport
+        if transport is None or transport.is_closing():
+            return
+
+        self.metrics.sent(1, len(data) + 4)
+        transport.write(STRUCT_INT.pack(flags | len(data)) + data)
+
+    def spawn_handler(self, coro):
+        """ Runs a call handler coroutine as task of this connection,
+        they get cancelled when the connection is lost.
+        """
+        task = asyncio.ensure_future(coro)
+        self.handlers.add(task)
+        task.add_done_callback(self.handlers.discard)
+
+        return task
+
+    def stats(self):
+        """ Returns the metrics of this connection (see
+        socketrpc.Metrics.snapshot) with its pending calls and the
+        bytes buffered by the transport.
+        """
+        stats = self.metrics.snapshot()
+        stats['pending'] = len(self.calls)
+        stats['write_bytes'] = self.transport is not None and self.transport.get_write_buffer_size() or 0
+
+        return stats
+
+    def docall_stats(self):
+        """ Returns stats(), with the metrics of all connections as
+        "total" if the server keeps them (SocketRPCServer.metrics).
+        """
+        stats = self.stats()
+
+        metrics = getattr(self.factory, 'metrics', None)
+        if callable(metrics):
+            stats['total'] = metrics().snapshot()
+
+        return stats
+
+    def call_stats(self):
+        """ Returns the number of pending calls, of calls which
+        timed out or got cancelled, replies which came after that and
+        the peer's calls skipped because it had given up on them.
+        """
+        return {'pending': len(self.calls),
+                'expired': self.callsExpired,
+                'cancelled': self.callsCancelled,
+                'late': self.lateReplies,
+                'skipped': self.callsSkipped,
+               }
+
+    async def dispatch_call(self, method, id, args, kwargs, deadline=None):
+        if deadline is not None and time.time() >= deadline:
+            # The caller has given up on it already
+            self._streams.pop(id, None)
+            self.callsSkipped += 1
+            return
+
+        code, result, id = await self._execute_call(method, id, args, kwargs)
+        if self._streams.pop(id, False) is not None:
+            # Cancelled meanwhile, the caller drops the reply
+            if self.connected.is_set():
+                self.callsSkipped += 1
+            return
+
+        if code == STATUS_OK and is_async_stream(result):
+            await self.send_stream(result, id, deadline)
+        else:
+            self.send_response(code, result, id)
+
+    async def _execute_call(self, method, id, args, kwargs):
+        """ Runs the docall_ method (awaits its result if it returns
+        an awaitable) and returns the reply as [status, result, id].
+        """
+        if self.debug:
+            self.logger.debug('exec CALL %s (%d)' % (method, id))
+
+        entry = self.find_method(method)
+        if entry is None:
+            self.logger.error('Unknown CALL method %s (%d)' % (method, id))
+            self.metrics.observe('server', '<unknown>', 0.0, True)
+
+            return [METHOD_NOT_FOUND, 'Method "%s" not found (%d)' % (method, id), id]
+
+        func = entry[0]
+
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+
+            reply = [STATUS_OK, result, id]
+        except Fault as e:
+            reply = [e.faultCode, e.faultString, id]
+        except Exception as e:
+            reply = [APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e)), id]
+
+        self.metrics.observe('server', self.method_name(method), time.time() - start, reply[0] != STATUS_OK)
+
+        return reply
+
+    def find_method(self, method):
+        """ Returns the (<bound method>, <inline>, <offload>) entry for a
+        method name or interned id, None if there is none.
+        """
+        if isinstance(method, int):
+            if 0 <= method < len(self._methods):
+                return self._methods[method]
+
+            return None
+
+        entry = self._dispatch.get(method)
+        if entry is None and not self.allow_dotted_attributes:
+            entry = self._dispatch.get(method.replace('.', ''))
+
+        return entry
+
+    def method_name(self, method):
+        """ Returns the name of a method we have, called
+        by name or interned id.
+        """
+        if isinstance(method, int):
+            return self._methodNames[method]
+
+        return method
+
+    async def dispatch_batch(self, entries, received=None):
+        """ Dispatches every transaction of a batch, the calls run
+        concurrently and get answered with a single batch reply.
+        """
+        now = time.time()
+
+        calls = []
+        for entry in entries:
+            transaction, obj = next(iter(entry.items()))
+
+            if transaction == 'call':
+                deadline = call_deadline(obj, received)
+                if deadline is not None and now >= deadline:
+                    self.callsSkipped += 1
+                    continue
+
+                calls.append(self._execute_call(obj[0], obj[3], obj[1], obj[2]))
+            elif transaction == 'reply':
+                self.dispatch_reply(obj[0], obj[1], obj[2])
+            else:
+                self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Unknown batch transaction: %s' % transaction))
+
+        if not calls:
+            return
+
+        replies = []
+        for reply in await asyncio.gather(*calls):
+            if reply[0] == STATUS_OK and is_async_stream(reply[1]):
+                # No streaming inside batches
+                try:
+                    if is_stream(reply[1]):
+                        reply[1] = list(reply[1])
+                    else:
+                        reply[1] = [chunk async for chunk in reply[1]]
+                except Exception as e:
+                    reply[:2] = [APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e))]
+
+            replies.append({'reply': reply})
+
+        self.send_batch(replies)
+
+    def dispatch_reply(self, status, result, id):
+        if self.debug:
+            self.logger.debug('recv REPLY (%d)' % id)
+
+        self.metrics.call_finished(id, status < STATUS_OK)
+
+        finished = self.calls.pop(id, None)
+        if finished is None:
+            self.unknown_reply(id, 'result')
+            return
+
+        if finished.done():
+            # Cancelled by its caller, we'll hear about it
+            return
+
+        if status >= STATUS_OK:
+            finished.set_result(result)
+        else:
+            finished.set_exception(Fault(status, result))
+
+    def dispatch_stream(self, id, chunk):
+        try:
+            result = self.calls[id]
+        except KeyError:
+            self.unknown_reply(id, 'stream')
+            return
+
+        if isinstance(result, StreamResult):
+            # Credit follows when the chunk gets consumed
+            result.put(chunk)
+        else:
+            self._chunks.setdefault(id, []).append(chunk)
+            self.stream_consumed(id)
+
+    def unknown_reply(self, id, kind):
+        """ Counts replies to our expired or cancelled calls, any
+        other unknown id is a fault.
+        """
+        if 0 < id <= self.id:
+            self.lateReplies += 1
+            if self.debug:
+                self.logger.debug('late %s (%d)' % (kind, id))
+        else:
+            self.fault_received(Fault(APPLICATION_ERROR, 'Unknown %s: %d' % (kind, id)))
+
+    def dispatch_stream_end(self, status, result, id):
+        self._consumed.pop(id, None)
+
+        chunks = self._chunks.pop(id, None)
+        if status >= STATUS_OK and chunks is not None:
+            result = chunks
+
+        self.dispatch_reply(status, result, id)
+
+    def dispatch_stream_credit(self, id, count):
+        if id not in self._streams:
+            # Finished already
+            return
+
+        credit = self._streams[id]
+        if count == STREAM_CANCEL:
+            # The receiver gave up on it, dispatch_call
+            # and send_stream see it gone
+            del self._streams[id]
+            if credit is not None:
+                credit.release()
+            return
+
+        if credit is None:
+            return
+
+        for i in range(count):
+            credit.release()
+
+    def stream_consumed(self, id, count=1):
+        """ Grants the sender of stream id new credit, batched to
+        every half streamWindow chunks.
+        """
+        if id not in self.calls:
+            # Already finished
+            return
+
+        consumed = self._consumed.get(id, 0) + count
+        if consumed < max(self.streamWindow // 2, 1):
+            self._consumed[id] = consumed
+            return
+
+        self._consumed[id] = 0
+
+        data = self.encode_message('stream_credit', [id, consumed])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def send_stream_cancel(self, id):
+        """ Tells the peer to stop streaming the reply of our call id,
+        it would wait for credit forever else. Calls without a
+        streamed reply ignore it.
+        """
+        if not self.connected.is_set():
+            return
+
+        data = self.encode_message('stream_credit', [id, STREAM_CANCEL])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def fault_received(self, fault):
+        """ Gets called whenever we receive a fault
+        which isn't assignable.
+        """
+        self.logger.error(fault)
+
+    def send_response(self, code=STATUS_OK, result='', id=None):
+        if self.debug:
+            self.logger.debug('send REPLY (%d)' % id)
+
+        frame = self.encode_frame('reply', [code, result, id])
+        if isinstance(frame, Fault):
+            self.fault_received(frame)
+            return
+
+        self.write_frame(*frame)
+
+    async def send_stream(self, iterator, id, deadline=None):
+        """ Sends every item of the (async) iterator as a "stream" chunk,
+        waits for credit from the receiver after streamWindow chunks in
+        flight and finishes with a "stream_end". Stops at the caller's
+        deadline or once the caller cancels it.
+        """
+        if self.debug:
+            self.logger.debug('send STREAM (%d)' % id)
+
+        if not hasattr(iterator, '__aiter__'):
+            iterator = _aiter(iterator)
+
+        credit = self._streams[id] = asyncio.Semaphore(self.streamWindow)
+        try:
+            try:
+                async for chunk in iterator:
+                    if deadline is None:
+                        await credit.acquire()
+                    else:
+                        try:
+                            await asyncio.wait_for(credit.acquire(), max(deadline - time.time(), 0))
+                        except asyncio.TimeoutError:
+                            # The caller has given up, it grants no more credit
+                            self.callsSkipped += 1
+                            return
+
+                    if self._streams.get(id) is not credit:
+                        # Connection lost or cancelled
+                        return
+
+                    data = self.encode_message('stream', [id, chunk])
+                    if isinstance(data, Fault):
+                        self.send_stream_end(data.faultCode, data.faultString, id)
+                        return
+
+                    self.send_frame(data)
+                    await self.drain()
+            except Fault as e:
+                self.send_stream_end(e.faultCode, e.faultString, id)
+            except Exception as e:
+                self.send_stream_end(APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e)), id)
+            else:
+                self.send_stream_end(STATUS_OK, None, id)
+        finally:
+            if self._streams.get(id) is credit:
+                del self._streams[id]
+
+    def send_stream_end(self, code=STATUS_OK, result=None, id=None):
+        data = self.encode_message('stream_end', [code, result, id])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def send_batch(self, replies):
+        if self.debug:
+            self.logger.debug('send BATCH REPLY (%d)' % len(replies))
+
+        data = self.encode_message('batch', replies)
+        if isinstance(data, Fault):
+            # Answer the replies which don't encode with an error
+            # of their own, the others still get their result
+            replies = [self.encodable_reply(entry) for entry in replies]
+            data = self.encode_message('batch', replies)
+
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def encodable_reply(self, entry):
+        """ Returns the batch entry {"reply": [<status>, <result>, <id>]}
+        or an APPLICATION_ERROR reply for its id if it doesn't encode.
+        """
+        reply = entry['reply']
+        data = self.encode_message('reply', reply)
+        if isinstance(data, Fault):
+            return {'reply': [APPLICATION_ERROR, 'Unserializable reply: %s' % data.faultString, reply[2]]}
+
+        return entry
+
+    def call(self, method, *args, **kwargs):
+        return self.call_timeout(self.callTimeout, method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        """ Sends a call, returns an asyncio Future of its result which
+        fails with a Fault, with a TIMEOUT_ERROR one if there is no
+        reply within timeout seconds (None waits forever).
+        Cancelling the Future cancels the call.
+        """
+        finished = asyncio.get_event_loop().create_future()
+        return self._send_call(finished, method, args, kwargs, timeout)
+
+    def call_stream(self, method, *args, **kwargs):
+        """ Like call but returns a StreamResult, an async iterator over
+        the chunks of a streamed reply. The sender gets credit for more
+        chunks as they are consumed, so memory stays bounded by streamWindow.
+        """
+        return self._send_call(StreamResult(self), method, args, kwargs, self.callTimeout)
+
+    def _send_call(self, finished, method, args, kwargs, timeout):
+        if not self.connected.is_set():
+            finished.set_exception(Fault(TRANSPORT_ERROR, 'Not connected.'))
+            return finished
+
+        self.id += 1
+        data = self.encode_message('call', self._call_obj(method, args, kwargs, self.id, timeout))
+        if isinstance(data, Fault):
+            finished.set_exception(data)
+            return finished
+
+        if self.debug:
+            self.logger.debug('send CALL (%d) %s' % (self.id, method))
+
+        self.send_frame(data)
+
+        if isinstance(finished, StreamResult):
+            finished.id = self.id
+        self.track_call(finished, self.id, method, timeout)
+
+        return finished
+
+    def call_many(self, calls, timeout=None):
+        """ Sends calls, a list of (method, args[, kwargs]) tuples,
+        in a single "batch" transaction, timeout defaults to callTimeout.
+
+        Returns a list with one Future per call, each call
+        succeeds or fails on its own.
+        """
+        loop = asyncio.get_event_loop()
+        results = [loop.create_future() for call in calls]
+
+        if not self.connected.is_set():
+            for finished in results:
+                finished.set_exception(Fault(TRANSPORT_ERROR, 'Not connected.'))
+            return results
+
+        if timeout is None:
+            timeout = self.callTimeout
+
+        entries = []
+        for call in calls:
+            self.id += 1
+            kwargs = len(call) > 2 and call[2] or {}
+            entries.append({'call': self._call_obj(call[0], call[1], kwargs, self.id, timeout)})
+
+        data = self.encode_message('batch', entries)
+        if isinstance(data, Fault):
+            for finished in results:
+                finished.set_exception(data)
+            return results
+
+        if self.debug:
+            self.logger.debug('send BATCH (%d calls)' % len(entries))
+
+        self.send_frame(data)
+
+        for call, entry, finished in zip(calls, entries, results):
+            self.track_call(finished, entry['call'][3], call[0], timeout)
+
+        return results
+
+    def _call_obj(self, method, args, kwargs, id, timeout):
+        """ Returns the "call" transaction obj, with the
+        timeout appended for the peer.
+        """
+        obj = [self._methodIds.get(method, method), list(args), kwargs, id]
+        if timeout is not None:
+            obj.append(timeout)
+
+        return obj
+
+    def track_call(self, finished, id, method, timeout):
+        """ Registers our sent call id, cancelling finished cancels it.
+        """
+        self.calls[id] = finished
+        self.track_deadline(id, timeout)
+        self.metrics.call_sent(id, method)
+
+        finished.add_done_callback(lambda finished: finished.cancelled() and self.cancel(id))
+
+    def track_deadline(self, id, timeout):
+        """ Expires call id after timeout seconds.
+        """
+        if timeout is None:
+            return
+
+        deadline = time.time() + timeout
+
+        deadlines = self._deadlines
+        if len(deadlines) > 2 * len(self.calls) + 64:
+            # Mostly calls which finished in time
+            deadlines.compact(self.calls)
+
+        if deadlines.push(deadline, id):
+            self._schedule_timer(deadline)
+
+    def _schedule_timer(self, deadline):
+        timer = self._timer
+        if timer is not None:
+            if self._timerAt <= deadline:
+                return
+
+            timer.cancel()
+
+        self._timerAt = deadline
+        self._timer = asyncio.get_event_loop().call_later(max(deadline - time.time(), 0), self._expire_calls)
+
+    def _expire_calls(self):
+        """ Fails the calls whose deadline has passed,
+        runs in the per connection timer.
+        """
+        self._timer = None
+
+        now = time.time()
+        for id in self._deadlines.expired(now):
+            finished = self.calls.pop(id, None)
+            if finished is not None:
+                self.callsExpired += 1
+                self.metrics.call_finished(id, True)
+                self._chunks.pop(id, None)
+                self._consumed.pop(id, None)
+                if not finished.done():
+                    finished.set_exception(Fault(TIMEOUT_ERROR, 'Call %d timed out.' % id))
+
+        earliest = self._deadlines.earliest()
+        if earliest is not None:
+            # Don't wake up for every single deadline
+            self._schedule_timer(max(earliest, now + 0.01))
+
+    def cancel(self, id):
+        """ Cancels our pending call id, its result fails with a
+        CANCELLED_ERROR Fault. Returns False if it had finished.
+        """
+        finished = self.calls.pop(id, None)
+        if finished is None:
+            return False
+
+        self.callsCancelled += 1
+        self.metrics.call_finished(id, True)
+        self._chunks.pop(id, None)
+        self._consumed.pop(id, None)
+        self.send_stream_cancel(id)
+        if not finished.done():
+            finished.set_exception(Fault(CANCELLED_ERROR, 'Call %d cancelled.' % id))
+
+        return True
+
+
+async def _aiter(iterator):
+    """ Async iterator over a plain iterator.
+    """
+    for item in iterator:
+        yield item
+
+
+class StreamResult(object):
+    """ Async iterator over the chunks of a streamed reply,
+    raises the Fault if the call failed.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.id = None
+        self.queue = asyncio.Queue()
+        self._done = False
+
+    def put(self, chunk):
+        self.queue.put_nowait((True, chunk))
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return False
+
+    def add_done_callback(self, callback):
+        # Cancelling goes through cancel()
+        pass
+
+    def set_result(self, result=None):
+        """ Ends the stream, a plain (not streamed)
+        reply gets iterated if it is a list.
+        """
+        self._done = True
+        if isinstance(result, list):
+            for chunk in result:
+                self.queue.put_nowait((True, chunk))
+
+        self.queue.put_nowait((False, None))
+
+    def set_exception(self, exception):
+        self._done = True
+        self.queue.put_nowait((False, exception))
+
+    def cancel(self):
+        """ @see: SocketRPCProtocol.cancel
+        """
+        if self.id is None:
+            # Not sent yet (see SocketRPCClient.call_stream)
+            if self._done:
+                return False
+
+            self.set_exception(Fault(CANCELLED_ERROR, 'Call cancelled.'))
+            return True
+
+        return self.protocol.cancel(self.id)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk, value = await self.queue.get()
+        if not chunk:
+            # Keep ending for further iterations
+            self.queue.put_nowait((False, value))
+            if value is not None:
+                raise value
+            raise StopAsyncIteration
+
+        self.protocol.stream_consumed(self.id)
+        return value
+
+
+class SocketRPCServer(object):
+    """ Serves protocol on listener, (<host>, <port>) or "unix:<path>".
+    """
+
+    def __init__(self, listener, protocol, backlog=None):
+        self.listener = listener
+        self.protocol = protocol
+        self.backlog = backlog
+        self.server = None
+
+        # Connection counters
+        self.connections = 0
+        self.active_connections = 0
+
+        # Protocols of the open connections and the
+        # summed up metrics of the closed ones
+        self.protocols = set()
+        self.closedMetrics = Metrics()
+
+    def build_protocol(self):
+        protocol = self.protocol()
+        protocol.factory = self
+        return protocol
+
+    async def start(self):
+        """ Starts listening, returns the asyncio Server.
+        """
+        loop = asyncio.get_event_loop()
+
+        path = unix_path(self.listener)
+        if path is not None:
+            self.server = await loop.create_unix_server(self.build_protocol, path, backlog=self.backlog or 100)
+        else:
+            self.server = await loop.create_server(self.build_protocol, self.listener[0], self.listener[1],
+                                                   backlog=self.backlog or 100)
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+
+        await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    def protocol_connected(self, protocol):
+        self.connections += 1
+        self.active_connections += 1
+        self.protocols.add(protocol)
+
+    def protocol_lost(self, protocol):
+        self.active_connections -= 1
+        self.protocols.discard(protocol)
+        self.closedMetrics.merge(protocol.metrics)
+
+    def stats(self):
+        return {'connections': self.connections,
+                'active_connections': self.active_connections,
+               }
+
+    def metrics(self):
+        """ Returns the Metrics summed up over all connections.
+        """
+        metrics = Metrics()
+        metrics.merge(self.closedMetrics)
+        for protocol in self.protocols:
+            metrics.merge(protocol.metrics)
+
+        return metrics
+
+
+class SocketRPCClient(object):
+    """ RPClient for the above Server, connect() it from a coroutine.
+        Automaticaly reconnects to the target server (with "reconnect=True")
+        but looses any results which hasn't been transfered on reconnect.
+
+        Calls made while it isn't connected wait for the connection.
+    """
+
+    ## START Reconnecting feature,
+    # shameless borrowed from
+    # twisted.i.p.ReconnectingClientFactory (Rene)
+    maxDelay = 3600
+    initialDelay = 1.0
+    factor = 2.7182818284590451
+    jitter = 0.11962656472
+
+    delay = initialDelay
+    retries = 0
+    maxRetries = None
+
+    continueTrying = True
+    ## END Reconnecting
+
+    def __init__(self, address, protocol, reconnect=False, default_timeout=None):
+        self.address = address
+        # (<host>, <port>) or ("unix", <path>) for logging
+        self.target = address_tuple(address)
+
+        proto = self.protocol = protocol()
+        if not isinstance(proto, SocketRPCProtocol):
+            raise AttributeError('protocol must implement "SocketRPCProtocol"')
+
+        if default_timeout is not None:
+            proto.callTimeout = default_timeout
+
+        proto.factory = self
+        self.continueTrying = reconnect
+        self.connected = proto.connected
+        self.debug = proto.debug
+        self._connecting = None
+
+    async def connect(self):
+        """ Connects, with reconnect=True retries until it succeeds.
+        """
+        loop = asyncio.get_event_loop()
+        path = unix_path(self.address)
+        while True:
+            try:
+                if path is not None:
+                    await loop.create_unix_connection(lambda: self.protocol, path)
+                else:
+                    await loop.create_connection(lambda: self.protocol, self.address[0], self.address[1])
+                self.delay = self.initialDelay
+                self.retries = 0
+                return
+            except OSError as e:
+                self.connection_failed(e)
+
+                delay = self._next_delay()
+                if delay is None:
+                    raise
+
+                await asyncio.sleep(delay)
+
+    def _next_delay(self):
+        """ Returns the seconds to wait before the next
+        attempt, None to give up.
+        """
+        if not self.continueTrying:
+            return None
+
+        self.retries += 1
+        if self.maxRetries is not None and (self.retries > self.maxRetries):
+            if self.debug:
+                logging.debug("Abandoning %s:%s after %d retries." % (self.target[0], self.target[1], self.retries))
+            return None
+
+        self.delay = min(self.delay * self.factor, self.maxDelay)
+        if self.jitter:
+            self.delay = random.normalvariate(self.delay, self.delay * self.jitter)
+
+        if self.debug:
+            logging.debug("%s:%s will retry in %d seconds" % (self.target[0], self.target[1], self.delay))
+
+        return max(self.delay, 0)
+
+    def close(self):
+        """ Stops reconnecting and closes the connection.
+        """
+        self.continueTrying = False
+
+        transport = self.protocol.transport
+        if transport is not None:
+            transport.close()
+
+    def connection_failed(self, reason):
+        logging.error('Connection to %s:%s failed: %s' % (self.target[0], self.target[1], reason))
+
+    def protocol_connected(self, protocol):
+        logging.info('Connected to %s:%s' % self.target)
+
+    def protocol_lost(self, protocol):
+        logging.info('Lost connection to %s:%s' % self.target)
+
+        if self.continueTrying:
+            self._connecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self._next_delay()
+        if delay is None:
+            return
+
+        await asyncio.sleep(delay)
+        try:
+            await self.connect()
+        except OSError:
+            pass
+
+    def _when_connected(self, count, send):
+        """ Returns count Futures which get the results of the
+        Futures send() returns once connected.
+        """
+        if self.connected.is_set():
+            return send()
+
+        loop = asyncio.get_event_loop()
+        results = [loop.create_future() for i in range(count)]
+
+        async def wait():
+            await self.connected.wait()
+            for result, sent in zip(results, send()):
+                _chain(sent, result)
+
+        asyncio.ensure_future(wait())
+        return results
+
+    def call(self, method, *args, **kwargs):
+        return self.call_timeout(self.protocol.callTimeout, method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        return self._when_connected(1, lambda: [self.protocol.call_timeout(timeout, method, *args, **kwargs)])[0]
+
+    def call_many(self, calls, timeout=None):
+        return self._when_connected(len(calls), lambda: self.protocol.call_many(calls, timeout))
+
+    def call_stream(self, method, *args, **kwargs):
+        protocol = self.protocol
+        if self.connected.is_set():
+            return protocol.call_stream(method, *args, **kwargs)
+
+        finished = StreamResult(protocol)
+
+        async def wait():
+            await self.connected.wait()
+            if not finished.done():
+                protocol._send_call(finished, method, args, kwargs, protocol.callTimeout)
+
+        asyncio.ensure_future(wait())
+        return finished
+
+    def cancel(self, id):
+        return self.protocol.cancel(id)
+
+
+def socketpair():
+    """ Returns two connected Unix sockets, create them before forking
+    and pass one to connect_socket in the parent, the other one in the
+    child (with a new event loop). Either side can call the other.
+    """
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+async def connect_socket(sock, protocol, factory=None):
+    """ Runs a new protocol on the connected socket sock (see
+    socketpair) and returns it, there is no reconnecting.
+    """
+    proto = protocol()
+    proto.factory = factory
+
+    await asyncio.get_event_loop().connect_accepted_socket(lambda: proto, sock)
+
+    return proto
+
+
+def _chain(source, target):
+    """ Passes the outcome of Future source on to target,
+    cancelling target cancels source.
+    """
+    def done(source):
+        if target.done():
+            return
+
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    source.add_done_callback(done)
+    target.add_done_callback(lambda target: target.cancelled() and source.cancel())
+
+
+__all__ = ['Fault', 'rpcmethod', 'SocketRPCProtocol', 'SocketRPCServer', 'SocketRPCClient', 'StreamResult', 'socketpair', 'connect_socket',
+           'set_serializer']
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc, the benchmark suite which generates
+# docs/benchresults.csv:
+#
+#   python -m socketrpc.bench -o docs/benchresults.csv
+#
+# The backends can't share a process (gevent monkey patches, Twisted
+# runs its reactor), every server and client runs in its own process
+# with gevent_bench or twisted_bench, socketrpc.bench.runner drives them.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+import json
+import resource
+import sys
+import time
+
+# The params of examples/gevent_srpc.py
+SMALL_PARAMS = {'g': 'is',
+                'e': 'very',
+                'v': 'cool',
+                'e': 'fast',
+                'n': 'and',
+                't': 'sexy!'}
+
+# Latency percentiles of a client run
+PERCENTILES = (50, 90, 99)
+
+
+def payload(size):
+    """ Returns the argument of the "echo" calls, SMALL_PARAMS
+    for size 0 else a string of size bytes.
+    """
+    if not size:
+        return SMALL_PARAMS
+
+    return 'x' * size
+
+def percentiles(latencies, points=PERCENTILES):
+    """ Returns the points percentiles of latencies (in seconds),
+    nearest rank on the sorted values.
+    """
+    if not latencies:
+        return [0.0] * len(points)
+
+    latencies = sorted(latencies)
+    last = len(latencies) - 1
+
+    return [latencies[min(last, int(round(point / 100.0 * last)))] for point in points]
+
+def begin():
+    """ Returns the mark to pass to report, taken
+    before the first call (after the imports).
+    """
+    return time.time(), resource.getrusage(resource.RUSAGE_SELF)
+
+def report(mark, latencies):
+    """ Writes the result of a client run since mark (see begin)
+    as a JSON line to stdout.
+    """
+    started, before = mark
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result = {'seconds': time.time() - started,
+              'user': usage.ru_utime - before.ru_utime,
+              'system': usage.ru_stime - before.ru_stime,
+              # KB on Linux
+              'rss': usage.ru_maxrss,
+              'calls': len(latencies),
+              'percentiles': percentiles(latencies),
+             }
+
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+
+def parse_commandline(parser, description):
+    """ Parses the command line of gevent_bench and twisted_bench.
+    """
+    parser.usage = """%%prog [-s <serializer>] [-H <host>] [-p <port>] [-u <path>] [-m <mode>] [-P <bytes>] [-r <# of requests>] [-c <# concurrent>] server|client
+
+%s""" % description
+
+    parser.add_option("-H", "--host", dest="host", default='127.0.0.1',
+                      help="HOST to connect/listen. Default: 127.0.0.1", metavar="HOST")
+    parser.add_option("-p", "--port", dest="port", default='9990',
+                      help="PORT to connect/listen. Default: 9990", metavar="PORT")
+    parser.add_option("-u", "--unix", dest="unix", default=None,
+                      help="Use the Unix socket PATH instead of HOST and PORT", metavar="PATH")
+    parser.add_option("-s", "--serializer", dest="serializer", default='pickle2',
+                      help="Use serializer SERIALIZER. Default: pickle2", metavar="SERIALIZER")
+    parser.add_option("-m", "--mode", dest="mode", default='serial',
+                      help="Client MODE: serial or parallel. Default: serial", metavar="MODE")
+    parser.add_option("-P", "--payload", dest="payload", default=0,
+                      help="Echo a string of BYTES, 0 echos a small dict. Default: 0", metavar="BYTES")
+    parser.add_option("-r", "--requests", dest="requests", default=10000,
+                      help="NUMBER of requests. Default: 10000", metavar="NUMBER")
+    parser.add_option("-c", "--concurrency", dest="concurrency", default=100,
+                      help="NUMBER of calls in flight in parallel mode. Default: 100", metavar="NUMBER")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in ('server', 'client'):
+        parser.error('Please give "server" or "client"')
+
+    address = (options.host, int(options.port))
+    if options.unix is not None:
+        address = 'unix:' + options.unix
+
+    return {'role': args[0],
+            'host': options.host,
+            'port': int(options.port),
+            'unix': options.unix,
+            'address': address,
+            'serializer': options.serializer,
+            'mode': options.mode,
+            'payload': int(options.payload),
+            'requests': int(options.requests),
+            'concurrency': int(options.concurrency),
+           }
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+from socketrpc.bench.runner import main
+
+main()
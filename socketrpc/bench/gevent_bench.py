@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+# Run as a script (see socketrpc.bench.runner), patching
+# has to happen before anything imports socket
+from gevent import monkey; monkey.patch_all()
+from gevent.event import Event
+
+from socketrpc.bench import payload, begin, report, parse_commandline
+from socketrpc.gevent_srpc import SocketRPCProtocol, SocketRPCServer, SocketRPCClient, set_serializer
+
+import logging
+import time
+from optparse import OptionParser
+
+
+class BenchProtocol(SocketRPCProtocol):
+    def docall_echo(self, args):
+        return args
+
+
+def server(options):
+    SocketRPCServer(options['address'], BenchProtocol, backlog=2048).serve_forever()
+
+def client(options):
+    client = SocketRPCClient(options['address'], BenchProtocol)
+    params = payload(options['payload'])
+    requests = options['requests']
+
+    latencies = []
+    mark = begin()
+    if options['mode'] == 'serial':
+        for i in xrange(requests):
+            sent = time.time()
+            client.call('echo', params).get()
+            latencies.append(time.time() - sent)
+
+    else:
+        # Slices of concurrency calls, each
+        # slice waits for all of its replies
+        def done(result, sent):
+            latencies.append(time.time() - sent)
+            if len(latencies) == expected:
+                finished.set()
+
+        expected = 0
+        while expected < requests:
+            count = min(options['concurrency'], requests - expected)
+            expected += count
+
+            finished = Event()
+            for i in xrange(count):
+                client.call('echo', params).rawlink(lambda result, sent=time.time(): done(result, sent))
+
+            finished.wait()
+
+    report(mark, latencies)
+    client.close()
+
+def main():
+    options = parse_commandline(OptionParser(), 'Runs the gevent side of a socketrpc benchmark.')
+    logging.basicConfig(level=logging.WARNING)
+
+    set_serializer(options['serializer'])
+    if options['role'] == 'server':
+        server(options)
+    else:
+        client(options)
+
+if __name__ == '__main__':
+    main()
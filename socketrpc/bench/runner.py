@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+from socketrpc import __version__, SERIALIZERS
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+# Scripts running the server or client side of a case
+BACKENDS = {'gevent': 'gevent_bench.py',
+            'twisted': 'twisted_bench.py',
+            # Client only
+            'sync': 'sync_bench.py',
+           }
+
+# The columns of docs/benchresults.csv (CPU of the client, Mem of the
+# server), followed by the ones of the case and the rest of the usage
+CSV_HEADER = ('Server', 'Client', 'Protocol', 'clientmode', 'Seconds (Real)', 'CPU (User)', 'CPU (System)', 'Mem',
+              'Payload', 'Requests', 'Latency p50 (ms)', 'Latency p90 (ms)', 'Latency p99 (ms)', 'Transport',
+              'Server CPU (User)', 'Server CPU (System)', 'Client Mem')
+
+# Ways of connecting server and client of a case,
+# "unix" replaces loopback TCP by a Unix socket
+TRANSPORTS = ('tcp', 'unix')
+
+
+def bench_command(backend, role, options):
+    """ Returns the command line which runs role ("server" or "client")
+    of backend with options (see socketrpc.bench.parse_commandline).
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), BACKENDS[backend])
+
+    command = [sys.executable, script, role]
+    for name in ('host', 'port', 'unix', 'serializer', 'mode', 'payload', 'requests', 'concurrency'):
+        if options.get(name) is not None:
+            command.append('--%s=%s' % (name, options[name]))
+
+    return command
+
+def bench_environment():
+    """ Returns os.environ with this socketrpc first on PYTHONPATH.
+    """
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join([path] + filter(None, [env.get('PYTHONPATH')]))
+
+    return env
+
+def free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+def process_usage(pid):
+    """ Returns the user and system CPU seconds and the peak RSS (KB, like
+    ru_maxrss on Linux) of process pid, None without a /proc file system.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+        with open('/proc/%d/status' % pid) as f:
+            status = f.read()
+    except IOError:
+        return None
+
+    # The command may contain spaces, the fields after
+    # it start with the state (the third field)
+    fields = stat[stat.rindex(')') + 2:].split()
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+
+    rss = 0
+    for line in status.splitlines():
+        if line.startswith('VmHWM:'):
+            rss = int(line.split()[1])
+
+    return int(fields[11]) / ticks, int(fields[12]) / ticks, rss
+
+def wait_listening(options, process, timeout=10.0):
+    """ Waits until process accepts connections on
+    the Unix socket or host:port of options.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited with %d' % process.returncode)
+
+        try:
+            if options.get('unix') is not None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(options['unix'])
+                finally:
+                    sock.close()
+            else:
+                socket.create_connection((options['host'], options['port']), 1.0).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+
+    raise RuntimeError('Server not listening after %.0f seconds' % timeout)
+
+def run_case(server, client, serializer, mode, payload, requests, concurrency, transport='tcp', host='127.0.0.1'):
+    """ Runs one case over loopback, every side in its own process.
+
+    Returns the client's report (see socketrpc.bench.report) with the
+    CPU seconds the server used during the run ("server_user" and
+    "server_system") and its peak RSS ("server_rss"), 0 where the
+    server's usage can't be sampled.
+    """
+    env = bench_environment()
+    options = {'host': host,
+               'port': free_port(host),
+               'serializer': serializer,
+              }
+
+    directory = None
+    if transport == 'unix':
+        directory = tempfile.mkdtemp(prefix='socketrpc-bench-')
+        options['unix'] = os.path.join(directory, 'server.sock')
+
+    process = subprocess.Popen(bench_command(server, 'server', options), env=env)
+    try:
+        wait_listening(options, process)
+
+        options.update({'mode': mode,
+                        'payload': payload,
+                        'requests': requests,
+                        'concurrency': concurrency,
+                       })
+        before = process_usage(process.pid)
+        output = subprocess.check_output(bench_command(client, 'client', options), env=env)
+        after = process_usage(process.pid)
+
+        result = json.loads(output.strip().splitlines()[-1])
+        result.update({'server_user': 0.0, 'server_system': 0.0, 'server_rss': 0})
+        if before is not None and after is not None:
+            result.update({'server_user': after[0] - before[0],
+                           'server_system': after[1] - before[1],
+                           'server_rss': after[2],
+                          })
+
+        return result
+    finally:
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+        if directory is not None:
+            if os.path.exists(options['unix']):
+                os.unlink(options['unix'])
+            os.rmdir(directory)
+
+def case_requests(payload, requests, max_bytes):
+    """ Returns the number of requests for payload, large ones
+    get limited to max_bytes of payload per case.
+    """
+    if not payload or max_bytes is None:
+        return requests
+
+    return max(min(requests, max_bytes // payload), 10)
+
+def run_matrix(servers, clients, serializers, modes, payloads, requests, concurrency, max_bytes=None, progress=None,
+               transports=('tcp',)):
+    """ Generator which runs every combination and yields a
+    CSV_HEADER row for each. Serializers which aren't
+    available get skipped.
+    """
+    for serializer in serializers:
+        if serializer not in SERIALIZERS:
+            if progress is not None:
+                progress('%s skipped: not available\n' % serializer)
+            continue
+
+        for server in servers:
+            for client in clients:
+                for mode in modes:
+                    for payload in payloads:
+                        count = case_requests(payload, requests, max_bytes)
+                        for transport in transports:
+                            if progress is not None:
+                                progress('%s <- %s %s %s %d bytes x %d over %s\n' % (server, client, serializer, mode,
+                                                                                   payload, count, transport))
+
+                            result = run_case(server, client, serializer, mode, payload, count, concurrency, transport)
+
+                            yield ([server, client, 'Socketrpc-%s' % serializer, mode,
+                                    result['seconds'], result['user'], result['system'], result['server_rss'],
+                                    payload, result['calls']] + [seconds * 1000.0 for seconds in result['percentiles']] +
+                                   [transport, result['server_user'], result['server_system'], result['rss']])
+
+def format_row(row):
+    """ Returns row in the format of docs/benchresults.csv, tab separated
+    with quoted strings and decimal commas.
+    """
+    fields = []
+    for value in row:
+        if isinstance(value, basestring):
+            fields.append('"%s"' % value.replace('"', '""'))
+        elif isinstance(value, float):
+            fields.append(('%.2f' % value).replace('.', ','))
+        else:
+            fields.append(str(value))
+
+    return '\t'.join(fields)
+
+def parse_commandline(parser=None):
+    if parser is None:
+        parser = OptionParser(usage="""%prog [-v] [-o <file>] [-S <backends>] [-C <backends>] [-s <serializers>] [-m <modes>] [-P <payloads>] [-t <transports>] [-r <# of requests>]
+
+Runs every combination of server and client backend, serializer, client
+mode, payload and transport over loopback (each side in its own process) and writes
+the results in the format of docs/benchresults.csv.""")
+
+    parser.add_option("-v", "--version", dest="print_version",
+                        help="print current Version", action="store_true")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Append the rows to FILE, the header only if it's empty. Default: stdout", metavar="FILE")
+    parser.add_option("-S", "--servers", dest="servers", default='gevent,twisted',
+                      help="Comma separated server BACKENDS. Default: gevent,twisted", metavar="BACKENDS")
+    parser.add_option("-C", "--clients", dest="clients", default='gevent,twisted',
+                      help="Comma separated client BACKENDS. Default: gevent,twisted", metavar="BACKENDS")
+    parser.add_option("-s", "--serializers", dest="serializers", default='bson,jsonlib,pickle2',
+                      help="Comma separated SERIALIZERS. Default: bson,jsonlib,pickle2", metavar="SERIALIZERS")
+    parser.add_option("-m", "--modes", dest="modes", default='serial,parallel',
+                      help="Comma separated client MODES. Default: serial,parallel", metavar="MODES")
+    parser.add_option("-P", "--payloads", dest="payloads", default='0,1024,65536,1048576',
+                      help="Comma separated payload SIZES in bytes, 0 is a small dict. Default: 0,1024,65536,1048576", metavar="SIZES")
+    parser.add_option("-t", "--transports", dest="transports", default='tcp',
+                      help="Comma separated TRANSPORTS: tcp (loopback) and unix. Default: tcp", metavar="TRANSPORTS")
+    parser.add_option("-r", "--requests", dest="requests", default=10000,
+                      help="NUMBER of requests per case. Default: 10000", metavar="NUMBER")
+    parser.add_option("-c", "--concurrency", dest="concurrency", default=100,
+                      help="NUMBER of calls in flight in parallel mode. Default: 100", metavar="NUMBER")
+    parser.add_option("-b", "--max-bytes", dest="max_bytes", default=256 * 1024 * 1024,
+                      help="Limit the requests of large payloads to BYTES per case. Default: 268435456", metavar="BYTES")
+
+    (options, args) = parser.parse_args()
+    if options.print_version:
+        print "%s: %s" % ('socketrpc', __version__)
+        sys.exit(0)
+
+    for transport in options.transports.split(','):
+        if transport not in TRANSPORTS:
+            parser.error('Unknown transport "%s", choose from %s' % (transport, ', '.join(TRANSPORTS)))
+
+    return {'output': options.output,
+            'servers': options.servers.split(','),
+            'clients': options.clients.split(','),
+            'serializers': options.serializers.split(','),
+            'modes': options.modes.split(','),
+            'payloads': [int(size) for size in options.payloads.split(',')],
+            'transports': options.transports.split(','),
+            'requests': int(options.requests),
+            'concurrency': int(options.concurrency),
+            'max_bytes': int(options.max_bytes),
+           }
+
+def main():
+    options = parse_commandline()
+
+    out = sys.stdout
+    header = True
+    if options['output'] is not None:
+        # Keeps the rows of earlier runs
+        header = not os.path.exists(options['output']) or not os.path.getsize(options['output'])
+        out = open(options['output'], 'a')
+
+    try:
+        if header:
+            out.write(format_row(CSV_HEADER) + '\n')
+        rows = run_matrix(options['servers'], options['clients'], options['serializers'], options['modes'],
+                          options['payloads'], options['requests'], options['concurrency'], options['max_bytes'],
+                          progress=sys.stderr.write, transports=options['transports'])
+        for row in rows:
+            out.write(format_row(row) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+from socketrpc.bench import payload, begin, report, parse_commandline
+from socketrpc.sync_client import SocketRPCClient, set_serializer
+
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+
+def client(options):
+    client = SocketRPCClient(options['address'])
+    params = payload(options['payload'])
+    requests = options['requests']
+
+    def serial(count):
+        for i in xrange(count):
+            sent = time.time()
+            client.call('echo', params)
+            latencies.append(time.time() - sent)
+
+    latencies = []
+    mark = begin()
+    if options['mode'] == 'serial':
+        serial(requests)
+
+    else:
+        # concurrency threads doing blocking calls,
+        # sharing the connections of the pool
+        concurrency = min(options['concurrency'], requests)
+        threads = []
+        for i in xrange(concurrency):
+            count = requests // concurrency + (i < requests % concurrency)
+            threads.append(threading.Thread(target=serial, args=(count,)))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    report(mark, latencies)
+    client.close()
+
+def main():
+    options = parse_commandline(OptionParser(), 'Runs the blocking client side of a socketrpc benchmark.')
+
+    set_serializer(options['serializer'])
+    if options['role'] == 'server':
+        sys.exit('sync_bench: socketrpc.sync_client has no server side')
+
+    client(options)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+from twisted.internet import protocol, reactor, defer
+
+from socketrpc.bench import payload, begin, report, parse_commandline
+from socketrpc.twisted_srpc import SocketRPCProtocol, set_serializer, listen
+
+import sys
+import time
+from optparse import OptionParser
+
+
+class BenchProtocol(SocketRPCProtocol):
+    def docall_echo(self, args):
+        return args
+
+
+def server(options):
+    f = protocol.ServerFactory()
+    f.protocol = BenchProtocol
+    listen(options['address'], f, backlog=2048)
+
+@defer.inlineCallbacks
+def client(remote, options):
+    params = payload(options['payload'])
+    requests = options['requests']
+
+    def done(result, sent):
+        latencies.append(time.time() - sent)
+
+    latencies = []
+    mark = begin()
+    if options['mode'] == 'serial':
+        for i in xrange(requests):
+            sent = time.time()
+            yield remote.call('echo', params)
+            latencies.append(time.time() - sent)
+
+    else:
+        # Slices of concurrency calls, each
+        # slice waits for all of its replies
+        sent = 0
+        while sent < requests:
+            count = min(options['concurrency'], requests - sent)
+            sent += count
+
+            dl = []
+            for i in xrange(count):
+                d = remote.call('echo', params)
+                d.addCallback(done, time.time())
+                dl.append(d)
+
+            yield defer.gatherResults(dl)
+
+    report(mark, latencies)
+    remote.transport.loseConnection()
+
+def main():
+    options = parse_commandline(OptionParser(), 'Runs the Twisted side of a socketrpc benchmark.')
+
+    set_serializer(options['serializer'])
+
+    failures = []
+    if options['role'] == 'server':
+        server(options)
+    else:
+        creator = protocol.ClientCreator(reactor, BenchProtocol)
+        if options['unix'] is not None:
+            d = creator.connectUNIX(options['unix'])
+        else:
+            d = creator.connectTCP(options['host'], options['port'])
+        d.addCallback(client, options)
+        d.addErrback(lambda failure: failures.append(failure) or failure.printTraceback(sys.stderr))
+        d.addBoth(lambda ign: reactor.stop())
+
+    reactor.run()
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -8,18 +8,35 @@
 #
 ###############################################################################
 
-from socketrpc import set_serializer2, Fault, STRUCT_INT, struct_error
-from socketrpc import STATUS_OK, NOT_WELLFORMED_ERROR, METHOD_NOT_FOUND, APPLICATION_ERROR
-
-from gevent import spawn, spawn_later
+from socketrpc import set_serializer2, Fault, STRUCT_INT, struct_error, rpcmethod, bind_dispatch, tobytes, is_stream
+from socketrpc import FRAME_COMPRESSED, FRAME_CONTROL, FRAME_FLAGS, FRAME_LENGTH, COMPRESSORS, SERIALIZERS, Handshake
+from socketrpc import encode_message, decode_message, ResultCache, DeadlineHeap, Metrics, call_deadline
+from socketrpc import STATUS_OK, NOT_WELLFORMED_ERROR, METHOD_NOT_FOUND, APPLICATION_ERROR, TRANSPORT_ERROR
+from socketrpc import TIMEOUT_ERROR, CANCELLED_ERROR, OVERLOADED_ERROR, STREAM_CANCEL
+from socketrpc import unix_path, address_tuple, peer_address, FRAME_SHM, ShmSegment, ShmReader, ReplicaSet
+
+from gevent import spawn, spawn_later, joinall, sleep, reinit
+from gevent.hub import get_hub
 from gevent.server import StreamServer
 from gevent.event import AsyncResult, Event
-from gevent.queue import Queue
+from gevent.queue import Queue, Empty
+from gevent.pool import Pool
+from gevent.lock import BoundedSemaphore, Semaphore
+from gevent.os import make_nonblocking, nb_write
 from gevent.socket import create_connection
-from gevent.socket import socket as gsocket
+from gevent.socket import socket as gsocket, socketpair as gsocketpair
 
-from socket import error as pysocket_error
+from socket import error as pysocket_error, SHUT_WR
+from socket import AF_INET, AF_INET6, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+import socket as pysocket
 import random
+import os
+import stat
+import errno
+import fcntl
+import signal
+import time
+import json
 
 try:
     from cStringIO import StringIO
@@ -34,17 +51,26 @@ def decode(data):
     pass
 def encode(obj):
     pass
+documents = False
+serializer_name = None
 
-def set_serializer(predefined=None, encode=None, decode=None):
+def set_serializer(predefined=None, encode=None, decode=None, buffers=False, documents=False):
     """ Sets the serializer for this class.
     @see: socketrpc.set_serializer2
     """
-    set_serializer2(predefined, encode, decode, globals())
+    set_serializer2(predefined, encode, decode, globals(), buffers, documents)
 
 
 def _recvsized(self):
+    header = ''
+    while len(header) < 4:
+        chunk = self.recv(4 - len(header))
+        if not chunk:
+            break
+        header += chunk
+
     try:
-        message_length = STRUCT_INT.unpack(self.recv(4))[0]
+        message_length = STRUCT_INT.unpack(header)[0]
     except struct_error:
         return Fault(NOT_WELLFORMED_ERROR, 'Haven\'t got a length.')
 
@@ -63,32 +89,219 @@ def _recvsized(self):
     return sock_buf.getvalue()
 
 
+def _recvframes(self, bufsize=65536):
+    """ Generator which yields (<flags>, <payload>) for every received
+    frame, the payload is a memoryview slice of one per connection bytearray.
+
+    Reads with recv_into, so a single read can carry many frames,
+    a slice is only valid until the next frame has been requested.
+    """
+    unpack_from = STRUCT_INT.unpack_from
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    start = end = 0
+
+    while True:
+        need = 4
+        while end - start >= 4:
+            word = unpack_from(buf, start)[0]
+            need = (word & FRAME_LENGTH) + 4
+            if end - start < need:
+                break
+
+            yield word & FRAME_FLAGS, view[start + 4:start + need]
+            start += need
+            need = 4
+
+        if start == end:
+            # Nothing pending, start over (and shrink after a large frame)
+            start = end = 0
+            if len(buf) > bufsize and need <= bufsize:
+                buf = bytearray(bufsize)
+                view = memoryview(buf)
+
+        elif len(buf) - start < need:
+            # Frame doesn't fit behind start, compact or grow
+            pending = end - start
+            if need <= len(buf):
+                buf[:pending] = buf[start:end]
+            else:
+                grown = bytearray(max(need, len(buf) * 2))
+                grown[:pending] = view[start:end]
+                buf = grown
+                view = memoryview(buf)
+            start, end = 0, pending
+
+        count = self.recv_into(view[end:])
+        if not count:
+            return
+
+        end += count
+
+
 def _sendsized(self, data):
     data = STRUCT_INT.pack(len(data)) + data
     self.sendall(data)
 
+
+def _sendsized_many(self, frames):
+    """ Frames all (<flags>, <data>) tuples of frames
+    and sends them with a single sendall.
+    """
+    pack = STRUCT_INT.pack
+    parts = []
+    for flags, data in frames:
+        parts.append(pack(flags | len(data)))
+        parts.append(data)
+
+    self.sendall(''.join(parts))
+
 # Monkey patch the gevent socket
 _socket = gsocket
 _socket.recvsized = _recvsized
+_socket.recvframes = _recvframes
 _socket.sendsized = _sendsized
+_socket.sendsized_many = _sendsized_many
 del _socket
 
 
 class SocketRPCProtocol:
 
     debug = False
+
+    # Without it a call to "a.b" falls back to "ab" if there
+    # is no method named "a.b"
     allow_dotted_attributes = False
 
+    # Run dispatch_reply in the read loop instead of a new greenlet
+    inlineReplies = False
+
+    # Maximum number of concurrent call handlers per connection, once
+    # reached the connection stops reading until a handler finishes
+    maxHandlers = None
+
+    # Compressors to offer the peer (most preferred first), frames
+    # of at least compressThreshold bytes get compressed
+    compression = None
+    compressThreshold = 4096
+
+    # Highest message version to offer the peer, 2 replaces
+    # the envelope dict by a fixed binary header
+    messageVersion = 1
+
+    # Advertise the docall_ methods with integer ids and call the
+    # peer's methods by id once it advertised them
+    internMethods = False
+
+    # Serializers to offer the peer (fastest first), until the
+    # handshake is done the one of set_serializer gets used
+    serializers = None
+
+    # Chunks of a streamed reply which may be in flight
+    streamWindow = 16
+
+    # Default timeout in seconds of our calls, the remaining time
+    # gets sent along so the peer can skip calls we gave up on
+    callTimeout = None
+
+    # Frames of at least offloadThreshold bytes get decompressed and
+    # decoded in the hub's thread pool while this connection waits,
+    # the replies of @rpcmethod(offload=True) methods get encoded there
+    offloadThreshold = None
+
+    # With a peer on the same host which offers it as well, messages
+    # of at least sharedMemoryThreshold bytes go through a shared
+    # memory segment of sharedMemorySize bytes per connection and
+    # direction, the socket only carries their descriptor
+    sharedMemory = False
+    sharedMemorySize = 64 * 1024 * 1024
+    sharedMemoryThreshold = 1024 * 1024
+
+    # Maximum number of our calls awaiting a reply and of encoded
+    # bytes waiting in the write queue, once reached call() waits
+    # ("block") or its result fails with OVERLOADED_ERROR ("fail")
+    maxInflight = None
+    maxWriteBytes = None
+    flowPolicy = 'block'
+
+    # Initial size of the per connection receive buffer
+    recvBufferSize = 65536
+
+    # Upper limits for a single coalesced write in handle_write
+    writeBatchBytes = 262144
+    writeBatchCount = 1024
+
     def __init__(self):
         """ Sets up instance only variables
         """
         self.id = 0
         self.calls = {}
 
+        # {<name>: (<bound docall_ method>, <inline>, <offload>)}
+        self._dispatch = bind_dispatch(self)
+        # Interned method ids index _methodNames and _methods
+        self._methodNames = sorted(self._dispatch)
+        self._methods = [self._dispatch[name] for name in self._methodNames]
+
         self.connected = Event()
 
         self.writeQueue = Queue()
         self.doWrite = True
+        # Encoded bytes in writeQueue, set while the window is open
+        self.writeBytes = 0
+        self._window = Event()
+        self._window.set()
+
+        # Streamed replies we send, {<id>: <credit Semaphore>}, None
+        # while the method runs (see dispatch_call)
+        self._streams = {}
+        # Chunks received for plain calls, {<id>: [<chunk>, ...]}
+        self._chunks = {}
+        # Consumed chunks not yet granted as credit, {<id>: <count>}
+        self._consumed = {}
+
+        # Negotiated connection options
+        self.handshake = None
+        self._compress = None
+        self._decompress = None
+        self._sendVersion = 1
+        self._recvVersion = 1
+        self._sendSerializer = None
+        self._recvSerializer = None
+        # {<name>: <id>} of the peer's interned methods
+        self._methodIds = {}
+
+        # Our shared memory segment, once the peer mapped it we send
+        # through it (_shmSend), _shmRecv is the peer's segment
+        self._shmSegment = None
+        self._shmSend = None
+        self._shmRecv = None
+
+        # Latency, byte and serializer counters
+        self.metrics = Metrics()
+
+        # Deadlines of our pending calls and the timer for the earliest
+        self._deadlines = DeadlineHeap()
+        self._timer = None
+        self._timerAt = None
+
+        # Calls which timed out, got cancelled, their replies
+        # which came too late and received calls we skipped
+        self.callsExpired = 0
+        self.callsCancelled = 0
+        self.lateReplies = 0
+        self.callsSkipped = 0
+
+        # Running call handlers and backpressure counters
+        self.handlers = Pool(self.maxHandlers)
+        self.handlerLimit = None
+        self.readStalls = 0
+        self.callStalls = 0
+        self.callsRejected = 0
+
+        # Write coalescing counters
+        self.writeBatches = 0
+        self.writeFrames = 0
 
 
     def make_connection(self, socket, address, factory):
@@ -99,92 +312,650 @@ class SocketRPCProtocol:
         self.factory = factory
         self.logger = logging.getLogger("%s.%s:%s" % (self.__class__.__name__, address[0], address[1]))
 
+        # Server wide handler limit
+        self.handlerLimit = getattr(factory, 'handlerLimit', None)
+
+        # A write queue per connection, the writer of a lost
+        # one never takes frames from (or stops) the next one
+        self.writeQueue = Queue()
+        self.writeBytes = 0
+        self._window.set()
+
+        self._compress = None
+        self._decompress = None
+        self._sendVersion = 1
+        self._recvVersion = 1
+        self._sendSerializer = None
+        self._recvSerializer = None
+        self._methodIds = {}
+        if self.sharedMemory:
+            self.open_shared_memory()
+        self.handshake = Handshake(self.hello_offer())
+        hello = self.handshake.hello()
+        if hello is not None:
+            self.queue_frame((FRAME_CONTROL, hello))
+
+        self.connected.set()
+
+    def hello_offer(self):
+        """ Returns the options to offer the peer on connect,
+        an empty offer skips the handshake.
+        """
+        offer = {}
+        if self.compression:
+            offer['compression'] = list(self.compression)
+        if self.messageVersion > 1:
+            offer['version'] = self.messageVersion
+        if self.internMethods:
+            offer['methods'] = self._methodNames
+        if self.serializers:
+            offer['serializers'] = [name for name in self.serializers if name in SERIALIZERS]
+        if self._shmSegment is not None:
+            offer['shm'] = self._shmSegment.offer()
+
+        return offer
+
+    def open_shared_memory(self):
+        """ Creates our segment to offer, without one
+        everything goes through the socket.
+        """
+        try:
+            self._shmSegment = ShmSegment(self.sharedMemorySize)
+        except EnvironmentError, e:
+            self.logger.warning('No shared memory segment: %s' % e)
 
     def handle_read(self):
         self.connected.set()
         self.connection_made()
 
         _sock = self.socket
+        queue = self.writeQueue
 
         try:
-            while True:
-                data = _sock.recvsized()
-                if isinstance(data, Fault):
-                    return
+            for flags, data in _sock.recvframes(self.recvBufferSize):
+                self.metrics.received(1, len(data) + 4)
+
+                if flags == FRAME_SHM:
+                    data = self.shared_frame(data)
+                    if isinstance(data, Fault):
+                        self.fault_received(data)
+                        continue
+                    flags = 0
+
+                elif flags & FRAME_CONTROL:
+                    self.control_received(data)
+                    continue
+
+                if self._shmSegment is not None and self.handshake.peer is None:
+                    # The peer's first frame wasn't a hello, it has no offer
+                    self.close_shared_memory()
 
-                data = decode(data)
-                if isinstance(data, Fault):
-                    self.fault_received(data)
+                threshold = self.offloadThreshold
+                if threshold is not None and len(data) >= threshold:
+                    # Only this connection waits, the next frame
+                    # gets read after this one has been dispatched
+                    message = self.offload(self.decode_frame, flags, data)
+                else:
+                    message = self.decode_frame(flags, data)
+
+                if isinstance(message, Fault):
+                    self.fault_received(message)
                     continue
 
-                transaction, obj = data.iteritems().next()
+                transaction, obj = message
 
                 # Dispatch the transaction
                 if transaction == 'call':
-                    spawn(self.dispatch_call, obj[0], obj[3], obj[1], obj[2])
+                    deadline = call_deadline(obj)
+                    entry = self.find_method(obj[0])
+                    # Until it runs, a cancel of the caller removes it (see dispatch_call)
+                    self._streams[obj[3]] = None
+                    if entry is not None and entry[1]:
+                        self.dispatch_call(obj[0], obj[3], obj[1], obj[2], deadline)
+                    else:
+                        self.spawn_handler(self.dispatch_call, obj[0], obj[3], obj[1], obj[2], deadline)
                 elif transaction == 'reply':
-                    spawn(self.dispatch_reply, obj[0], obj[1], obj[2])
+                    if self.inlineReplies:
+                        self.dispatch_reply(obj[0], obj[1], obj[2])
+                    else:
+                        spawn(self.dispatch_reply, obj[0], obj[1], obj[2])
+                elif transaction == 'batch':
+                    self.dispatch_batch(obj, time.time())
+                elif transaction == 'stream':
+                    self.dispatch_stream(obj[0], obj[1])
+                elif transaction == 'stream_end':
+                    self.dispatch_stream_end(obj[0], obj[1], obj[2])
+                elif transaction == 'stream_credit':
+                    self.dispatch_stream_credit(obj[0], obj[1])
                 else:
-                    self.fault_received(NOT_WELLFORMED_ERROR, 'Unknown transaction: %s' % transaction)
+                    self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Unknown transaction: %s' % transaction))
 
         finally:
             # TODO: Make sure that everything has been transmitted.
             self.connected.clear()
+
+            # Wake up streams waiting for credit, they see the lost connection
+            streams = self._streams
+            self._streams = {}
+            for credit in streams.itervalues():
+                if credit is not None:
+                    credit.release()
+            self._chunks = {}
+            self._consumed = {}
+
+            # Fail our pending calls, nobody would answer them
+            self._deadlines.clear()
+            if self._timer is not None:
+                self._timer.kill(block=False)
+                self._timer = None
+
+            calls = self.calls
+            self.calls = {}
+            self.metrics.calls_lost()
+            for finished in calls.itervalues():
+                finished.set_exception(Fault(TRANSPORT_ERROR, 'Connection lost.'))
+
+            # Callers waiting for the window see the lost connection
+            self._window.set()
+
+            # Stops the writer of this connection
+            self._compress = None
+            self._sendVersion = 1
+            self._sendSerializer = None
+            self._methodIds = {}
+            self.close_shared_memory()
+            queue.put(None)
+
             self.connection_lost()
 
     def handle_write(self):
+        """ Drains everything currently queued (up to writeBatchBytes
+        and writeBatchCount) and sends it with one sendall per wakeup.
+        """
         q = self.writeQueue
+        sock = self.socket
 
         self.connected.wait()
 
-        _sock = self.socket
+        max_bytes = self.writeBatchBytes
+        max_count = self.writeBatchCount
         try:
-            while True:
-                data = q.get()
+            stop = False
+            while not stop:
+                frame = q.get()
+                if frame is None:
+                    return
+
+                batch = [frame]
+                size = len(frame[1])
+
+                while size < max_bytes and len(batch) < max_count:
+                    try:
+                        frame = q.get_nowait()
+                    except Empty:
+                        break
+
+                    if frame is None:
+                        stop = True
+                        break
+
+                    batch.append(frame)
+                    size += len(frame[1])
 
                 try:
-                    self.socket.sendsized(data)
+                    sock.sendsized_many(batch)
                 except (TypeError, pysocket_error), e:
                     # TODO: This needs to be passed
                     self.logger.exception(e)
+
+                if q is self.writeQueue:
+                    # Not the leftovers of a lost connection
+                    self.writeBytes -= size
+                    self.release_window()
+
+                self.metrics.sent(len(batch), size + 4 * len(batch))
+
+                self.writeBatches += 1
+                self.writeFrames += len(batch)
         finally:
             pass
 
+    def control_received(self, data):
+        """ Handles handshake control frames.
+        """
+        handshake = self.handshake
+        use = handshake.received(data)
+        if use is not None:
+            if handshake.send.get('shm'):
+                # Map the peer's segment before confirming it
+                try:
+                    self._shmRecv = ShmReader(handshake.peer['shm']['path'], handshake.peer['shm']['token'])
+                except (EnvironmentError, ValueError), e:
+                    # Not confirmed, the peer keeps sending inline frames
+                    self.logger.warning('Can\'t map the peer\'s shared memory segment: %s' % e)
+                    use = handshake.withdraw('shm')
+
+            # Frames after "use" get sent with the new options
+            self.queue_frame((FRAME_CONTROL, use))
+
+            compression = handshake.send.get('compression')
+            self._compress = compression and COMPRESSORS[compression][0] or None
+            self._sendVersion = handshake.send.get('version', 1)
+            self._sendSerializer = handshake.send.get('serializer')
+            self._methodIds = dict((name, id) for id, name in enumerate(handshake.peer.get('methods') or ()))
+
+        compression = handshake.recv.get('compression')
+        self._decompress = compression and COMPRESSORS[compression][1] or None
+        self._recvVersion = handshake.recv.get('version', 1)
+        self._recvSerializer = handshake.recv.get('serializer')
+
+        segment = self._shmSegment
+        if segment is not None and handshake.used and self._shmSend is None:
+            if handshake.recv.get('shm') == segment.path:
+                # Mapped by the peer, nobody else needs the file
+                self._shmSend = segment
+                segment.unlink()
+            else:
+                self._shmSegment = None
+                segment.close()
+
+    def shared_frame(self, descriptor):
+        """ Returns the message of a FRAME_SHM descriptor or a Fault.
+        """
+        if self._shmRecv is None:
+            return Fault(NOT_WELLFORMED_ERROR, 'Shared memory frame without a segment.')
+
+        return self._shmRecv.read(descriptor)
+
+    def close_shared_memory(self):
+        """ Unmaps both segments, our file gets removed.
+        """
+        self._shmSend = None
+        if self._shmSegment is not None:
+            self._shmSegment.close()
+            self._shmSegment = None
+
+        if self._shmRecv is not None:
+            self._shmRecv.close()
+            self._shmRecv = None
+
+    def encode_message(self, transaction, obj):
+        """ Encodes transaction obj with the negotiated serializer
+        and message version.
+        """
+        name = self._sendSerializer
+        if name is None:
+            name, func, docs = serializer_name, encode, documents
+        else:
+            func, decoder, docs = SERIALIZERS[name]
+
+        start = time.time()
+        data = encode_message(func, transaction, obj, self._sendVersion, docs)
+        self.metrics.serialized(name, time.time() - start)
+
+        return data
+
+    def decode_message(self, data):
+        """ Returns (<transaction>, <obj>) of a received message or a Fault.
+        """
+        name = self._recvSerializer
+        if name is None:
+            name, func, docs = serializer_name, decode, documents
+        else:
+            encoder, func, docs = SERIALIZERS[name]
+
+        start = time.time()
+        message = decode_message(func, data, self._recvVersion, docs)
+        self.metrics.serialized(name, time.time() - start, encoded=False)
+
+        return message
+
+    def decode_frame(self, flags, data):
+        """ Returns (<transaction>, <obj>) of a (compressed)
+        frame or a Fault.
+        """
+        if flags & FRAME_COMPRESSED:
+            if self._decompress is None:
+                return Fault(NOT_WELLFORMED_ERROR, 'Compressed frame without a compressor.')
+
+            data = self._decompress(tobytes(data))
+
+        return self.decode_message(data)
+
+    def encode_frame(self, transaction, obj):
+        """ Returns the (<flags>, <data>) frame of transaction obj or a Fault.
+        """
+        data = self.encode_message(transaction, obj)
+        if isinstance(data, Fault):
+            return data
+
+        return self.compress_frame(data)
+
+    def compress_frame(self, data):
+        """ Returns the (<flags>, <data>) frame of data, compressed
+        when negotiated and at least compressThreshold bytes long.
+        """
+        if self._shmSend is not None and len(data) >= self.sharedMemoryThreshold:
+            # Goes through shared memory, see queue_frame
+            return (0, data)
+
+        compress = self._compress
+        if compress is not None and len(data) >= self.compressThreshold:
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                return (FRAME_COMPRESSED, compressed)
+
+        return (0, data)
+
+    def send_frame(self, data):
+        """ Queues data for handle_write, see compress_frame.
+        """
+        self.queue_frame(self.compress_frame(data))
+
+    def queue_frame(self, frame):
+        """ Queues a (<flags>, <data>) frame for handle_write, large
+        ones go through shared memory if the peer mapped our segment.
+        """
+        segment = self._shmSend
+        if segment is not None and not frame[0] and len(frame[1]) >= self.sharedMemoryThreshold:
+            descriptor = segment.write(frame[1])
+            if descriptor is not None:
+                frame = (FRAME_SHM, descriptor)
+
+        self.writeBytes += len(frame[1])
+        self.writeQueue.put(frame)
+
+    def window_open(self, count=1):
+        """ Returns True if count more calls fit into maxInflight and
+        the write queue is below maxWriteBytes. Without pending
+        calls any number fits, a large call_many would never fit else.
+        """
+        limit = self.maxInflight
+        if limit is not None and self.calls and len(self.calls) + count > limit:
+            return False
+
+        limit = self.maxWriteBytes
+        return limit is None or self.writeBytes < limit
+
+    def acquire_window(self, count=1):
+        """ Waits until count more calls fit into the window (see
+        window_open), returns None then or the Fault to fail them with.
+        """
+        stalled = False
+        while not self.window_open(count):
+            if self.flowPolicy != 'block':
+                self.callsRejected += count
+                return Fault(OVERLOADED_ERROR, 'Call window full.')
+
+            if not stalled:
+                self.callStalls += 1
+                stalled = True
+
+            self._window.clear()
+            self._window.wait()
+            if not self.connected.is_set():
+                return Fault(TRANSPORT_ERROR, 'Connection lost.')
+
+        return None
+
+    def release_window(self):
+        """ Wakes up the callers waiting in acquire_window
+        once there is room again.
+        """
+        if not self._window.is_set() and self.window_open():
+            self._window.set()
+
+    def offload(self, func, *args):
+        """ Runs func in the hub's thread pool, the calling greenlet
+        waits for the result while the others keep running.
+        """
+        return get_hub().threadpool.apply(func, args)
+
+    def spawn_handler(self, func, *args):
+        """ Spawns a call handler, blocks the read loop (and so the
+        peer by TCP backpressure) while maxHandlers or the server
+        wide limit is reached.
+        """
+        handlers = self.handlers
+        limit = self.handlerLimit
+
+        if handlers.full() or (limit is not None and limit.locked()):
+            self.readStalls += 1
+
+        handlers.wait_available()
+
+        if limit is None:
+            return handlers.spawn(func, *args)
+
+        limit.acquire()
+        greenlet = handlers.spawn(func, *args)
+        greenlet.link(lambda g: limit.release())
+
+        return greenlet
+
+    def handler_stats(self):
+        """ Returns the handler limit, the running handlers, how often
+        reading stalled because of the limits and the write queue depth.
+        """
+        return {'limit': self.maxHandlers,
+                'active': len(self.handlers),
+                'stalls': self.readStalls,
+                'write_queue': self.writeQueue.qsize(),
+               }
+
+    def flow_stats(self):
+        """ Returns the usage of the call window, how often callers
+        had to wait for it and how many calls got rejected.
+        """
+        return {'inflight': len(self.calls),
+                'max_inflight': self.maxInflight,
+                'write_bytes': self.writeBytes,
+                'max_write_bytes': self.maxWriteBytes,
+                'stalls': self.callStalls,
+                'rejected': self.callsRejected,
+               }
+
+    def stats(self):
+        """ Returns the metrics of this connection (see
+        socketrpc.Metrics.snapshot) with its pending calls
+        and the depth of the write queue.
+        """
+        stats = self.metrics.snapshot()
+        stats['pending'] = len(self.calls)
+        stats['write_queue'] = self.writeQueue.qsize()
+        stats['write_bytes'] = self.writeBytes
+        if self._shmSend is not None:
+            stats['shared_memory'] = self._shmSend.stats()
+
+        return stats
+
+    def docall_stats(self):
+        """ Returns stats(), with the metrics of all connections as
+        "total" if the server keeps them (SocketRPCServer.metrics).
+        """
+        stats = self.stats()
+
+        metrics = getattr(self.factory, 'metrics', None)
+        if callable(metrics):
+            stats['total'] = metrics().snapshot()
+
+        return stats
+
+    def call_stats(self):
+        """ Returns the number of pending calls, of calls which
+        timed out or got cancelled, replies which came after that and
+        the peer's calls skipped because it had given up on them.
+        """
+        return {'pending': len(self.calls),
+                'expired': self.callsExpired,
+                'cancelled': self.callsCancelled,
+                'late': self.lateReplies,
+                'skipped': self.callsSkipped,
+               }
+
+    def write_stats(self):
+        """ Returns the write coalescing counters, "average" is the
+        mean number of frames per send.
+        """
+        batches = self.writeBatches
+        return {'batches': batches,
+                'frames': self.writeFrames,
+                'average': batches and float(self.writeFrames) / batches or 0.0,
+               }
+
     def connection_made(self):
         self.logger.info('New connection from %s:%s' % self.address)
 
     def connection_lost(self):
         self.logger.info('Lost connection from %s:%s' % self.address)
 
-    def dispatch_call(self, method, id, args, kwargs):
-        if not self.allow_dotted_attributes:
-            method = method.replace('.', '')
+    def dispatch_call(self, method, id, args, kwargs, deadline=None):
+        if deadline is not None and time.time() >= deadline:
+            # The caller has given up on it already
+            self._streams.pop(id, None)
+            self.callsSkipped += 1
+            return
 
-        cmd = 'docall_%s' % method
+        code, result, id = self._execute_call(method, id, args, kwargs)
+        if self._streams.pop(id, False) is not None:
+            # Cancelled meanwhile, the caller drops the reply
+            if self.connected.is_set():
+                self.callsSkipped += 1
+            return
 
+        if code == STATUS_OK and is_stream(result):
+            self.send_stream(result, id, deadline)
+        elif code == STATUS_OK:
+            entry = self.find_method(method)
+            self.send_response(code, result, id, entry is not None and entry[2])
+        else:
+            self.send_response(code, result, id)
+
+    def _execute_call(self, method, id, args, kwargs):
+        """ Runs the docall_ method and returns the
+        reply as [status, result, id].
+        """
         if self.debug:
             self.logger.debug('exec CALL %s (%d)' % (method, id))
 
-        try:
-            func = getattr(self, cmd)
-        except AttributeError, e:
+        entry = self.find_method(method)
+        if entry is None:
             self.logger.error('Unknown CALL method %s (%d)' % (method, id))
+            self.metrics.observe('server', '<unknown>', 0.0, True)
 
-            self.send_response(METHOD_NOT_FOUND, 'Method "%s" not found (%d)' % (method, id))
-            return
+            return [METHOD_NOT_FOUND, 'Method "%s" not found (%d)' % (method, id), id]
 
+        func = entry[0]
+
+        start = time.time()
         try:
-            result = func(*args, **kwargs)
-            self.send_response(result=result, id=id)
+            reply = [STATUS_OK, func(*args, **kwargs), id]
         except Fault, e:
-            self.send_response(e.faultCode, e.faultString, id)
+            reply = [e.faultCode, e.faultString, id]
+        except Exception, e:
+            reply = [APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e)), id]
+
+        self.metrics.observe('server', self.method_name(method), time.time() - start, reply[0] != STATUS_OK)
+
+        return reply
+
+    def find_method(self, method):
+        """ Returns the (<bound method>, <inline>, <offload>) entry for a
+        method name or interned id, None if there is none.
+        """
+        if isinstance(method, (int, long)):
+            if 0 <= method < len(self._methods):
+                return self._methods[method]
+
+            return None
+
+        entry = self._dispatch.get(method)
+        if entry is None and not self.allow_dotted_attributes:
+            entry = self._dispatch.get(method.replace('.', ''))
+
+        return entry
+
+    def method_name(self, method):
+        """ Returns the name of a method we have, called
+        by name or interned id.
+        """
+        if isinstance(method, (int, long)):
+            return self._methodNames[method]
+
+        return method
+
+    def dispatch_batch(self, entries, received=None):
+        """ Dispatches every transaction of a batch, each call runs in a
+        handler of its own (see spawn_handler, the reader waits for free
+        ones) and they get answered with a single batch reply.
+        """
+        calls = []
+        for entry in entries:
+            transaction, obj = entry.iteritems().next()
+
+            if transaction == 'call':
+                handler = self.spawn_handler(self._execute_batched, obj[0], obj[3], obj[1], obj[2],
+                                             call_deadline(obj, received))
+                calls.append((obj[3], handler))
+            elif transaction == 'reply':
+                self.dispatch_reply(obj[0], obj[1], obj[2])
+            else:
+                self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Unknown batch transaction: %s' % transaction))
+
+        if calls:
+            spawn(self._send_batch_replies, calls)
+
+    def _execute_batched(self, method, id, args, kwargs, deadline):
+        """ Runs a call of a batch, returns None if it
+        expired while waiting for a handler.
+        """
+        if deadline is not None and time.time() >= deadline:
+            self.callsSkipped += 1
+            return None
+
+        try:
+            return self._execute_call(method, id, args, kwargs)
         except Exception, e:
-            self.send_response(APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e)), id)
+            # Logged here, the greenlet would print the traceback else
+            self.logger.exception(e)
+            return [APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e)), id]
+
+    def _send_batch_replies(self, calls):
+        """ Waits for the handlers of a batch, calls [(<id>, <greenlet>), ...],
+        and sends their replies.
+        """
+        joinall([call for id, call in calls])
+
+        replies = []
+        for id, call in calls:
+            if not call.successful():
+                # Killed
+                e = call.exception
+                replies.append({'reply': [APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e)), id]})
+                continue
+
+            reply = call.value
+            if reply is None:
+                continue
+
+            if reply[0] == STATUS_OK and is_stream(reply[1]):
+                # No streaming inside batches
+                try:
+                    reply[1] = list(reply[1])
+                except Exception, e:
+                    reply[:2] = [APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e))]
+
+            replies.append({'reply': reply})
+
+        if replies:
+            self.send_batch(replies)
 
     def dispatch_reply(self, status, result, id):
         if self.debug:
             self.logger.debug('recv REPLY (%d)' % id)
 
+        self.metrics.call_finished(id, status < STATUS_OK)
+
         try:
             if status >= STATUS_OK:
                 self.calls[id].set(result)
@@ -193,7 +964,101 @@ class SocketRPCProtocol:
                 self.calls[id].set_exception(Fault(status, result))
                 del self.calls[id]
         except KeyError:
-            self.fault_received(Fault(APPLICATION_ERROR, 'Unknown result: %d' % id))
+            self.unknown_reply(id, 'result')
+            return
+
+        self.release_window()
+
+    def dispatch_stream(self, id, chunk):
+        try:
+            result = self.calls[id]
+        except KeyError:
+            self.unknown_reply(id, 'stream')
+            return
+
+        if isinstance(result, StreamQueue):
+            # Credit follows when the chunk gets consumed
+            result.put_chunk(chunk)
+        else:
+            self._chunks.setdefault(id, []).append(chunk)
+            self.stream_consumed(id)
+
+    def unknown_reply(self, id, kind):
+        """ Counts replies to our expired or cancelled calls, any
+        other unknown id is a fault.
+        """
+        if 0 < id <= self.id:
+            self.lateReplies += 1
+            if self.debug:
+                self.logger.debug('late %s (%d)' % (kind, id))
+        else:
+            self.fault_received(Fault(APPLICATION_ERROR, 'Unknown %s: %d' % (kind, id)))
+
+    def dispatch_stream_end(self, status, result, id):
+        self._consumed.pop(id, None)
+
+        chunks = self._chunks.pop(id, None)
+        if status >= STATUS_OK and chunks is not None:
+            result = chunks
+
+        self.dispatch_reply(status, result, id)
+
+    def dispatch_stream_credit(self, id, count):
+        if id not in self._streams:
+            # Finished already
+            return
+
+        credit = self._streams[id]
+        if count == STREAM_CANCEL:
+            # The receiver gave up on it, dispatch_call
+            # and send_stream see it gone
+            del self._streams[id]
+            if credit is not None:
+                credit.release()
+            return
+
+        if credit is None:
+            return
+
+        for i in xrange(count):
+            credit.release()
+
+    def stream_consumed(self, id, count=1):
+        """ Grants the sender of stream id new credit, batched to
+        every half streamWindow chunks.
+        """
+        if id not in self.calls:
+            # Already finished
+            return
+
+        consumed = self._consumed.get(id, 0) + count
+        if consumed < max(self.streamWindow // 2, 1):
+            self._consumed[id] = consumed
+            return
+
+        self._consumed[id] = 0
+
+        data = self.encode_message('stream_credit', [id, consumed])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def send_stream_cancel(self, id):
+        """ Tells the peer to stop streaming the reply of our call id,
+        it would wait for credit forever else. Calls without a
+        streamed reply ignore it.
+        """
+        if not self.connected.is_set():
+            return
+
+        data = self.encode_message('stream_credit', [id, STREAM_CANCEL])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
 
     def fault_received(self, fault):
         """ Gets called whenever we receive a fault
@@ -201,25 +1066,121 @@ class SocketRPCProtocol:
         """
         self.logger.exception(fault)
 
-    def send_response(self, code=STATUS_OK, result='', id=None):
+    def send_response(self, code=STATUS_OK, result='', id=None, offload=False):
         if self.debug:
             self.logger.debug('send REPLY (%d)' % id)
 
-        data = encode({'reply': [code,
-                                result,
-                                id,
-                      ]})
+        if offload:
+            options = (self._sendVersion, self._sendSerializer, self._compress)
+            frame = self.offload(self.encode_frame, 'reply', [code, result, id])
+            if options != (self._sendVersion, self._sendSerializer, self._compress):
+                # The handshake switched the options meanwhile
+                frame = self.encode_frame('reply', [code, result, id])
+        else:
+            frame = self.encode_frame('reply', [code, result, id])
+
+        if isinstance(frame, Fault):
+            self.fault_received(frame)
+            return
+
+        self.queue_frame(frame)
 
-        self.writeQueue.put(data)
+    def send_stream(self, iterator, id, deadline=None):
+        """ Sends every item of iterator as a "stream" chunk, waits for
+        credit from the receiver after streamWindow chunks in flight and
+        finishes with a "stream_end". Stops at the caller's deadline
+        or once the caller cancels it.
+        """
+        if self.debug:
+            self.logger.debug('send STREAM (%d)' % id)
+
+        credit = self._streams[id] = Semaphore(self.streamWindow)
+        try:
+            try:
+                for chunk in iterator:
+                    if deadline is None:
+                        credit.acquire()
+                    elif not credit.acquire(timeout=max(deadline - time.time(), 0)):
+                        # The caller has given up, it grants no more credit
+                        self.callsSkipped += 1
+                        return
+
+                    if self._streams.get(id) is not credit:
+                        # Connection lost or cancelled
+                        return
+
+                    data = self.encode_message('stream', [id, chunk])
+                    if isinstance(data, Fault):
+                        self.send_stream_end(data.faultCode, data.faultString, id)
+                        return
+
+                    self.send_frame(data)
+            except Fault, e:
+                self.send_stream_end(e.faultCode, e.faultString, id)
+            except Exception, e:
+                self.send_stream_end(APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e)), id)
+            else:
+                self.send_stream_end(STATUS_OK, None, id)
+        finally:
+            if self._streams.get(id) is credit:
+                del self._streams[id]
+
+    def send_stream_end(self, code=STATUS_OK, result=None, id=None):
+        data = self.encode_message('stream_end', [code, result, id])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def send_batch(self, replies):
+        if self.debug:
+            self.logger.debug('send BATCH REPLY (%d)' % len(replies))
+
+        data = self.encode_message('batch', replies)
+        if isinstance(data, Fault):
+            # Answer the replies which don't encode with an error
+            # of their own, the others still get their result
+            replies = [self.encodable_reply(entry) for entry in replies]
+            data = self.encode_message('batch', replies)
+
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def encodable_reply(self, entry):
+        """ Returns the batch entry {"reply": [<status>, <result>, <id>]}
+        or an APPLICATION_ERROR reply for its id if it doesn't encode.
+        """
+        reply = entry['reply']
+        data = self.encode_message('reply', reply)
+        if isinstance(data, Fault):
+            return {'reply': [APPLICATION_ERROR, 'Unserializable reply: %s' % data.faultString, reply[2]]}
+
+        return entry
 
     def call(self, method, *args, **kwargs):
+        return self.call_timeout(self.callTimeout, method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        """ Like call, the result fails with a TIMEOUT_ERROR Fault
+        if there is no reply within timeout seconds (None waits forever).
+        """
         self.connected.wait()
 
+        fault = self.acquire_window()
+        if fault is not None:
+            finished = CallResult(self, None)
+            finished.set_exception(fault)
+            return finished
+
         self.id += 1
-        data = encode({'call': [method, args, kwargs, self.id]})
+        data = self.encode_message('call', self._call_obj(method, args, kwargs, self.id, timeout))
 
+        finished = CallResult(self, self.id)
         if isinstance(data, Fault):
-            finished = AsyncResult()
             finished.set(data)
 
             return finished
@@ -227,31 +1188,669 @@ class SocketRPCProtocol:
         if self.debug:
             self.logger.debug('send CALL (%d) %s' % (self.id, method))
 
-        self.writeQueue.put(data)
+        self.send_frame(data)
 
-        finished = AsyncResult()
         self.calls[self.id] = finished
+        self.track_deadline(self.id, timeout)
+        self.metrics.call_sent(self.id, method)
 
         return finished
 
+    def call_stream(self, method, *args, **kwargs):
+        """ Like call but returns a StreamResult, an iterator over the
+        chunks of a streamed reply. The sender gets credit for more chunks
+        as they are consumed, so memory stays bounded by streamWindow.
+        """
+        self.connected.wait()
+
+        fault = self.acquire_window()
+        if fault is not None:
+            finished = StreamResult(self, None)
+            finished.set_exception(fault)
+            return finished
+
+        self.id += 1
+        data = self.encode_message('call', self._call_obj(method, args, kwargs, self.id, self.callTimeout))
+
+        finished = StreamResult(self, self.id)
+        if isinstance(data, Fault):
+            finished.set_exception(data)
+            return finished
+
+        if self.debug:
+            self.logger.debug('send CALL (%d) %s (stream)' % (self.id, method))
+
+        self.send_frame(data)
+        self.calls[self.id] = finished.queue
+        self.track_deadline(self.id, self.callTimeout)
+        self.metrics.call_sent(self.id, method)
+
+        return finished
+
+    def call_many(self, calls, timeout=None):
+        """ Sends calls, a list of (method, args[, kwargs]) tuples,
+        in a single "batch" transaction, timeout defaults to callTimeout.
+
+        Returns a list with one CallResult per call, each call
+        succeeds or fails on its own.
+        """
+        self.connected.wait()
+
+        if timeout is None:
+            timeout = self.callTimeout
+
+        fault = self.acquire_window(len(calls))
+        if fault is not None:
+            results = []
+            for call in calls:
+                finished = CallResult(self, None)
+                finished.set_exception(fault)
+                results.append(finished)
+
+            return results
+
+        entries = []
+        for call in calls:
+            self.id += 1
+            kwargs = len(call) > 2 and call[2] or {}
+            entries.append({'call': self._call_obj(call[0], call[1], kwargs, self.id, timeout)})
+
+        data = self.encode_message('batch', entries)
+
+        results = []
+        if isinstance(data, Fault):
+            for entry in entries:
+                finished = CallResult(self, entry['call'][3])
+                finished.set(data)
+                results.append(finished)
+
+            return results
+
+        if self.debug:
+            self.logger.debug('send BATCH (%d calls)' % len(entries))
+
+        self.send_frame(data)
+
+        for call, entry in zip(calls, entries):
+            id = entry['call'][3]
+            finished = CallResult(self, id)
+            self.calls[id] = finished
+            self.track_deadline(id, timeout)
+            self.metrics.call_sent(id, call[0])
+            results.append(finished)
+
+        return results
+
+    def _call_obj(self, method, args, kwargs, id, timeout):
+        """ Returns the "call" transaction obj, with the
+        timeout appended for the peer.
+        """
+        obj = [self._methodIds.get(method, method), args, kwargs, id]
+        if timeout is not None:
+            obj.append(timeout)
+
+        return obj
+
+    def track_deadline(self, id, timeout):
+        """ Expires call id after timeout seconds.
+        """
+        if timeout is None:
+            return
+
+        deadline = time.time() + timeout
+
+        deadlines = self._deadlines
+        if len(deadlines) > 2 * len(self.calls) + 64:
+            # Mostly calls which finished in time
+            deadlines.compact(self.calls)
+
+        if deadlines.push(deadline, id):
+            self._schedule_timer(deadline)
+
+    def _schedule_timer(self, deadline):
+        timer = self._timer
+        if timer is not None:
+            if self._timerAt <= deadline:
+                return
+
+            timer.kill(block=False)
+
+        self._timerAt = deadline
+        self._timer = spawn_later(max(deadline - time.time(), 0), self._expire_calls)
+
+    def _expire_calls(self):
+        """ Fails the calls whose deadline has passed,
+        runs in the per connection timer.
+        """
+        self._timer = None
+
+        now = time.time()
+        for id in self._deadlines.expired(now):
+            finished = self.calls.pop(id, None)
+            if finished is not None:
+                self.callsExpired += 1
+                self.metrics.call_finished(id, True)
+                self._chunks.pop(id, None)
+                self._consumed.pop(id, None)
+                finished.set_exception(Fault(TIMEOUT_ERROR, 'Call %d timed out.' % id))
+
+        self.release_window()
+
+        earliest = self._deadlines.earliest()
+        if earliest is not None:
+            # Don't wake up for every single deadline
+            self._schedule_timer(max(earliest, now + 0.01))
+
+    def cancel(self, id):
+        """ Cancels our pending call id, its result fails with a
+        CANCELLED_ERROR Fault. Returns False if it had finished.
+        """
+        finished = self.calls.pop(id, None)
+        if finished is None:
+            return False
+
+        self.callsCancelled += 1
+        self.metrics.call_finished(id, True)
+        self._chunks.pop(id, None)
+        self._consumed.pop(id, None)
+        self.send_stream_cancel(id)
+        finished.set_exception(Fault(CANCELLED_ERROR, 'Call %d cancelled.' % id))
+        self.release_window()
+
+        return True
+
+
+class CallResult(AsyncResult):
+    """ The AsyncResult of a call, knows its id.
+    """
+
+    def __init__(self, protocol, id):
+        AsyncResult.__init__(self)
+        self.protocol = protocol
+        self.id = id
+
+    def cancel(self):
+        """ @see: SocketRPCProtocol.cancel
+        """
+        return self.protocol.cancel(self.id)
+
+
+class CachedResult(AsyncResult):
+    """ The AsyncResult of a call through a ResultCache, a hit or one
+    of the callers of a request shared by concurrent misses. Cancelling
+    fails just this one, the request gets cancelled once none of its
+    callers waits for it.
+    """
+
+    def __init__(self, request=None):
+        AsyncResult.__init__(self)
+        self.request = request
+        self.id = None
+        if request is not None:
+            self.id = request.id
+            request.callers.append(self)
+            request.rawlink(self._settle)
+
+    def _settle(self, request):
+        if self.ready():
+            return
+
+        if request.successful():
+            self.set(request.value)
+        else:
+            self.set_exception(request.exception)
+
+    def cancel(self):
+        """ @see: SocketRPCProtocol.cancel
+        """
+        if self.ready():
+            return False
+
+        self.set_exception(Fault(CANCELLED_ERROR, 'Call %s cancelled.' % self.id))
+        if not [caller for caller in self.request.callers if not caller.ready()]:
+            self.request.cancel()
+
+        return True
+
+
+class StreamQueue(Queue):
+    """ The chunks of a streamed reply, the pending call of a
+    StreamResult. Items are (True, <chunk>) or (False, <the end>).
+    """
+
+    def put_chunk(self, chunk):
+        self.put((True, chunk))
+
+    def set(self, result=None):
+        """ Ends the stream, a plain reply gets
+        returned as a stream of its items.
+        """
+        if result is not None:
+            if not isinstance(result, (list, tuple)):
+                result = [result]
+
+            for chunk in result:
+                self.put((True, chunk))
+
+        self.put((False, None))
+
+    def set_exception(self, exception):
+        self.put((False, exception))
+
+
+class StreamResult(object):
+    """ Iterator over the chunks of a streamed reply,
+    raises the Fault if the call failed.
+
+    The protocol only knows its queue, a StreamResult dropped
+    (or closed) before the end cancels the call, so the sender
+    stops streaming.
+    """
+
+    def __init__(self, protocol, id):
+        self.protocol = protocol
+        self.id = id
+        self.queue = StreamQueue()
+
+    def put(self, chunk):
+        self.queue.put_chunk(chunk)
+
+    def set(self, result=None):
+        self.queue.set(result)
+
+    def set_exception(self, exception):
+        self.queue.set_exception(exception)
+
+    def cancel(self):
+        """ @see: SocketRPCProtocol.cancel
+        """
+        if self.protocol is None:
+            return False
+
+        return self.protocol.cancel(self.id)
+
+    def close(self):
+        """ Cancels the call unless the stream has ended.
+        """
+        if self.protocol is not None and self.protocol.calls.get(self.id) is self.queue:
+            self.protocol.cancel(self.id)
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        ok, value = self.queue.get()
+        if not ok:
+            # Keep the end for further calls
+            self.queue.put((ok, value))
+            if value is None:
+                raise StopIteration
+            raise value
+
+        self.protocol.stream_consumed(self.id)
+        return value
+
 
 class SocketRPCServer(StreamServer):
-    def __init__(self, listener, protocol, backlog=None, spawn='default'):
+    def __init__(self, listener, protocol, backlog=None, spawn='default', max_handlers=None):
+        if unix_path(listener) is not None:
+            listener = _listen_socket(listener, backlog)
+            backlog = None
+
         StreamServer.__init__(self, listener, backlog=backlog, spawn=spawn)
         self.protocol = protocol
 
+        # Concurrent call handlers over all connections
+        self.max_handlers = max_handlers
+        self.handlerLimit = None
+        if max_handlers is not None:
+            self.handlerLimit = BoundedSemaphore(max_handlers)
+
+        # Connection counters
+        self.connections = 0
+        self.active_connections = 0
+
+        # Protocols of the open connections and the
+        # summed up metrics of the closed ones
+        self.protocols = set()
+        self.closedMetrics = Metrics()
+
     def handle(self, socket, address):
         """ Start the socket handlers
             self.protocol.handle_write and
             self.protocol.handle_read.
         """
         protocol = self.protocol()
+        if not isinstance(address, tuple):
+            # Unix socket
+            address = peer_address(socket)
+
+        self.connections += 1
+        self.active_connections += 1
+        self.protocols.add(protocol)
+        try:
+            protocol.make_connection(socket, address, self)
+            # XXX: Is this greenlet independent from handle?
+            spawn(protocol.handle_write)
 
-        protocol.make_connection(socket, address, self)
-        # XXX: Is this greenlet independent from handle?
-        spawn(protocol.handle_write)
+            protocol.handle_read()
+        finally:
+            self.active_connections -= 1
+            self.protocols.discard(protocol)
+            self.closedMetrics.merge(protocol.metrics)
+
+    def metrics(self):
+        """ Returns the Metrics summed up over all connections.
+        """
+        metrics = Metrics()
+        metrics.merge(self.closedMetrics)
+        for protocol in self.protocols:
+            metrics.merge(protocol.metrics)
+
+        return metrics
 
-        protocol.handle_read()
+    def stats(self):
+        stats = {'connections': self.connections,
+                 'active_connections': self.active_connections,
+                 'handler_limit': self.max_handlers,
+                }
+        if self.handlerLimit is not None:
+            stats['active_handlers'] = self.max_handlers - self.handlerLimit.counter
+
+        return stats
+
+
+def _listen_socket(address, backlog=None, reuse_port=False):
+    """ Returns a bound and listening gevent socket for address,
+    a stale Unix socket file of a previous server gets replaced.
+    """
+    path = unix_path(address)
+    if path is not None:
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+
+        sock = gsocket(AF_UNIX, SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(backlog or 256)
+        sock.setblocking(0)
+
+        return sock
+
+    family = AF_INET
+    if ':' in address[0]:
+        family = AF_INET6
+
+    sock = gsocket(family, SOCK_STREAM)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(SOL_SOCKET, pysocket.SO_REUSEPORT, 1)
+
+    sock.bind(address)
+    sock.listen(backlog or 256)
+    sock.setblocking(0)
+
+    return sock
+
+
+class SocketRPCPreforkServer(object):
+    """ Runs "workers" processes, each with its own SocketRPCServer
+    for protocol on the same address.
+
+    The workers bind their own socket with SO_REUSEPORT, so the kernel
+    balances new connections between them. Without SO_REUSEPORT they
+    share a socket bound by the supervisor.
+
+    The supervisor restarts crashed workers and collects their stats,
+    see worker_stats(). Call serve_forever from the main greenlet,
+    the workers get forked from it.
+    """
+
+    server = SocketRPCServer
+
+    """ Seconds between two stats reports of a worker
+    """
+    statsInterval = 5.0
+
+    """ Seconds to wait before a crashed worker gets restarted
+    """
+    restartDelay = 1.0
+
+    def __init__(self, listener, protocol, workers=None, backlog=None, reuse_port=None, max_handlers=None):
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+
+        if reuse_port is None:
+            # Unix sockets can't be shared with SO_REUSEPORT
+            reuse_port = hasattr(pysocket, 'SO_REUSEPORT') and unix_path(listener) is None
+
+        self.listener = listener
+        self.protocol = protocol
+        self.workers = workers
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.max_handlers = max_handlers
+
+        self.socket = None
+        self.running = False
+
+        # pid -> worker number
+        self.pids = {}
+        # worker number -> stats dict
+        self.stats = {}
+        # worker number -> stats pipe read end
+        self._pipes = {}
+        self._partial = {}
+        # worker number -> time its restart is due
+        self._restarts = {}
+
+    def serve_forever(self):
+        if not self.reuse_port:
+            self.socket = _listen_socket(self.listener, self.backlog)
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self._signal_stop)
+        signal.signal(signal.SIGINT, self._signal_stop)
+
+        for number in xrange(self.workers):
+            self.stats[number] = {'restarts': 0}
+            self._start_worker(number)
+
+        try:
+            while self.running:
+                self._reap()
+                self._restart_due()
+                self._read_stats()
+                sleep(0.2)
+        finally:
+            self.stop()
+
+    def _signal_stop(self, signum, frame):
+        self.running = False
+
+    def stop(self):
+        """ Stops all workers and waits for them.
+        """
+        self.running = False
+        self._restarts = {}
+
+        for pid in self.pids.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        for pid in self.pids.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        self.pids = {}
+
+    def _start_worker(self, number):
+        rfd, wfd = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            # Worker
+            os.close(rfd)
+            code = 0
+            try:
+                try:
+                    self._run_worker(number, wfd)
+                except:
+                    logging.exception('Worker %d failed' % number)
+                    code = 1
+            finally:
+                os._exit(code)
+
+        os.close(wfd)
+        fcntl.fcntl(rfd, fcntl.F_SETFL, fcntl.fcntl(rfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        old = self._pipes.pop(number, None)
+        if old is not None:
+            os.close(old)
+        self._pipes[number] = rfd
+        self._partial[number] = ''
+
+        self.pids[pid] = number
+        self.stats[number].update({'pid': pid, 'started': time.time()})
+
+    def _run_worker(self, number, wfd):
+        reinit()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        self.pids = {}
+        self._restarts = {}
+        for fd in self._pipes.values():
+            os.close(fd)
+        self._pipes = {}
+
+        listener = self.socket
+        if listener is None:
+            listener = _listen_socket(self.listener, self.backlog, reuse_port=True)
+
+        server = self.server(listener, self.protocol, max_handlers=self.max_handlers)
+
+        # A supervisor which doesn't keep up blocks
+        # the reporting greenlet, not the worker
+        make_nonblocking(wfd)
+
+        def report():
+            while True:
+                stats = server.stats()
+                stats['worker'] = number
+
+                data = json.dumps(stats) + '\n'
+                while data:
+                    data = data[nb_write(wfd, data):]
+
+                sleep(self.statsInterval)
+
+        spawn(report)
+        server.serve_forever()
+
+    def _reap(self):
+        """ Schedules the restart of workers which exited while running.
+        """
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+
+            if pid == 0:
+                return
+
+            number = self.pids.pop(pid, None)
+            if number is None:
+                continue
+
+            logging.error('Worker %d (pid %d) exited with status %d' % (number, pid, status))
+            if self.running:
+                self._restarts[number] = time.time() + self.restartDelay
+
+    def _restart_due(self):
+        """ Restarts the workers whose restartDelay has passed, from the
+        main greenlet (like the first start) so the fork doesn't carry
+        the supervisor's loop into the worker.
+        """
+        now = time.time()
+        for number, due in self._restarts.items():
+            if due <= now:
+                del self._restarts[number]
+                self.stats[number]['restarts'] += 1
+                self._start_worker(number)
+
+    def _read_stats(self):
+        for number, fd in self._pipes.items():
+            try:
+                data = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+
+            lines = (self._partial[number] + data).split('\n')
+            self._partial[number] = lines.pop()
+            for line in lines:
+                self.stats[number].update(json.loads(line))
+
+    def worker_stats(self):
+        """ Returns a dict of worker number -> stats, the last report of
+        each worker plus its pid, start time and number of restarts.
+        """
+        return self.stats
+
+
+def _connect_socket(address, timeout=None, source_address=None):
+    """ Returns a gevent socket connected to address,
+    create_connection for (<host>, <port>) tuples.
+    """
+    path = unix_path(address)
+    if path is None:
+        return create_connection(address, timeout, source_address)
+
+    sock = gsocket(AF_UNIX, SOCK_STREAM)
+    if timeout is not None:
+        sock.settimeout(timeout)
+
+    try:
+        sock.connect(path)
+    except:
+        sock.close()
+        raise
+
+    return sock
+
+def socketpair():
+    """ Returns two connected Unix sockets, create them before forking
+    and pass one to connect_socket in the parent, the other one in the
+    child (after gevent.reinit()). Either side can call the other.
+    """
+    return gsocketpair(AF_UNIX, SOCK_STREAM)
+
+def connect_socket(sock, protocol, factory=None):
+    """ Runs a new protocol on the connected socket sock (see
+    socketpair) and returns it, there is no reconnecting.
+    """
+    proto = protocol()
+    proto.make_connection(sock, peer_address(sock), factory)
+
+    spawn(proto.handle_read)
+    spawn(proto.handle_write)
+
+    return proto
 
 
 class SocketRPCClient(object):
@@ -276,20 +1875,34 @@ class SocketRPCClient(object):
     isTrying = False
     ## END Reconnecting
 
-    def __init__(self, address, protocol, timeout=None, source_address=None, reconnect=False):
+    def __init__(self, address, protocol, timeout=None, source_address=None, reconnect=False, cache=None,
+                 default_timeout=None):
         self.sock_args = [address, timeout, source_address]
+        # (<host>, <port>) or ("unix", <path>) for logging
+        self.target = address_tuple(address)
 
         proto = self.protocol = protocol()
         if not isinstance(proto, SocketRPCProtocol):
             raise AttributeError('protocol must implement "SocketRPCProtocol"')
 
+        if default_timeout is not None:
+            proto.callTimeout = default_timeout
+
         self.continueTrying = reconnect
 
         # Do monkey patching, TODO: ugly but working.
         # methods
         proto.connection_made = self.connection_made
         proto.connection_lost = self.connection_lost
-        self.call = proto.call
+        self.call_many = proto.call_many
+        self.call_stream = proto.call_stream
+        self.call_timeout = proto.call_timeout
+        self.cancel = proto.cancel
+
+        # A socketrpc.ResultCache for call
+        self.cache = cache
+        if cache is None:
+            self.call = proto.call
 
         # args
         self.connected = proto.connected
@@ -298,12 +1911,46 @@ class SocketRPCClient(object):
         # Start connecting
         self.connect()
 
+    def call(self, method, *args, **kwargs):
+        """ call through self.cache, concurrent misses
+        for the same key share one request.
+        """
+        cache = self.cache
+        if cache.ttl(method) is None:
+            return self.protocol.call(method, *args, **kwargs)
+
+        key = cache.key(method, args, kwargs)
+        found, value = cache.get(key)
+        if found:
+            finished = CachedResult()
+            finished.set(value)
+            return finished
+
+        request = cache.pending.get(key)
+        if request is not None:
+            cache.joined += 1
+            return CachedResult(request)
+
+        request = cache.pending[key] = self.protocol.call(method, *args, **kwargs)
+        request.callers = []
+
+        def done(request):
+            if cache.pending.get(key) is request:
+                del cache.pending[key]
+
+            if request.successful() and not isinstance(request.value, Fault):
+                cache.set(key, method, request.value)
+
+        finished = CachedResult(request)
+        request.rawlink(done)
+        return finished
+
     def connect(self):
         # Protocol specific
         try:
-            self.socket = create_connection(*self.sock_args)
+            self.socket = _connect_socket(*self.sock_args)
 
-            self.address = self.socket.getpeername()
+            self.address = peer_address(self.socket)
 
             self.protocol.make_connection(self.socket, self.address, self)
 
@@ -312,8 +1959,21 @@ class SocketRPCClient(object):
         except pysocket_error, e:
             self.connection_failed(e)
 
+    def close(self):
+        """ Stops reconnecting and closes the connection.
+        """
+        self.continueTrying = False
+
+        # The peer closes in turn, then the reader sees EOF and runs connection_lost
+        socket = getattr(self, 'socket', None)
+        if socket is not None:
+            try:
+                socket.shutdown(SHUT_WR)
+            except pysocket_error:
+                pass
+
     def connection_failed(self, reason):
-        logging.error('Connection to %s:%s failed: %s' % (self.sock_args[0][0], self.sock_args[0][1], reason))
+        logging.error('Connection to %s:%s failed: %s' % (self.target[0], self.target[1], reason))
 
         if self.continueTrying and not self.isTrying:
             self._retry()
@@ -336,18 +1996,18 @@ class SocketRPCClient(object):
             self.retries = 0
 
             if self.debug:
-                logging.debug("Successfully reconnected to %s:%s" % self.sock_args[0])
+                logging.debug("Successfully reconnected to %s:%s" % self.target)
             return
 
         if not self.continueTrying:
             if self.debug:
-                logging.debug("Abandoning connecting to %s:%s on explicit request" % self.sock_args[0])
+                logging.debug("Abandoning connecting to %s:%s on explicit request" % self.target)
             return
 
         self.retries += 1
         if self.maxRetries is not None and (self.retries > self.maxRetries):
             if self.debug:
-                logging.debug("Abandoning %s:%s after %d retries." % (self.sock_args[0][0], self.sock_args[0][1], self.retries))
+                logging.debug("Abandoning %s:%s after %d retries." % (self.target[0], self.target[1], self.retries))
             return
 
         self.delay = min(self.delay * self.factor, self.maxDelay)
@@ -356,10 +2016,419 @@ class SocketRPCClient(object):
                                               self.delay * self.jitter)
 
         if self.debug:
-            logging.debug("%s:%s will retry in %d seconds" % (self.sock_args[0][0], self.sock_args[0][1], self.delay,))
+            logging.debug("%s:%s will retry in %d seconds" % (self.target[0], self.target[1], self.delay,))
 
         self.connect()
 
         spawn_later(self.delay, self._retry)
 
-__all__ = ['Fault', 'SocketRPCProtocol', 'SocketRPCServer', 'SocketRPCClient', 'set_serializer']
+
+class SocketRPCClientPool(object):
+    """ Keeps between min_size and max_size SocketRPCClients connected
+    to one server.
+
+    Calls go to the connected member with the fewest outstanding calls,
+    members which aren't connected get skipped, they reconnect on their
+    own with the backoff of the "client" class.
+    """
+
+    client = SocketRPCClient
+
+    """ Grow once every connected member
+    has this many outstanding calls
+    """
+    growOutstanding = 64
+
+    """ Seconds between checks for idle members
+    """
+    shrinkInterval = 30.0
+
+    def __init__(self, address, protocol, min_size=1, max_size=4, timeout=None, source_address=None,
+                 default_timeout=None):
+        self.client_args = (address, protocol, timeout, source_address, default_timeout)
+        self.min_size = min_size
+        self.max_size = max_size
+
+        self.members = []
+        self._growing = False
+
+        for i in xrange(min_size):
+            self._grow()
+
+        self._shrinker = spawn_later(self.shrinkInterval, self._shrink)
+
+    def _grow(self):
+        address, protocol, timeout, source_address, default_timeout = self.client_args
+        member = self.client(address, protocol, timeout, source_address, reconnect=True,
+                             default_timeout=default_timeout)
+        self.members.append(member)
+
+        return member
+
+    def _grow_background(self):
+        try:
+            if len(self.members) < self.max_size:
+                self._grow()
+        finally:
+            self._growing = False
+
+    def _shrink(self):
+        """ Closes idle and disconnected members above min_size.
+        """
+        for member in list(self.members):
+            if len(self.members) <= self.min_size:
+                break
+
+            if not member.connected.is_set() or not member.protocol.calls:
+                self.members.remove(member)
+                member.close()
+
+        self._shrinker = spawn_later(self.shrinkInterval, self._shrink)
+
+    def _choose(self):
+        best = None
+        best_outstanding = None
+        for member in self.members:
+            if not member.connected.is_set():
+                continue
+
+            outstanding = len(member.protocol.calls)
+            if best is None or outstanding < best_outstanding:
+                best = member
+                best_outstanding = outstanding
+
+        if (best is None or best_outstanding >= self.growOutstanding) \
+            and not self._growing and len(self.members) < self.max_size:
+            self._growing = True
+            spawn(self._grow_background)
+
+        return best
+
+    def outstanding(self):
+        """ Returns the number of outstanding calls per member,
+        None for members which aren't connected.
+        """
+        result = []
+        for member in self.members:
+            if member.connected.is_set():
+                result.append(len(member.protocol.calls))
+            else:
+                result.append(None)
+
+        return result
+
+    def call(self, method, *args, **kwargs):
+        member = self._choose()
+        if member is None:
+            finished = AsyncResult()
+            finished.set_exception(Fault(TRANSPORT_ERROR, 'Not connected.'))
+            return finished
+
+        return member.call(method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        member = self._choose()
+        if member is None:
+            finished = AsyncResult()
+            finished.set_exception(Fault(TRANSPORT_ERROR, 'Not connected.'))
+            return finished
+
+        return member.call_timeout(timeout, method, *args, **kwargs)
+
+    def call_stream(self, method, *args, **kwargs):
+        member = self._choose()
+        if member is None:
+            finished = StreamResult(None, None)
+            finished.set_exception(Fault(TRANSPORT_ERROR, 'Not connected.'))
+            return finished
+
+        return member.call_stream(method, *args, **kwargs)
+
+    def call_many(self, calls, timeout=None):
+        member = self._choose()
+        if member is None:
+            results = []
+            for call in calls:
+                finished = AsyncResult()
+                finished.set_exception(Fault(TRANSPORT_ERROR, 'Not connected.'))
+                results.append(finished)
+
+            return results
+
+        return member.call_many(calls, timeout)
+
+    def close(self):
+        self._shrinker.kill(block=False)
+
+        for member in self.members:
+            member.close()
+
+        self.members = []
+
+
+class HedgedResult(AsyncResult):
+    """ The AsyncResult of a hedged call, it gets the first reply of
+    its calls ("results"), the others get cancelled. Transport errors
+    and timeouts only count once no other call is left.
+    """
+
+    def __init__(self):
+        AsyncResult.__init__(self)
+        self.results = []
+
+    def cancel(self):
+        """ Cancels the calls, see SocketRPCProtocol.cancel.
+        """
+        cancelled = False
+        for result in self.results:
+            cancel = getattr(result, 'cancel', None)
+            if cancel is not None and not result.ready():
+                cancelled = cancel() or cancelled
+
+        return cancelled
+
+
+class ClusterClient(object):
+    """ Spreads calls over SocketRPCClients to many replicas of a server.
+
+    Calls go to the healthy replica with the fewest outstanding calls
+    (policy="outstanding") or the lowest moving average latency weighted
+    by them (policy="ewma"). A replica which lost its connection or had
+    maxFailures transport errors or timeouts in a row leaves the rotation,
+    it gets probed with probeMethod after the backoff of the "client"
+    class and comes back once a probe succeeds.
+
+    With a socketrpc.HedgePolicy calls of its methods which got no reply
+    within the method's delay get sent to a second replica as well, see
+    HedgedResult.
+    """
+
+    client = SocketRPCClient
+
+    """ Transport errors or timeouts in a row
+    which take a replica out of rotation
+    """
+    maxFailures = 3
+
+    """ Method and timeout of the probe call, every
+    protocol has the built-in "stats"
+    """
+    probeMethod = 'stats'
+    probeTimeout = 5.0
+
+    def __init__(self, addresses, protocol, timeout=None, source_address=None, default_timeout=None,
+                 policy='outstanding', hedge=None):
+        self.replicas = ReplicaSet(policy)
+        self.hedge = hedge
+        self.closed = False
+        self._probes = []
+
+        for address in addresses:
+            member = self.client(address, protocol, timeout, source_address, default_timeout=default_timeout)
+            replica = self.replicas.add(address, member)
+            if not member.connected.is_set():
+                self._down(replica)
+
+    def _outstanding(self, replica):
+        member = replica.client
+        if not member.connected.is_set():
+            self._down(replica)
+            return None
+
+        return len(member.protocol.calls)
+
+    def _choose(self):
+        return self.replicas.choose(self._outstanding)
+
+    def _track(self, replica, finished, method):
+        """ Observes the outcome of finished, a call of method, on replica.
+        """
+        start = time.time()
+
+        def done(finished):
+            code = getattr(finished.exception, 'faultCode', None)
+            if code == CANCELLED_ERROR:
+                return
+
+            if code not in (TRANSPORT_ERROR, TIMEOUT_ERROR):
+                seconds = time.time() - start
+                replica.succeeded(seconds)
+                if self.hedge is not None:
+                    self.hedge.observe(method, seconds)
+            elif replica.failed() >= self.maxFailures or not replica.client.connected.is_set():
+                self._down(replica)
+
+        finished.rawlink(done)
+        return finished
+
+    def _down(self, replica):
+        """ Takes replica out of rotation and schedules its probe.
+        """
+        if not replica.healthy or self.closed:
+            return
+
+        self._schedule(replica)
+
+    def _schedule(self, replica):
+        delay = replica.down(self.client)
+        if delay is None:
+            logging.error('Giving up on %s:%s after %d probes' % (address_tuple(replica.address) + (replica.retries - 1,)))
+            return
+
+        logging.warning('%s:%s out of rotation, probing in %.1f seconds' % (address_tuple(replica.address) + (delay,)))
+        self._probes.append(spawn_later(delay, self._probe, replica))
+
+    def _probe(self, replica):
+        self._probes = [probe for probe in self._probes if not probe.ready()]
+        if self.closed:
+            return
+
+        member = replica.client
+        if not member.connected.is_set():
+            member.connect()
+
+        if member.connected.is_set():
+            try:
+                member.call_timeout(self.probeTimeout, self.probeMethod).get()
+            except Fault, e:
+                if e.faultCode in (TRANSPORT_ERROR, TIMEOUT_ERROR):
+                    self._schedule(replica)
+                    return
+
+            logging.info('%s:%s back in rotation' % address_tuple(replica.address))
+            replica.up()
+            return
+
+        self._schedule(replica)
+
+    def _unavailable(self):
+        finished = AsyncResult()
+        finished.set_exception(Fault(TRANSPORT_ERROR, 'No healthy replica.'))
+        return finished
+
+    def _send(self, replica, timeout, method, args, kwargs):
+        if timeout is None:
+            finished = replica.client.call(method, *args, **kwargs)
+        else:
+            finished = replica.client.call_timeout(timeout, method, *args, **kwargs)
+
+        return self._track(replica, finished, method)
+
+    def _hedged(self, replica, delay, timeout, method, args, kwargs):
+        """ Sends the call to replica, after delay seconds without
+        a reply to a second one as well.
+        """
+        hedge = self.hedge
+        finished = HedgedResult()
+        first = self._send(replica, timeout, method, args, kwargs)
+        finished.results.append(first)
+
+        def settle(result):
+            if finished.ready():
+                return
+
+            fault = result.exception
+            if getattr(fault, 'faultCode', None) in (TRANSPORT_ERROR, TIMEOUT_ERROR, CANCELLED_ERROR) \
+                and [other for other in finished.results if not other.ready()]:
+                # The other call may still get a reply
+                return
+
+            timer.kill(block=False)
+            if result is not first:
+                hedge.won += 1
+
+            if fault is None:
+                finished.set(result.value)
+            else:
+                finished.set_exception(fault)
+
+            for other in finished.results:
+                # Plain AsyncResults (cache hits) can't be cancelled
+                if not other.ready() and hasattr(other, 'cancel'):
+                    other.cancel()
+
+        def send_hedge():
+            if finished.ready():
+                return
+
+            second = self.replicas.choose(self._outstanding, exclude=replica)
+            if second is None or not hedge.allow():
+                return
+
+            result = self._send(second, timeout, method, args, kwargs)
+            finished.results.append(result)
+            result.rawlink(settle)
+
+        timer = spawn_later(delay, send_hedge)
+        first.rawlink(settle)
+
+        return finished
+
+    def call(self, method, *args, **kwargs):
+        return self.call_timeout(None, method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        """ Like call with a timeout (None: the protocol's callTimeout),
+        calls of hedged methods return a HedgedResult.
+        """
+        replica = self._choose()
+        if replica is None:
+            return self._unavailable()
+
+        delay = None
+        if self.hedge is not None:
+            delay = self.hedge.delay(method)
+
+        if delay is None:
+            return self._send(replica, timeout, method, args, kwargs)
+
+        return self._hedged(replica, delay, timeout, method, args, kwargs)
+
+    def call_stream(self, method, *args, **kwargs):
+        replica = self._choose()
+        if replica is None:
+            finished = StreamResult(None, None)
+            finished.set_exception(Fault(TRANSPORT_ERROR, 'No healthy replica.'))
+            return finished
+
+        return replica.client.call_stream(method, *args, **kwargs)
+
+    def call_many(self, calls, timeout=None):
+        replica = self._choose()
+        if replica is None:
+            return [self._unavailable() for call in calls]
+
+        results = replica.client.call_many(calls, timeout)
+        return [self._track(replica, finished, call[0]) for call, finished in zip(calls, results)]
+
+    def outstanding(self):
+        """ Returns the number of outstanding calls per replica,
+        None for replicas which aren't connected.
+        """
+        result = []
+        for replica in self.replicas:
+            member = replica.client
+            if member.connected.is_set():
+                result.append(len(member.protocol.calls))
+            else:
+                result.append(None)
+
+        return result
+
+    def stats(self):
+        """ Returns health, latency average and counters by replica address.
+        """
+        return self.replicas.stats()
+
+    def close(self):
+        self.closed = True
+        for probe in self._probes:
+            probe.kill(block=False)
+
+        self._probes = []
+        for replica in self.replicas:
+            replica.client.close()
+
+
+__all__ = ['Fault', 'rpcmethod', 'SocketRPCProtocol', 'SocketRPCServer', 'SocketRPCPreforkServer', 'SocketRPCClient', 'SocketRPCClientPool', 'ClusterClient', 'CallResult', 'CachedResult', 'HedgedResult', 'StreamResult', 'ResultCache', 'socketpair', 'connect_socket',
+           'set_serializer']
@@ -0,0 +1,732 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+###############################################################################
+#
+# This file is part of socketrpc, the blocking client for
+# threaded processes (no gevent, no reactor).
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+from socketrpc import set_serializer2, Fault, STRUCT_INT, FrameBuffer, tobytes
+from socketrpc import FRAME_COMPRESSED, FRAME_CONTROL, COMPRESSORS, SERIALIZERS, Handshake
+from socketrpc import encode_message, decode_message, DeadlineHeap, Metrics
+from socketrpc import STATUS_OK, NOT_WELLFORMED_ERROR, METHOD_NOT_FOUND, APPLICATION_ERROR, TRANSPORT_ERROR
+from socketrpc import TIMEOUT_ERROR, CANCELLED_ERROR, STREAM_CANCEL, unix_path, address_tuple
+
+import logging
+import socket
+import threading
+import time
+
+
+# For pylint
+def decode(data):
+    pass
+def encode(obj):
+    pass
+documents = False
+serializer_name = None
+
+def set_serializer(predefined=None, encode=None, decode=None, buffers=False, documents=False):
+    """ Sets the serializer for this class.
+    @see: socketrpc.set_serializer2
+    """
+    set_serializer2(predefined, encode, decode, globals(), buffers, documents)
+
+
+def connect_socket(address, timeout=None):
+    """ Returns a socket connected to address, (<host>, <port>)
+    or "unix:<path>".
+    """
+    path = unix_path(address)
+    if path is None:
+        sock = socket.create_connection(address, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+
+    return sock
+
+
+class SyncResult(object):
+    """ Result of a call, get() blocks the calling thread until the
+    reply arrived. Replies get set by the reader thread of the connection.
+    """
+
+    def __init__(self, connection=None, deadline=None):
+        self.connection = connection
+        self.deadline = deadline
+        self.id = None
+        self.value = None
+        self.exception = None
+        self._event = threading.Event()
+
+    def set(self, value=None):
+        self.value = value
+        self._event.set()
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self._event.set()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        return self._event.is_set() and self.exception is None
+
+    def get(self, timeout=None):
+        """ Returns the result or raises its Fault. With timeout the
+        call fails with TIMEOUT_ERROR after that many seconds, if
+        that is earlier than its own deadline.
+        """
+        if timeout is not None and not self._event.is_set():
+            deadline = time.time() + timeout
+            if self.deadline is None or deadline < self.deadline:
+                self.connection.track_deadline(self.id, deadline)
+
+        # The connection's timer fails it at the deadline, a timed
+        # wait would poll on Python 2
+        self._event.wait()
+
+        if self.exception is not None:
+            raise self.exception
+
+        return self.value
+
+    def cancel(self):
+        """ @see: SocketRPCConnection.cancel
+        """
+        if self.connection is None:
+            return False
+
+        return self.connection.cancel(self.id)
+
+
+class SocketRPCConnection(object):
+    """ One socket to the server, shared by many threads.
+
+    Frames get written under a send lock by the calling threads, a
+    reader thread matches the replies to the pending calls by id.
+    The peer's calls get answered with METHOD_NOT_FOUND, this side
+    serves no methods.
+    """
+
+    def __init__(self, client, address):
+        self.client = client
+        # (<host>, <port>) or ("unix", <path>)
+        self.address = address_tuple(address)
+        self.logger = logging.getLogger("%s.%s:%s" % ((self.__class__.__name__,) + self.address))
+
+        try:
+            self.socket = connect_socket(address, client.connectTimeout)
+        except socket.error as e:
+            raise Fault(TRANSPORT_ERROR, 'Connection to %s:%s failed: %s' % (self.address + (e,)))
+
+        self.socket.settimeout(None)
+
+        self.id = 0
+        # {<id>: <SyncResult>}
+        self.calls = {}
+        # Chunks received for streamed replies, {<id>: [<chunk>, ...]}
+        self._chunks = {}
+        # Received chunks not yet granted as credit, {<id>: <count>}
+        self._consumed = {}
+        self.closed = False
+
+        # Guards calls, the counters and metrics
+        self._lock = threading.Lock()
+        # Guards the socket's write side and the send options,
+        # every frame gets encoded and written under it
+        self._sendLock = threading.Lock()
+
+        # Negotiated connection options
+        self._compress = None
+        self._decompress = None
+        self._sendVersion = 1
+        self._recvVersion = 1
+        self._sendSerializer = None
+        self._recvSerializer = None
+        # {<name>: <id>} of the peer's interned methods
+        self._methodIds = {}
+
+        # Calls which timed out, got cancelled and their
+        # replies which came too late
+        self.callsExpired = 0
+        self.callsCancelled = 0
+        self.lateReplies = 0
+
+        self.metrics = Metrics()
+
+        # Deadlines of our pending calls, the timer thread
+        # starts with the first one
+        self._deadlines = DeadlineHeap()
+        self._timer = None
+        self._timerWakeup = threading.Condition(self._lock)
+
+        self.handshake = Handshake(client.hello_offer())
+        hello = self.handshake.hello()
+        if hello is not None:
+            with self._sendLock:
+                self.write_frame(FRAME_CONTROL, hello)
+
+        self._reader = threading.Thread(target=self.read_loop, name='socketrpc reader %s:%s' % self.address)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def pending(self):
+        return len(self.calls)
+
+    def read_loop(self):
+        """ Receives frames until the connection is lost,
+        runs in the reader thread.
+        """
+        frames = FrameBuffer()
+        recv = self.socket.recv
+        size = self.client.recvBufferSize
+        try:
+            while True:
+                data = recv(size)
+                if not data:
+                    break
+
+                for flags, frame in frames.feed(data):
+                    self.frame_received(flags, frame)
+        except socket.error as e:
+            if not self.closed:
+                self.logger.error('Connection lost: %s' % e)
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            self.close()
+
+    def frame_received(self, flags, data):
+        with self._lock:
+            self.metrics.received(1, len(data) + 4)
+
+        if flags & FRAME_CONTROL:
+            self.control_received(data)
+            return
+
+        message = self.decode_frame(flags, data)
+        if isinstance(message, Fault):
+            self.fault_received(message)
+            return
+
+        transaction, obj = message
+        if transaction == 'reply':
+            self.finish(obj[2], obj[0], obj[1])
+        elif transaction == 'batch':
+            for entry in obj:
+                transaction, entry = next(iter(entry.items()))
+                if transaction == 'reply':
+                    self.finish(entry[2], entry[0], entry[1])
+                elif transaction == 'call':
+                    self.refuse_call(entry[0], entry[3])
+        elif transaction == 'stream':
+            self.stream_received(obj[0], obj[1])
+        elif transaction == 'stream_end':
+            with self._lock:
+                self._consumed.pop(obj[2], None)
+                chunks = self._chunks.pop(obj[2], None)
+
+            result = obj[1]
+            if obj[0] >= STATUS_OK and chunks is not None:
+                result = chunks
+            self.finish(obj[2], obj[0], result)
+        elif transaction == 'call':
+            self.refuse_call(obj[0], obj[3])
+        elif transaction == 'stream_credit':
+            # We never stream
+            pass
+        else:
+            self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Unknown transaction: %s' % transaction))
+
+    def control_received(self, data):
+        """ Handles handshake control frames.
+        """
+        handshake = self.handshake
+        with self._sendLock:
+            use = handshake.received(data)
+            if use is not None:
+                # Frames after "use" get sent with the new options
+                self.write_frame(FRAME_CONTROL, use)
+
+                compression = handshake.send.get('compression')
+                self._compress = compression and COMPRESSORS[compression][0] or None
+                self._sendVersion = handshake.send.get('version', 1)
+                self._sendSerializer = handshake.send.get('serializer')
+                self._methodIds = dict((name, id) for id, name in enumerate(handshake.peer.get('methods') or ()))
+
+        compression = handshake.recv.get('compression')
+        self._decompress = compression and COMPRESSORS[compression][1] or None
+        self._recvVersion = handshake.recv.get('version', 1)
+        self._recvSerializer = handshake.recv.get('serializer')
+
+    def decode_frame(self, flags, data):
+        """ Returns (<transaction>, <obj>) of a (compressed)
+        frame or a Fault.
+        """
+        if flags & FRAME_COMPRESSED:
+            if self._decompress is None:
+                return Fault(NOT_WELLFORMED_ERROR, 'Compressed frame without a compressor.')
+
+            data = self._decompress(tobytes(data))
+
+        name = self._recvSerializer
+        if name is None:
+            name, func, docs = serializer_name, decode, documents
+        else:
+            encoder, func, docs = SERIALIZERS[name]
+
+        start = time.time()
+        message = decode_message(func, data, self._recvVersion, docs)
+        seconds = time.time() - start
+        with self._lock:
+            self.metrics.serialized(name, seconds, encoded=False)
+
+        return message
+
+    def send_message(self, transaction, obj):
+        """ Encodes transaction obj with the negotiated options and
+        writes it, returns a Fault if that failed or None.
+        """
+        with self._sendLock:
+            name = self._sendSerializer
+            if name is None:
+                name, func, docs = serializer_name, encode, documents
+            else:
+                func, decoder, docs = SERIALIZERS[name]
+
+            start = time.time()
+            data = encode_message(func, transaction, obj, self._sendVersion, docs)
+            seconds = time.time() - start
+            with self._lock:
+                self.metrics.serialized(name, seconds)
+
+            if isinstance(data, Fault):
+                return data
+
+            flags = 0
+            compress = self._compress
+            if compress is not None and len(data) >= self.client.compressThreshold:
+                compressed = compress(data)
+                if len(compressed) < len(data):
+                    flags, data = FRAME_COMPRESSED, compressed
+
+            return self.write_frame(flags, data)
+
+    def write_frame(self, flags, data):
+        """ Writes a frame, the caller holds the send lock.
+        """
+        try:
+            self.socket.sendall(STRUCT_INT.pack(flags | len(data)) + data)
+        except socket.error as e:
+            self.close()
+            return Fault(TRANSPORT_ERROR, 'Connection lost: %s' % e)
+
+        with self._lock:
+            self.metrics.sent(1, len(data) + 4)
+
+        return None
+
+    def fault_received(self, fault):
+        """ Gets called whenever we receive a fault
+        which isn't assignable.
+        """
+        self.logger.error(fault)
+
+    def refuse_call(self, method, id):
+        fault = self.send_message('reply', [METHOD_NOT_FOUND, 'Method "%s" not found (%d)' % (method, id), id])
+        if fault is not None:
+            self.fault_received(fault)
+
+    def send_calls(self, calls, timeout=None):
+        """ Sends calls, a list of (method, args, kwargs) tuples (more
+        than one in a "batch" transaction), returns a SyncResult for each.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+
+        results = []
+        entries = []
+        with self._lock:
+            for method, args, kwargs in calls:
+                result = SyncResult(self, deadline)
+                results.append(result)
+                if self.closed:
+                    result.set_exception(Fault(TRANSPORT_ERROR, 'Not connected.'))
+                    continue
+
+                self.id += 1
+                result.id = self.id
+                self.calls[self.id] = result
+                self.metrics.call_sent(self.id, method)
+
+                obj = [self._methodIds.get(method, method), list(args), kwargs, self.id]
+                if timeout is not None:
+                    obj.append(timeout)
+                entries.append(obj)
+
+        if not entries:
+            return results
+
+        if deadline is not None:
+            with self._lock:
+                for obj in entries:
+                    self._track_deadline(obj[3], deadline)
+
+        if len(calls) == 1:
+            fault = self.send_message('call', entries[0])
+        else:
+            fault = self.send_message('batch', [{'call': obj} for obj in entries])
+
+        if fault is not None:
+            for obj in entries:
+                self.finish(obj[3], fault.faultCode, fault.faultString)
+
+        return results
+
+    def finish(self, id, status, result):
+        """ Sets the result of our call id, counts late replies.
+        """
+        with self._lock:
+            call = self.calls.pop(id, None)
+            if call is None:
+                if 0 < id <= self.id:
+                    self.lateReplies += 1
+                    return
+            else:
+                self.metrics.call_finished(id, status < STATUS_OK)
+
+        if call is None:
+            self.fault_received(Fault(APPLICATION_ERROR, 'Unknown result: %d' % id))
+        elif status >= STATUS_OK:
+            call.set(result)
+        else:
+            call.set_exception(Fault(status, result))
+
+    def stream_received(self, id, chunk):
+        """ Collects a chunk of a streamed reply, grants the sender
+        new credit every half streamWindow chunks.
+        """
+        with self._lock:
+            if id not in self.calls:
+                # Timed out or cancelled
+                return
+
+            self._chunks.setdefault(id, []).append(chunk)
+
+            consumed = self._consumed.get(id, 0) + 1
+            if consumed < max(self.client.streamWindow // 2, 1):
+                self._consumed[id] = consumed
+                return
+
+            self._consumed[id] = 0
+
+        fault = self.send_message('stream_credit', [id, consumed])
+        if fault is not None:
+            self.fault_received(fault)
+
+    def track_deadline(self, id, deadline):
+        """ Expires call id at deadline (time.time() based).
+        """
+        with self._lock:
+            if id in self.calls:
+                self._track_deadline(id, deadline)
+
+    def _track_deadline(self, id, deadline):
+        # Holds the lock
+        deadlines = self._deadlines
+        if len(deadlines) > 2 * len(self.calls) + 64:
+            # Mostly calls which finished in time
+            deadlines.compact(self.calls)
+
+        if deadlines.push(deadline, id):
+            if self._timer is None:
+                self._timer = threading.Thread(target=self.expire_loop, name='socketrpc timer %s:%s' % self.address)
+                self._timer.daemon = True
+                self._timer.start()
+            else:
+                self._timerWakeup.notify()
+
+    def expire_loop(self):
+        """ Fails the calls whose deadline has passed with
+        TIMEOUT_ERROR, runs in the timer thread.
+        """
+        while True:
+            expired = []
+            with self._lock:
+                if self.closed:
+                    return
+
+                now = time.time()
+                for id in self._deadlines.expired(now):
+                    call = self._remove(id)
+                    if call is not None:
+                        self.callsExpired += 1
+                        expired.append((id, call))
+
+                if not expired:
+                    earliest = self._deadlines.earliest()
+                    self._timerWakeup.wait(earliest is not None and earliest - now or None)
+
+            for id, call in expired:
+                call.set_exception(Fault(TIMEOUT_ERROR, 'Call %d timed out.' % id))
+
+    def _remove(self, id):
+        # Holds the lock
+        call = self.calls.pop(id, None)
+        if call is not None:
+            self.metrics.call_finished(id, True)
+            self._chunks.pop(id, None)
+            self._consumed.pop(id, None)
+
+        return call
+
+    def cancel(self, id):
+        """ Fails our pending call id with CANCELLED_ERROR, returns
+        False if it had finished. The peer still runs it, but drops
+        the reply and stops streaming it.
+        """
+        with self._lock:
+            call = self._remove(id)
+            if call is None:
+                return False
+
+            self.callsCancelled += 1
+            closed = self.closed
+
+        call.set_exception(Fault(CANCELLED_ERROR, 'Call %d cancelled.' % id))
+
+        if not closed:
+            # It would wait for credit forever else
+            fault = self.send_message('stream_credit', [id, STREAM_CANCEL])
+            if fault is not None:
+                self.fault_received(fault)
+
+        return True
+
+    def close(self):
+        """ Closes the socket and fails the pending calls with TRANSPORT_ERROR.
+        """
+        with self._lock:
+            if self.closed:
+                return
+
+            self.closed = True
+            calls = self.calls
+            self.calls = {}
+            self._chunks = {}
+            self._consumed = {}
+            self._deadlines.clear()
+            self.metrics.calls_lost()
+            self._timerWakeup.notify()
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+        for call in calls.values():
+            call.set_exception(Fault(TRANSPORT_ERROR, 'Connection lost.'))
+
+    def call_stats(self):
+        return {'pending': len(self.calls),
+                'expired': self.callsExpired,
+                'cancelled': self.callsCancelled,
+                'late': self.lateReplies,
+               }
+
+
+class SocketRPCClient(object):
+    """ Thread-safe blocking client for processes without gevent or a
+    reactor. Keeps a pool of up to poolSize persistent connections,
+    every call goes out on the one with the fewest pending calls (a new
+    one is opened while all are busy and the pool isn't full).
+
+    Lost connections get replaced on the next call, calls
+    pending on them fail with TRANSPORT_ERROR.
+    """
+
+    # Connections to keep open
+    poolSize = 4
+
+    # Seconds to wait for a connection
+    connectTimeout = 10.0
+
+    # Default timeout in seconds of our calls, the remaining time
+    # gets sent along so the server can skip calls we gave up on
+    callTimeout = None
+
+    # Compressors to offer the server (most preferred first), frames
+    # of at least compressThreshold bytes get compressed
+    compression = None
+    compressThreshold = 4096
+
+    # Highest message version to offer the server
+    messageVersion = 1
+
+    # Serializers to offer the server (fastest first), until the
+    # handshake is done the one of set_serializer gets used
+    serializers = None
+
+    # Chunks of a streamed reply the server may have in flight,
+    # must not exceed the server's streamWindow
+    streamWindow = 16
+
+    # Bytes to receive at once
+    recvBufferSize = 65536
+
+    def __init__(self, address, pool_size=None, default_timeout=None):
+        self.address = address
+        if pool_size is not None:
+            self.poolSize = pool_size
+        if default_timeout is not None:
+            self.callTimeout = default_timeout
+
+        self.connections = []
+        self._lock = threading.Lock()
+        # Connections being opened, they count against poolSize
+        self._connecting = 0
+        self._connectDone = threading.Condition(self._lock)
+
+        # Metrics of the closed connections
+        self.closedMetrics = Metrics()
+
+    def hello_offer(self):
+        """ Returns the options to offer the server on connect,
+        an empty offer skips the handshake.
+        """
+        offer = {}
+        if self.compression:
+            offer['compression'] = list(self.compression)
+        if self.messageVersion > 1:
+            offer['version'] = self.messageVersion
+        if self.serializers:
+            offer['serializers'] = [name for name in self.serializers if name in SERIALIZERS]
+
+        return offer
+
+    def connection(self):
+        """ Returns the open connection with the fewest pending calls,
+        opens one if there is none or all are busy and the pool has room.
+
+        Connecting happens outside the lock, so the other threads keep
+        using the open connections meanwhile. If it fails the busy
+        connection gets used, with none open the Fault gets raised.
+        """
+        with self._lock:
+            while True:
+                for connection in [c for c in self.connections if c.closed]:
+                    self.connections.remove(connection)
+                    self.closedMetrics.merge(connection.metrics)
+
+                best = None
+                for connection in self.connections:
+                    if best is None or connection.pending() < best.pending():
+                        best = connection
+
+                room = len(self.connections) + self._connecting < self.poolSize
+                if best is not None and (not best.pending() or not room):
+                    return best
+                if room:
+                    break
+
+                # None open yet, wait for the ones being opened
+                self._connectDone.wait()
+
+            self._connecting += 1
+
+        connection = None
+        try:
+            connection = SocketRPCConnection(self, self.address)
+        except Fault as e:
+            if best is None:
+                raise
+            logging.error(e.faultString)
+        finally:
+            with self._lock:
+                self._connecting -= 1
+                if connection is not None:
+                    self.connections.append(connection)
+                self._connectDone.notify_all()
+
+        return connection or best
+
+    def call(self, method, *args, **kwargs):
+        """ Calls method on the server, blocks until its
+        result arrived and returns it, raises its Fault.
+        """
+        return self.call_timeout(self.callTimeout, method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        """ Like call, fails with TIMEOUT_ERROR if there
+        is no reply within timeout seconds.
+        """
+        return self.call_async(timeout, method, *args, **kwargs).get()
+
+    def call_async(self, timeout, method, *args, **kwargs):
+        """ Sends a call without waiting, returns its SyncResult.
+        timeout None waits forever.
+        """
+        return self.connection().send_calls([(method, args, kwargs)], timeout)[0]
+
+    def call_many(self, calls, timeout=None):
+        """ Sends calls, a list of (method, args[, kwargs]) tuples, in a
+        single "batch" transaction, timeout defaults to callTimeout.
+
+        Returns a list with one SyncResult per call, each call
+        succeeds or fails on its own.
+        """
+        if timeout is None:
+            timeout = self.callTimeout
+
+        calls = [(call[0], call[1], len(call) > 2 and call[2] or {}) for call in calls]
+        return self.connection().send_calls(calls, timeout)
+
+    def close(self):
+        """ Closes all connections, their pending calls fail.
+        """
+        with self._lock:
+            connections = self.connections
+            self.connections = []
+
+        for connection in connections:
+            connection.close()
+            self.closedMetrics.merge(connection.metrics)
+
+    def metrics(self):
+        """ Returns the Metrics summed up over all connections.
+        """
+        metrics = Metrics()
+        metrics.merge(self.closedMetrics)
+        for connection in list(self.connections):
+            with connection._lock:
+                metrics.merge(connection.metrics)
+
+        return metrics
+
+    def stats(self):
+        """ Returns metrics().snapshot() with the
+        number of connections and pending calls.
+        """
+        connections = list(self.connections)
+
+        stats = self.metrics().snapshot()
+        stats['connections'] = len(connections)
+        stats['pending'] = sum(connection.pending() for connection in connections)
+
+        return stats
+
+
+__all__ = ['Fault', 'SocketRPCClient', 'SocketRPCConnection', 'SyncResult', 'set_serializer']
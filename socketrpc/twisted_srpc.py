@@ -8,28 +8,32 @@
 #
 ###############################################################################
 
-from socketrpc import set_serializer2, Fault, STRUCT_INT, struct_error
+from socketrpc import set_serializer2, Fault, FrameBuffer, STRUCT_INT, rpcmethod, bind_dispatch, tobytes, is_stream
+from socketrpc import FRAME_COMPRESSED, FRAME_CONTROL, COMPRESSORS, SERIALIZERS, Handshake, encode_message, decode_message
 from socketrpc import STATUS_OK, NOT_WELLFORMED_ERROR, SUPPORTED_TRANSACTIONS, METHOD_NOT_FOUND, APPLICATION_ERROR, TRANSPORT_ERROR
+from socketrpc import TIMEOUT_ERROR, CANCELLED_ERROR, DeadlineHeap, Metrics, call_deadline, unix_path
+from socketrpc import FRAME_SHM, ShmSegment, ShmReader, ReplicaSet, address_tuple, STREAM_CANCEL
 
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, threads
 from twisted.python import log
+from twisted.python.failure import Failure
 
-try:
-    from cStringIO import StringIO
-except ImportError, e:
-    from StringIO import StringIO
+import socket
+import time
 
 # For pylint
 def decode(data):
     pass
 def encode(obj):
     pass
+documents = False
+serializer_name = None
 
-def set_serializer(predefined=None, encode=None, decode=None):
+def set_serializer(predefined=None, encode=None, decode=None, buffers=False, documents=False):
     """ Sets the serializer for this class.
     @see: socketrpc.set_serializer2
     """
-    set_serializer2(predefined, encode, decode, globals())
+    set_serializer2(predefined, encode, decode, globals(), buffers, documents)
 
 class SocketRPCProtocol(protocol.Protocol):
     """ Incremental number "call" transactions.
@@ -45,138 +49,677 @@ class SocketRPCProtocol(protocol.Protocol):
     """
     debug = False
 
-    """ Should the dispatch_call method
-    strip dots for security?
+    """ Without it a call to "a.b" falls back
+    to "ab" if there is no method named "a.b"
     """
     allow_dotted_attributes = False
 
-    """ Tuple with Buffering data
-        Contents:
-            StringIO   buffer
-            int        total length of the buffer
-            int        where to read data next 
-            int        bytes required for the next full object
+    """ Dict of the docall_ methods, format:
+        {<name>: (<bound method>, <inline>, <offload>)}
+    """
+    _dispatch = None
+
+    """ Compressors to offer the peer (most preferred first),
+    frames of at least compressThreshold bytes get compressed
+    """
+    compression = None
+    compressThreshold = 4096
+
+    """ FrameBuffer holding a partial frame
+    between two dataReceived calls.
     """
     _buffer = None
 
-    """ Number bytes needed in the buffer 
-    for the next object
+    """ Frames of at least offloadThreshold bytes get decompressed and
+    decoded with deferToThread, the replies of @rpcmethod(offload=True)
+    methods get encoded there
     """
-    _objNeed = 0
+    offloadThreshold = None
+
+    """ Frames received while a frame gets decoded in a thread,
+    they wait for it to keep the order, format:
+        [(<flags>, <data>), ...]
+    """
+    _backlog = None
+
+    """ With a peer on the same host which offers it as well, messages
+    of at least sharedMemoryThreshold bytes go through a shared memory
+    segment of sharedMemorySize bytes per connection and direction,
+    the socket only carries their descriptor
+    """
+    sharedMemory = False
+    sharedMemorySize = 64 * 1024 * 1024
+    sharedMemoryThreshold = 1024 * 1024
+
+    """ Our segment, once the peer mapped it we send
+    through it (_shmSend), _shmRecv is the peer's segment
+    """
+    _shmSegment = None
+    _shmSend = None
+    _shmRecv = None
+
+    """ Highest message version to offer the peer, 2 replaces the
+    envelope dict by a fixed binary header
+    """
+    messageVersion = 1
+
+    """ Advertise the docall_ methods with integer ids and call
+    the peer's methods by id once it advertised them
+    """
+    internMethods = False
+
+    """ Serializers to offer the peer (fastest first), until the
+    handshake is done the one of set_serializer gets used
+    """
+    serializers = None
+
+    """ Interned method ids index _methodNames and _methods,
+    the peer's ids, format:
+        {<name>: <id>}
+    """
+    _methodNames = None
+    _methods = None
+    _methodIds = None
+
+    """ Negotiated connection options
+    """
+    handshake = None
+    _compress = None
+    _decompress = None
+    _sendVersion = 1
+    _recvVersion = 1
+    _sendSerializer = None
+    _recvSerializer = None
+
+    """ Chunks of a streamed reply which may be in flight
+    """
+    streamWindow = 16
+
+    """ Default timeout in seconds of our calls, the remaining
+    time gets sent along so the peer can stop streaming to us
+    """
+    callTimeout = None
+
+    """ Deadlines of our pending calls and the
+    DelayedCall for the earliest
+    """
+    _deadlines = None
+    _timer = None
+
+    """ Calls which timed out, got cancelled, their replies which
+    came too late and streams to the peer stopped at its deadline
+    """
+    callsExpired = 0
+    callsCancelled = 0
+    lateReplies = 0
+    callsSkipped = 0
+
+    """ Streamed replies we send, format:
+        {<id>: [<iterator>, <credit>, <deadline>]}
+    """
+    _streams = None
+
+    """ Receiving streams, chunk callbacks of call_stream and
+    chunks of plain calls, format:
+        {<id>: <callback>} / {<id>: [<chunk>, ...]}
+    """
+    _streamCallbacks = None
+    _chunks = None
+
+    """ Consumed chunks not yet granted as credit, format:
+        {<id>: <count>}
+    """
+    _consumed = None
+
+    """ Latency, byte and serializer counters of the connection
+    """
+    metrics = None
 
     def connectionMade(self):
-        self._buffer = (StringIO(), 0, 0, 0,)
-        self._objNeed = 0
+        self._buffer = FrameBuffer()
         self.id = 0
         self.calls = {}
+        self._streams = {}
+        self._streamCallbacks = {}
+        self._chunks = {}
+        self._consumed = {}
+        self._deadlines = DeadlineHeap()
+        self.metrics = Metrics()
+        self._dispatch = bind_dispatch(self)
+        self._methodNames = sorted(self._dispatch)
+        self._methods = [self._dispatch[name] for name in self._methodNames]
+        self._methodIds = {}
+
+        if self.sharedMemory:
+            self.open_shared_memory()
+        self.handshake = Handshake(self.hello_offer())
+        hello = self.handshake.hello()
+        if hello is not None:
+            self.send_frame(hello, FRAME_CONTROL)
 
         # ClientCreator does not pass "factory" so check here
         if hasattr(self, 'factory') and hasattr(self.factory, 'clientConnectionMade'):
             self.factory.clientConnectionMade(self)
 
     def connectionLost(self, reason=protocol.connectionDone):
-        for call in self.calls.itervalues():
+        self.connected = 0
+        streams = self._streams
+        self._streams = {}
+        for stream in streams.itervalues():
+            if stream is not None and stream[3] is not None:
+                stream[3].cancel()
+        self._backlog = None
+        self.close_shared_memory()
+
+        self._deadlines.clear()
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        calls = self.calls
+        self.calls = {}
+        self.metrics.calls_lost()
+        for call in calls.itervalues():
             call.errback(Fault(TRANSPORT_ERROR, reason.getErrorMessage()))
 
-    def dataReceived(self, data):
-        buffer, blen, offset, need = self._buffer
-        buffer.write(data)
-        blen += len(data)
+    def hello_offer(self):
+        """ Returns the options to offer the peer on connect,
+        an empty offer skips the handshake.
+        """
+        offer = {}
+        if self.compression:
+            offer['compression'] = list(self.compression)
+        if self.messageVersion > 1:
+            offer['version'] = self.messageVersion
+        if self.internMethods:
+            offer['methods'] = self._methodNames
+        if self.serializers:
+            offer['serializers'] = [name for name in self.serializers if name in SERIALIZERS]
+        if self._shmSegment is not None:
+            offer['shm'] = self._shmSegment.offer()
+
+        return offer
 
-        while blen > offset:
-            if need == 0:
+    def open_shared_memory(self):
+        """ Creates our segment to offer, without one
+        everything goes through the socket.
+        """
+        try:
+            self._shmSegment = ShmSegment(self.sharedMemorySize)
+        except EnvironmentError, e:
+            log.msg('No shared memory segment: %s' % e)
+
+    def control_received(self, data):
+        """ Handles handshake control frames.
+        """
+        handshake = self.handshake
+        use = handshake.received(data)
+        if use is not None:
+            if handshake.send.get('shm'):
+                # Map the peer's segment before confirming it
                 try:
-                    buffer.seek(offset)
-                    need = STRUCT_INT.unpack(buffer.read(4))[0]
-                    offset += 4
-                    buffer.seek(blen)
-                except struct_error:
-                    self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Haven\'t got a length.'))
-                    self._buffer = (StringIO(), 0, 0, 0,)
-                    return False
-
-            if blen - offset >= need:
-                buffer.seek(offset)
-                data = buffer.read(need)
-                offset += need
-                need = 0
-
-                data = decode(data)
-                if isinstance(data, Fault):
-                    self.fault_received(data)
-                    continue
+                    self._shmRecv = ShmReader(handshake.peer['shm']['path'], handshake.peer['shm']['token'])
+                except (EnvironmentError, ValueError), e:
+                    # Not confirmed, the peer keeps sending inline frames
+                    log.msg('Can\'t map the peer\'s shared memory segment: %s' % e)
+                    use = handshake.withdraw('shm')
 
-                transaction, obj = data.iteritems().next()
-                if not transaction in SUPPORTED_TRANSACTIONS:
-                    self.fault_received(NOT_WELLFORMED_ERROR, 'Unknown transaction: %s' % transaction)
-                    continue
+            # Frames after "use" get sent with the new options
+            self.send_frame(use, FRAME_CONTROL)
 
-                if transaction == 'call':
-                    d = self.dispatch_call(obj[0], obj[3], obj[1], obj[2])
-                    d.addCallback(self._callCb, obj[3])
-                    d.addErrback(self._callEb, obj[3])
-                elif transaction == 'reply':
-                    self.dispatch_reply(obj[0], obj[1], obj[2])
+            compression = handshake.send.get('compression')
+            self._compress = compression and COMPRESSORS[compression][0] or None
+            self._sendVersion = handshake.send.get('version', 1)
+            self._sendSerializer = handshake.send.get('serializer')
+            self._methodIds = dict((name, id) for id, name in enumerate(handshake.peer.get('methods') or ()))
 
+        compression = handshake.recv.get('compression')
+        self._decompress = compression and COMPRESSORS[compression][1] or None
+        self._recvVersion = handshake.recv.get('version', 1)
+        self._recvSerializer = handshake.recv.get('serializer')
+
+        segment = self._shmSegment
+        if segment is not None and handshake.used and self._shmSend is None:
+            if handshake.recv.get('shm') == segment.path:
+                # Mapped by the peer, nobody else needs the file
+                self._shmSend = segment
+                segment.unlink()
             else:
-                break
+                self._shmSegment = None
+                segment.close()
 
-        if need == 0:
-            data = buffer.read()
-            buffer.seek(0)
-            buffer.truncate()
-            buffer.write(data)
-            blen = len(data)
-            offset = 0
+    def shared_frame(self, descriptor):
+        """ Returns the message of a FRAME_SHM descriptor or a Fault.
+        """
+        if self._shmRecv is None:
+            return Fault(NOT_WELLFORMED_ERROR, 'Shared memory frame without a segment.')
 
-        self._buffer = (buffer, blen, offset, need,)
+        return self._shmRecv.read(descriptor)
 
+    def close_shared_memory(self):
+        """ Unmaps both segments, our file gets removed.
+        """
+        self._shmSend = None
+        if self._shmSegment is not None:
+            self._shmSegment.close()
+            self._shmSegment = None
 
-    def dispatch_call(self, method, id, args, kwargs):
-        if not self.allow_dotted_attributes:
-            method = method.replace('.', '')
+        if self._shmRecv is not None:
+            self._shmRecv.close()
+            self._shmRecv = None
+
+    def encode_message(self, transaction, obj):
+        """ Encodes transaction obj with the negotiated serializer
+        and message version.
+        """
+        name = self._sendSerializer
+        if name is None:
+            name, func, docs = serializer_name, encode, documents
+        else:
+            func, decoder, docs = SERIALIZERS[name]
+
+        start = time.time()
+        data = encode_message(func, transaction, obj, self._sendVersion, docs)
+        self.metrics.serialized(name, time.time() - start)
+
+        return data
+
+    def decode_message(self, data):
+        """ Returns (<transaction>, <obj>) of a received message or a Fault.
+        """
+        name = self._recvSerializer
+        if name is None:
+            name, func, docs = serializer_name, decode, documents
+        else:
+            encoder, func, docs = SERIALIZERS[name]
+
+        start = time.time()
+        message = decode_message(func, data, self._recvVersion, docs)
+        self.metrics.serialized(name, time.time() - start, encoded=False)
+
+        return message
+
+    def decode_frame(self, flags, data):
+        """ Returns (<transaction>, <obj>) of a (compressed)
+        frame or a Fault.
+        """
+        if flags & FRAME_COMPRESSED:
+            if self._decompress is None:
+                return Fault(NOT_WELLFORMED_ERROR, 'Compressed frame without a compressor.')
+
+            data = self._decompress(tobytes(data))
+
+        return self.decode_message(data)
+
+    def encode_frame(self, transaction, obj):
+        """ Returns the (<flags>, <data>) frame of transaction obj or a Fault.
+        """
+        data = self.encode_message(transaction, obj)
+        if isinstance(data, Fault):
+            return data
+
+        return self.compress_frame(data)
+
+    def compress_frame(self, data):
+        """ Returns the (<flags>, <data>) frame of data, compressed
+        when negotiated and at least compressThreshold bytes long.
+        """
+        if self._shmSend is not None and len(data) >= self.sharedMemoryThreshold:
+            # Goes through shared memory, see write_frame
+            return (0, data)
+
+        compress = self._compress
+        if compress is not None and len(data) >= self.compressThreshold:
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                return (FRAME_COMPRESSED, compressed)
+
+        return (0, data)
+
+    def send_frame(self, data, flags=0):
+        """ Writes data as a frame, see compress_frame.
+        """
+        if not flags:
+            flags, data = self.compress_frame(data)
+
+        self.write_frame(flags, data)
+
+    def write_frame(self, flags, data):
+        """ Writes a (<flags>, <data>) frame, large ones go through
+        shared memory if the peer mapped our segment.
+        """
+        segment = self._shmSend
+        if segment is not None and not flags and len(data) >= self.sharedMemoryThreshold:
+            descriptor = segment.write(data)
+            if descriptor is not None:
+                flags, data = FRAME_SHM, descriptor
+
+        self.metrics.sent(1, len(data) + 4)
+        self.transport.write(STRUCT_INT.pack(flags | len(data)) + data)
+
+    def dataReceived(self, data):
+        metrics = self.metrics
+        metrics.bytesIn += len(data)
+
+        received = time.time()
+        for flags, data in self._buffer.feed(data):
+            metrics.framesIn += 1
+            if self._backlog is not None:
+                self._backlog.append((flags, data, received))
+            else:
+                self.frame_received(flags, data, received)
+
+    def frame_received(self, flags, data, received=None):
+        if flags == FRAME_SHM:
+            data = self.shared_frame(data)
+            if isinstance(data, Fault):
+                self.fault_received(data)
+                return
+            flags = 0
+
+        elif flags & FRAME_CONTROL:
+            self.control_received(data)
+            return
+
+        if self._shmSegment is not None and self.handshake.peer is None:
+            # The peer's first frame wasn't a hello, it has no offer
+            self.close_shared_memory()
+
+        threshold = self.offloadThreshold
+        if threshold is not None and len(data) >= threshold:
+            # Later frames wait in the backlog until this one is dispatched
+            self._backlog = []
+
+            d = threads.deferToThread(self.decode_frame, flags, data)
+            d.addErrback(lambda failure: Fault(NOT_WELLFORMED_ERROR, failure.getErrorMessage()))
+            d.addCallback(self._decodedCb, received)
+            return
+
+        self.message_received(self.decode_frame(flags, data), received)
+
+    def _decodedCb(self, message, received=None):
+        backlog = self._backlog
+        self._backlog = None
+        if not self.connected:
+            return
+
+        self.message_received(message, received)
+
+        while backlog:
+            flags, data, received = backlog.pop(0)
+            self.frame_received(flags, data, received)
 
-        cmd = 'docall_%s' % method
+            if self._backlog is not None:
+                # Another large frame, the rest waits for it
+                self._backlog = backlog
+                return
 
+    def message_received(self, message, received=None):
+        """ Dispatches a decoded message, received is the time its
+        frame arrived (calls which expired since then get skipped).
+        """
+        if isinstance(message, Fault):
+            self.fault_received(message)
+            return
+
+        transaction, obj = message
+        if not transaction in SUPPORTED_TRANSACTIONS:
+            self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Unknown transaction: %s' % transaction))
+            return
+
+        if transaction == 'call':
+            deadline = call_deadline(obj, received)
+            if deadline is not None and time.time() >= deadline:
+                # The caller has given up on it
+                self.callsSkipped += 1
+                return
+
+            entry = self.find_method(obj[0])
+            # Until it returns, a cancel of the caller removes it (see _callDone)
+            self._streams[obj[3]] = None
+            d = self.dispatch_call(obj[0], obj[3], obj[1], obj[2])
+            d.addBoth(self._callDone, obj[3], entry is not None and entry[2], deadline)
+            d.addErrback(self._callEb, obj[3])
+        elif transaction == 'reply':
+            self.dispatch_reply(obj[0], obj[1], obj[2])
+        elif transaction == 'batch':
+            self.dispatch_batch(obj, received)
+        elif transaction == 'stream':
+            self.dispatch_stream(obj[0], obj[1])
+        elif transaction == 'stream_end':
+            self.dispatch_stream_end(obj[0], obj[1], obj[2])
+        elif transaction == 'stream_credit':
+            self.dispatch_stream_credit(obj[0], obj[1])
+
+    def dispatch_call(self, method, id, args, kwargs):
         if self.debug:
             log.msg('exec CALL %s (%d)' % (method, id))
 
-        try:
-            func = getattr(self, cmd)
-        except AttributeError, e:
+        entry = self.find_method(method)
+        if entry is None:
             log.msg('Unknown CALL method %s (%d)' % (method, id))
+            self.metrics.observe('server', '<unknown>', 0.0, True)
             return defer.fail(Fault(METHOD_NOT_FOUND, 'Method "%s" not found (%d)' % (method, id)))
 
-        return defer.maybeDeferred(func, *args, **kwargs)
+        func = entry[0]
 
-    def _callEb(self, failure, id):
+        d = defer.maybeDeferred(func, *args, **kwargs)
+        d.addBoth(self._observeCb, self.method_name(method), time.time())
+        return d
+
+    def _observeCb(self, result, method, start):
+        error = isinstance(result, (Failure, Fault))
+        self.metrics.observe('server', method, time.time() - start, error)
+        return result
+
+    def method_name(self, method):
+        """ Returns the name of a method we have, called
+        by name or interned id.
+        """
+        if isinstance(method, (int, long)):
+            return self._methodNames[method]
+
+        return method
+
+    def find_method(self, method):
+        """ Returns the (<bound method>, <inline>, <offload>) entry for a
+        method name or interned id, None if there is none.
+        """
+        if isinstance(method, (int, long)):
+            if 0 <= method < len(self._methods):
+                return self._methods[method]
+
+            return None
+
+        entry = self._dispatch.get(method)
+        if entry is None and not self.allow_dotted_attributes:
+            entry = self._dispatch.get(method.replace('.', ''))
+
+        return entry
+
+    def dispatch_batch(self, entries, received=None):
+        """ Dispatches every transaction of a batch, the calls
+        get answered with a single batch reply.
+        """
+        now = time.time()
+
+        dl = []
+        for entry in entries:
+            transaction, obj = entry.iteritems().next()
+
+            if transaction == 'call':
+                deadline = call_deadline(obj, received)
+                if deadline is not None and now >= deadline:
+                    self.callsSkipped += 1
+                    continue
+
+                d = self.dispatch_call(obj[0], obj[3], obj[1], obj[2])
+                d.addCallbacks(self._callResult, self._callFailure,
+                               callbackArgs=(obj[3],), errbackArgs=(obj[3],))
+                dl.append(d)
+            elif transaction == 'reply':
+                self.dispatch_reply(obj[0], obj[1], obj[2])
+            else:
+                self.fault_received(Fault(NOT_WELLFORMED_ERROR, 'Unknown batch transaction: %s' % transaction))
+
+        if dl:
+            d = defer.gatherResults(dl)
+            d.addCallback(self._batchCb)
+
+    def _callFailure(self, failure, id):
         obj = failure.value
         if isinstance(obj, Fault):
-            self.send_response(obj.faultCode, obj.faultString, id)
+            return [obj.faultCode, obj.faultString, id]
         elif isinstance(obj, Exception):
-            self.send_response(APPLICATION_ERROR, "%s: %s" % (obj.__class__.__name__, repr(obj)), id)
+            return [APPLICATION_ERROR, "%s: %s" % (obj.__class__.__name__, repr(obj)), id]
         else:
-            self.send_response(APPLICATION_ERROR, repr(obj), id)
+            return [APPLICATION_ERROR, repr(obj), id]
 
-    def _callCb(self, result, id):
+    def _callResult(self, result, id):
         if isinstance(result, Fault):
-            self.send_response(result.faultCode, result.faultString, id)
+            return [result.faultCode, result.faultString, id]
+        else:
+            return [STATUS_OK, result, id]
+
+    def _callDone(self, result, id, offload=False, deadline=None):
+        if self._streams.pop(id, False) is not None:
+            # Cancelled meanwhile, the caller drops the reply
+            if self.connected:
+                self.callsSkipped += 1
+            return
+
+        if isinstance(result, Failure):
+            return self._callEb(result, id)
+
+        return self._callCb(result, id, offload, deadline)
+
+    def _callEb(self, failure, id):
+        self.send_response(*self._callFailure(failure, id))
+
+    def _callCb(self, result, id, offload=False, deadline=None):
+        if is_stream(result):
+            self.send_stream(result, id, deadline)
+        elif offload and not isinstance(result, Fault):
+            return self.send_offloaded('reply', [STATUS_OK, result, id])
         else:
-            self.send_response(STATUS_OK, result, id)
+            self.send_response(*self._callResult(result, id))
+
+    def _batchCb(self, replies):
+        for reply in replies:
+            if reply[0] == STATUS_OK and is_stream(reply[1]):
+                # No streaming inside batches
+                try:
+                    reply[1] = list(reply[1])
+                except Exception, e:
+                    reply[:2] = [APPLICATION_ERROR, "%s: %s" % (e.__class__.__name__, repr(e))]
+
+        self.send_batch([{'reply': reply} for reply in replies])
 
     def dispatch_reply(self, status, result, id):
         if self.debug:
             log.msg('recv REPLY %d' % id)
 
-        try:
-            if status >= STATUS_OK:
-                self.calls[id].callback(result)
-                del self.calls[id]
-            else:
-                self.calls[id].errback(Fault(status, result))
-                del self.calls[id]
-        except KeyError:
-            self.fault_received(Fault(APPLICATION_ERROR, 'Unknown result: %d' % id))
+        self.metrics.call_finished(id, status < STATUS_OK)
+
+        # Not pending anymore for the callbacks
+        finished = self.calls.pop(id, None)
+        if finished is None:
+            self.unknown_reply(id, 'result')
+            return
+
+        if status >= STATUS_OK:
+            finished.callback(result)
+        else:
+            finished.errback(Fault(status, result))
+
+    def dispatch_stream(self, id, chunk):
+        if id not in self.calls:
+            self.unknown_reply(id, 'stream')
+            return
+
+        callback = self._streamCallbacks.get(id)
+        if callback is None:
+            self._chunks.setdefault(id, []).append(chunk)
+            self.stream_consumed(id)
+            return
+
+        # Credit follows when the callback is done with the chunk
+        d = defer.maybeDeferred(callback, chunk)
+        d.addCallback(lambda ign: self.stream_consumed(id))
+        d.addErrback(self.fault_received)
+
+    def unknown_reply(self, id, kind):
+        """ Counts replies to our expired or cancelled calls, any
+        other unknown id is a fault.
+        """
+        if 0 < id <= self.id:
+            self.lateReplies += 1
+            if self.debug:
+                log.msg('late %s %d' % (kind, id))
+        else:
+            self.fault_received(Fault(APPLICATION_ERROR, 'Unknown %s: %d' % (kind, id)))
+
+    def dispatch_stream_end(self, status, result, id):
+        self._consumed.pop(id, None)
+        self._streamCallbacks.pop(id, None)
+
+        chunks = self._chunks.pop(id, None)
+        if status >= STATUS_OK and chunks is not None:
+            result = chunks
+
+        self.dispatch_reply(status, result, id)
+
+    def dispatch_stream_credit(self, id, count):
+        if id not in self._streams:
+            # Finished already
+            return
+
+        stream = self._streams[id]
+        if count == STREAM_CANCEL:
+            # The receiver gave up on it, _callDone sees it gone
+            self._end_stream(id)
+            return
+
+        if stream is not None:
+            stream[1] += count
+            self._pump_stream(id)
+
+    def stream_consumed(self, id, count=1):
+        """ Grants the sender of stream id new credit, batched to
+        every half streamWindow chunks.
+        """
+        if id not in self.calls:
+            # Already finished
+            return
+
+        consumed = self._consumed.get(id, 0) + count
+        if consumed < max(self.streamWindow // 2, 1):
+            self._consumed[id] = consumed
+            return
+
+        self._consumed[id] = 0
+
+        data = self.encode_message('stream_credit', [id, consumed])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def send_stream_cancel(self, id):
+        """ Tells the peer to stop streaming the reply of our call id,
+        it keeps the stream around else. Calls without a streamed
+        reply ignore it.
+        """
+        if not self.connected:
+            return
+
+        data = self.encode_message('stream_credit', [id, STREAM_CANCEL])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
 
     def fault_received(self, fault):
         """ Gets called whenever we receive a fault
@@ -185,21 +728,136 @@ class SocketRPCProtocol(protocol.Protocol):
         log.err(fault)
 
     def send_response(self, code=STATUS_OK, result='', id=None):
-        data = {'reply': [code, result, id]}
-
         if self.debug:
             log.msg('send REPLY %d' % id)
 
-        data = encode(data)
+        data = self.encode_message('reply', [code, result, id])
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def send_offloaded(self, transaction, obj):
+        """ Encodes and compresses transaction obj with deferToThread,
+        returns a Deferred which fires once it has been written.
+        """
+        options = (self._sendVersion, self._sendSerializer, self._compress)
+
+        def write(frame):
+            if options != (self._sendVersion, self._sendSerializer, self._compress):
+                # The handshake switched the options meanwhile
+                frame = self.encode_frame(transaction, obj)
+
+            if isinstance(frame, Fault):
+                self.fault_received(frame)
+                return
+
+            self.write_frame(*frame)
+
+        d = threads.deferToThread(self.encode_frame, transaction, obj)
+        d.addCallback(write)
+        return d
+
+    def send_stream(self, iterator, id, deadline=None):
+        """ Sends every item of iterator as a "stream" chunk while the
+        receiver has granted credit and finishes with a "stream_end".
+        Stops at the caller's deadline or once the caller cancels it.
+        """
+        if self.debug:
+            log.msg('send STREAM %d' % id)
+
+        # [<iterator>, <credit>, <deadline>, <deadline timer>]
+        stream = self._streams[id] = [iterator, self.streamWindow, deadline, None]
+        if deadline is not None:
+            from twisted.internet import reactor
+            # Without credit _pump_stream doesn't run at the deadline
+            stream[3] = reactor.callLater(max(deadline - time.time(), 0), self._expire_stream, id)
+
+        self._pump_stream(id)
+
+    def _expire_stream(self, id):
+        # The caller has given up on it, it grants no more credit
+        self._streams[id][3] = None
+        self._end_stream(id)
+        self.callsSkipped += 1
+
+    def _end_stream(self, id):
+        stream = self._streams.pop(id)
+        if stream is not None and stream[3] is not None:
+            stream[3].cancel()
+
+    def _pump_stream(self, id):
+        stream = self._streams[id]
+        iterator = stream[0]
+
+        while stream[1] > 0:
+            try:
+                chunk = iterator.next()
+            except StopIteration:
+                self._end_stream(id)
+                self.send_stream_end(STATUS_OK, None, id)
+                return
+            except Exception, e:
+                self._end_stream(id)
+                self.send_stream_end(*self._callFailure(Failure(e), id))
+                return
+
+            data = self.encode_message('stream', [id, chunk])
+            if isinstance(data, Fault):
+                self._end_stream(id)
+                self.send_stream_end(data.faultCode, data.faultString, id)
+                return
+
+            self.send_frame(data)
+            stream[1] -= 1
+
+    def send_stream_end(self, code=STATUS_OK, result=None, id=None):
+        data = self.encode_message('stream_end', [code, result, id])
         if isinstance(data, Fault):
             self.fault_received(data)
             return
 
-        self.transport.write(STRUCT_INT.pack(len(data)) + data)
+        self.send_frame(data)
+
+    def send_batch(self, replies):
+        if self.debug:
+            log.msg('send BATCH REPLY (%d)' % len(replies))
+
+        data = self.encode_message('batch', replies)
+        if isinstance(data, Fault):
+            # Answer the replies which don't encode with an error
+            # of their own, the others still get their result
+            replies = [self.encodable_reply(entry) for entry in replies]
+            data = self.encode_message('batch', replies)
+
+        if isinstance(data, Fault):
+            self.fault_received(data)
+            return
+
+        self.send_frame(data)
+
+    def encodable_reply(self, entry):
+        """ Returns the batch entry {"reply": [<status>, <result>, <id>]}
+        or an APPLICATION_ERROR reply for its id if it doesn't encode.
+        """
+        reply = entry['reply']
+        data = self.encode_message('reply', reply)
+        if isinstance(data, Fault):
+            return {'reply': [APPLICATION_ERROR, 'Unserializable reply: %s' % data.faultString, reply[2]]}
+
+        return entry
 
     def call(self, method, *args, **kwargs):
+        return self.call_timeout(self.callTimeout, method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        """ Like call, the Deferred fails with a TIMEOUT_ERROR Fault
+        if there is no reply within timeout seconds (None waits forever).
+        Cancelling it cancels the call.
+        """
         self.id += 1
-        data = encode({'call': [method, args, kwargs, self.id]})
+        data = self.encode_message('call', self._callObj(method, args, kwargs, self.id, timeout))
 
         if isinstance(data, Fault):
             return defer.fail(data)
@@ -207,14 +865,184 @@ class SocketRPCProtocol(protocol.Protocol):
         if self.debug:
             log.msg('send CALL %d %s' % (self.id, method))
 
-        data = STRUCT_INT.pack(len(data)) + data
-        self.transport.write(data)
+        self.send_frame(data)
 
-        finished = defer.Deferred()
+        finished = defer.Deferred(lambda d, id=self.id: self.cancel(id))
         self.calls[self.id] = finished
+        self.track_deadline(self.id, timeout)
+        self.metrics.call_sent(self.id, method)
 
         return finished
 
+    def call_stream(self, callback, method, *args, **kwargs):
+        """ Like call but for streamed replies, callback gets called
+        with every chunk. If it returns a Deferred the sender gets credit
+        for the next chunks once it fires, so memory stays bounded by
+        streamWindow. The returned Deferred fires at the end of the stream,
+        with the result if the method sent a plain reply.
+        """
+        finished = self.call(method, *args, **kwargs)
+        if self.id in self.calls:
+            self._streamCallbacks[self.id] = callback
+
+        return finished
+
+    def call_many(self, calls, timeout=None):
+        """ Sends calls, a list of (method, args[, kwargs]) tuples,
+        in a single "batch" transaction, timeout defaults to callTimeout.
+
+        Returns a list with one Deferred per call, each call
+        succeeds or fails on its own.
+        """
+        if timeout is None:
+            timeout = self.callTimeout
+
+        entries = []
+        for call in calls:
+            self.id += 1
+            kwargs = len(call) > 2 and call[2] or {}
+            entries.append({'call': self._callObj(call[0], call[1], kwargs, self.id, timeout)})
+
+        data = self.encode_message('batch', entries)
+
+        if isinstance(data, Fault):
+            return [defer.fail(data) for entry in entries]
+
+        if self.debug:
+            log.msg('send BATCH (%d calls)' % len(entries))
+
+        self.send_frame(data)
+
+        results = []
+        for call, entry in zip(calls, entries):
+            id = entry['call'][3]
+            finished = defer.Deferred(lambda d, id=id: self.cancel(id))
+            self.calls[id] = finished
+            self.track_deadline(id, timeout)
+            self.metrics.call_sent(id, call[0])
+            results.append(finished)
+
+        return results
+
+    def _callObj(self, method, args, kwargs, id, timeout):
+        """ Returns the "call" transaction obj, with the
+        timeout appended for the peer.
+        """
+        obj = [self._methodIds.get(method, method), args, kwargs, id]
+        if timeout is not None:
+            obj.append(timeout)
+
+        return obj
+
+    def track_deadline(self, id, timeout):
+        """ Expires call id after timeout seconds.
+        """
+        if timeout is None:
+            return
+
+        deadline = time.time() + timeout
+
+        deadlines = self._deadlines
+        if len(deadlines) > 2 * len(self.calls) + 64:
+            # Mostly calls which finished in time
+            deadlines.compact(self.calls)
+
+        if deadlines.push(deadline, id):
+            self._scheduleTimer(deadline)
+
+    def _scheduleTimer(self, deadline):
+        delay = max(deadline - time.time(), 0)
+
+        timer = self._timer
+        if timer is not None and timer.active():
+            if timer.getTime() > deadline:
+                timer.reset(delay)
+            return
+
+        from twisted.internet import reactor
+        self._timer = reactor.callLater(delay, self._expireCalls)
+
+    def _expireCalls(self):
+        """ Fails the calls whose deadline has passed,
+        runs in the per connection timer.
+        """
+        self._timer = None
+
+        now = time.time()
+        for id in self._deadlines.expired(now):
+            finished = self.calls.pop(id, None)
+            if finished is not None:
+                self.callsExpired += 1
+                self.metrics.call_finished(id, True)
+                self._streamCallbacks.pop(id, None)
+                self._chunks.pop(id, None)
+                self._consumed.pop(id, None)
+                finished.errback(Fault(TIMEOUT_ERROR, 'Call %d timed out.' % id))
+
+        earliest = self._deadlines.earliest()
+        if earliest is not None:
+            # Don't wake up for every single deadline
+            self._scheduleTimer(max(earliest, now + 0.01))
+
+    def cancel(self, id):
+        """ Cancels our pending call id, its Deferred fails with a
+        CANCELLED_ERROR Fault. Returns False if it had finished.
+        """
+        finished = self.calls.pop(id, None)
+        if finished is None:
+            return False
+
+        self.callsCancelled += 1
+        self.metrics.call_finished(id, True)
+        self._streamCallbacks.pop(id, None)
+        self._chunks.pop(id, None)
+        self._consumed.pop(id, None)
+        self.send_stream_cancel(id)
+        finished.errback(Fault(CANCELLED_ERROR, 'Call %d cancelled.' % id))
+
+        return True
+
+    def stats(self):
+        """ Returns the metrics of this connection (see
+        socketrpc.Metrics.snapshot) with its pending calls and the
+        bytes buffered by the transport.
+        """
+        stats = self.metrics.snapshot()
+        stats['pending'] = len(self.calls)
+
+        # FileDescriptor keeps them in dataBuffer and _tempDataBuffer
+        transport = self.transport
+        stats['write_bytes'] = len(getattr(transport, 'dataBuffer', '')) + getattr(transport, '_tempDataLen', 0)
+        if self._shmSend is not None:
+            stats['shared_memory'] = self._shmSend.stats()
+
+        return stats
+
+    def docall_stats(self):
+        """ Returns stats(), with the metrics of all connections as
+        "total" if the factory keeps them (a "metrics" method returning
+        a socketrpc.Metrics).
+        """
+        stats = self.stats()
+
+        metrics = getattr(getattr(self, 'factory', None), 'metrics', None)
+        if callable(metrics):
+            stats['total'] = metrics().snapshot()
+
+        return stats
+
+    def call_stats(self):
+        """ Returns the number of pending calls, of calls which
+        timed out or got cancelled, replies which came after that and
+        streams to the peer stopped at its deadline.
+        """
+        return {'pending': len(self.calls),
+                'expired': self.callsExpired,
+                'cancelled': self.callsCancelled,
+                'late': self.lateReplies,
+                'skipped': self.callsSkipped,
+               }
+
 
 class SocketRPCClient(protocol.ReconnectingClientFactory):
 
@@ -225,6 +1053,14 @@ class SocketRPCClient(protocol.ReconnectingClientFactory):
 
     protocol = SocketRPCProtocol
 
+    """ A socketrpc.ResultCache for call
+    """
+    cache = None
+
+    """ Default call timeout of the connections (@see: SocketRPCProtocol.callTimeout)
+    """
+    callTimeout = None
+
     def startedConnecting(self, connector):
         self.connector = connector
 
@@ -235,10 +1071,415 @@ class SocketRPCClient(protocol.ReconnectingClientFactory):
     def clientConnectionMade(self, protocol):
         self.remote = protocol
         self.remote.debug = self.debug
+        if self.callTimeout is not None:
+            self.remote.callTimeout = self.callTimeout
         self.connected = True
 
     def call(self, method, *args, **kwargs):
+        if self.cache is not None and self.cache.ttl(method) is not None:
+            return self._cachedCall(method, args, kwargs)
+
         if not self.connected:
             return defer.fail(Fault(TRANSPORT_ERROR, 'Not connected.'))
 
         return self.remote.call(method, *args, **kwargs)
+
+    def _cachedCall(self, method, args, kwargs):
+        """ call through self.cache, concurrent misses for the same key
+        share one request. Every caller gets a Deferred of its own, the
+        request gets cancelled once none of them waits for it.
+        """
+        cache = self.cache
+        key = cache.key(method, args, kwargs)
+        found, value = cache.get(key)
+        if found:
+            return defer.succeed(value)
+
+        # [<request>, [<Deferred of a waiting caller>, ...]]
+        entry = cache.pending.get(key)
+        if entry is not None:
+            cache.joined += 1
+        elif not self.connected:
+            return defer.fail(Fault(TRANSPORT_ERROR, 'Not connected.'))
+        else:
+            entry = cache.pending[key] = [None, []]
+
+        waiting = entry[1]
+
+        def cancel(d):
+            waiting.remove(d)
+            d.errback(Fault(CANCELLED_ERROR, 'Call cancelled.'))
+            if not waiting:
+                entry[0].cancel()
+
+        d = defer.Deferred(cancel)
+        waiting.append(d)
+
+        if entry[0] is None:
+            def done(result):
+                if cache.pending.get(key) is entry:
+                    del cache.pending[key]
+                if not isinstance(result, Failure):
+                    cache.set(key, method, result)
+
+                for d in waiting:
+                    if isinstance(result, Failure):
+                        d.errback(result)
+                    else:
+                        d.callback(result)
+
+            entry[0] = self.remote.call(method, *args, **kwargs)
+            entry[0].addBoth(done)
+
+        return d
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        if not self.connected:
+            return defer.fail(Fault(TRANSPORT_ERROR, 'Not connected.'))
+
+        return self.remote.call_timeout(timeout, method, *args, **kwargs)
+
+    def call_many(self, calls, timeout=None):
+        if not self.connected:
+            return [defer.fail(Fault(TRANSPORT_ERROR, 'Not connected.')) for call in calls]
+
+        return self.remote.call_many(calls, timeout)
+
+    def call_stream(self, callback, method, *args, **kwargs):
+        if not self.connected:
+            return defer.fail(Fault(TRANSPORT_ERROR, 'Not connected.'))
+
+        return self.remote.call_stream(callback, method, *args, **kwargs)
+
+
+class ClusterClient(object):
+    """ Spreads calls over SocketRPCClients connected to many replicas
+    of a server.
+
+    Calls go to the healthy replica with the fewest outstanding calls
+    (policy="outstanding") or the lowest moving average latency weighted
+    by them (policy="ewma"). A replica which lost its connection or had
+    maxFailures transport errors or timeouts in a row leaves the rotation,
+    it gets reconnected and probed with probeMethod after the backoff of
+    the "client" factory and comes back once a probe succeeds.
+
+    With a socketrpc.HedgePolicy calls of its methods which got no reply
+    within the method's delay get sent to a second replica as well. The
+    first reply wins and the other call gets cancelled, transport errors
+    and timeouts only count once no other call is left.
+    """
+
+    client = SocketRPCClient
+
+    """ Transport errors or timeouts in a row
+    which take a replica out of rotation
+    """
+    maxFailures = 3
+
+    """ Method and timeout of the probe call, every
+    protocol has the built-in "stats"
+    """
+    probeMethod = 'stats'
+    probeTimeout = 5.0
+
+    def __init__(self, addresses, protocol=SocketRPCProtocol, timeout=30, callTimeout=None,
+                 policy='outstanding', hedge=None):
+        self.replicas = ReplicaSet(policy)
+        self.hedge = hedge
+        self.closed = False
+
+        # {<replica>: <DelayedCall>} of the scheduled probes
+        self._probes = {}
+
+        for address in addresses:
+            factory = self.client()
+            factory.protocol = protocol
+            factory.callTimeout = callTimeout
+            replica = self.replicas.add(address, factory)
+
+            # We reconnect, see _reconnect
+            factory.continueTrying = False
+            self._hook(replica)
+
+            connect(address, factory, timeout)
+
+    def _hook(self, replica):
+        """ Chains the connection events of replica's factory to ours.
+        """
+        factory = replica.client
+        made, failed, lost = factory.clientConnectionMade, factory.clientConnectionFailed, factory.clientConnectionLost
+
+        def clientConnectionMade(protocol):
+            made(protocol)
+            if not replica.healthy and replica not in self._probes:
+                self._probe(replica)
+
+        def clientConnectionFailed(connector, reason):
+            failed(connector, reason)
+            if replica.healthy:
+                self._down(replica)
+            elif replica not in self._probes:
+                self._schedule(replica)
+
+        def clientConnectionLost(connector, reason):
+            lost(connector, reason)
+            self._down(replica)
+
+        factory.clientConnectionMade = clientConnectionMade
+        factory.clientConnectionFailed = clientConnectionFailed
+        factory.clientConnectionLost = clientConnectionLost
+
+    def _outstanding(self, replica):
+        factory = replica.client
+        if not factory.connected:
+            return None
+
+        return len(factory.remote.calls)
+
+    def _choose(self):
+        return self.replicas.choose(self._outstanding)
+
+    def _track(self, replica, d, method):
+        """ Observes the outcome of Deferred d, a call of method, on replica.
+        """
+        start = time.time()
+
+        def done(result):
+            fault = isinstance(result, Failure) and result.value or None
+            code = getattr(fault, 'faultCode', None)
+            if code == CANCELLED_ERROR:
+                return result
+
+            if code not in (TRANSPORT_ERROR, TIMEOUT_ERROR):
+                seconds = time.time() - start
+                replica.succeeded(seconds)
+                if self.hedge is not None:
+                    self.hedge.observe(method, seconds)
+            elif replica.failed() >= self.maxFailures or not replica.client.connected:
+                self._down(replica)
+
+            return result
+
+        d.addBoth(done)
+        return d
+
+    def _down(self, replica):
+        """ Takes replica out of rotation and schedules its probe.
+        """
+        if not replica.healthy or self.closed:
+            return
+
+        self._schedule(replica)
+
+    def _schedule(self, replica):
+        from twisted.internet import reactor
+
+        delay = replica.down(self.client)
+        if delay is None:
+            log.msg('Giving up on %s:%s after %d probes' % (address_tuple(replica.address) + (replica.retries - 1,)))
+            return
+
+        log.msg('%s:%s out of rotation, probing in %.1f seconds' % (address_tuple(replica.address) + (delay,)))
+        self._probes[replica] = reactor.callLater(delay, self._reconnect, replica)
+
+    def _reconnect(self, replica):
+        """ Probes replica, connects it first if needed (clientConnectionMade
+        probes then, clientConnectionFailed schedules the next try).
+        """
+        del self._probes[replica]
+        factory = replica.client
+        if factory.connected:
+            self._probe(replica)
+        else:
+            factory.connector.connect()
+
+    def _probe(self, replica):
+        d = replica.client.call_timeout(self.probeTimeout, self.probeMethod)
+        d.addBoth(self._probeCb, replica)
+
+    def _probeCb(self, result, replica):
+        if self.closed:
+            return
+
+        fault = isinstance(result, Failure) and result.value or None
+        if getattr(fault, 'faultCode', None) in (TRANSPORT_ERROR, TIMEOUT_ERROR):
+            self._schedule(replica)
+            return
+
+        log.msg('%s:%s back in rotation' % address_tuple(replica.address))
+        replica.up()
+
+    def _send(self, replica, timeout, method, args, kwargs):
+        if timeout is None:
+            d = replica.client.call(method, *args, **kwargs)
+        else:
+            d = replica.client.call_timeout(timeout, method, *args, **kwargs)
+
+        return self._track(replica, d, method)
+
+    def _hedged(self, replica, delay, timeout, method, args, kwargs):
+        """ Sends the call to replica, after delay seconds without
+        a reply to a second one as well. Cancelling the returned
+        Deferred cancels both.
+        """
+        from twisted.internet import reactor
+
+        hedge = self.hedge
+        pending = []
+        # The winning call, once there is one
+        settled = []
+        finished = defer.Deferred(lambda d: [call.cancel() for call in list(pending)])
+
+        def settle(result, call):
+            pending.remove(call)
+            if finished.called or settled:
+                return None
+
+            fault = isinstance(result, Failure) and result.value or None
+            if getattr(fault, 'faultCode', None) in (TRANSPORT_ERROR, TIMEOUT_ERROR, CANCELLED_ERROR) and pending:
+                # The other call may still get a reply
+                return None
+
+            if timer.active():
+                timer.cancel()
+            if call is not first:
+                hedge.won += 1
+
+            # Before the callbacks of finished run
+            settled.append(call)
+            for other in list(pending):
+                other.cancel()
+
+            if fault is None:
+                finished.callback(result)
+            else:
+                finished.errback(result)
+
+        def send_hedge():
+            if finished.called:
+                return
+
+            second = self.replicas.choose(self._outstanding, exclude=replica)
+            if second is None or not hedge.allow():
+                return
+
+            d = self._send(second, timeout, method, args, kwargs)
+            pending.append(d)
+            d.addBoth(settle, d)
+
+        timer = reactor.callLater(delay, send_hedge)
+        first = self._send(replica, timeout, method, args, kwargs)
+        pending.append(first)
+        first.addBoth(settle, first)
+
+        return finished
+
+    def call(self, method, *args, **kwargs):
+        return self.call_timeout(None, method, *args, **kwargs)
+
+    def call_timeout(self, timeout, method, *args, **kwargs):
+        """ Like call with a timeout (None: the factory's callTimeout).
+        """
+        replica = self._choose()
+        if replica is None:
+            return defer.fail(Fault(TRANSPORT_ERROR, 'No healthy replica.'))
+
+        delay = None
+        if self.hedge is not None:
+            delay = self.hedge.delay(method)
+
+        if delay is None:
+            return self._send(replica, timeout, method, args, kwargs)
+
+        return self._hedged(replica, delay, timeout, method, args, kwargs)
+
+    def call_many(self, calls, timeout=None):
+        replica = self._choose()
+        if replica is None:
+            return [defer.fail(Fault(TRANSPORT_ERROR, 'No healthy replica.')) for call in calls]
+
+        results = replica.client.call_many(calls, timeout)
+        return [self._track(replica, d, call[0]) for call, d in zip(calls, results)]
+
+    def call_stream(self, callback, method, *args, **kwargs):
+        replica = self._choose()
+        if replica is None:
+            return defer.fail(Fault(TRANSPORT_ERROR, 'No healthy replica.'))
+
+        return replica.client.call_stream(callback, method, *args, **kwargs)
+
+    def outstanding(self):
+        """ Returns the number of outstanding calls per replica,
+        None for replicas which aren't connected.
+        """
+        result = []
+        for replica in self.replicas:
+            factory = replica.client
+            if factory.connected:
+                result.append(len(factory.remote.calls))
+            else:
+                result.append(None)
+
+        return result
+
+    def stats(self):
+        """ Returns health, latency average and counters by replica address.
+        """
+        return self.replicas.stats()
+
+    def close(self):
+        """ Stops probing and reconnecting, drops the connections.
+        """
+        self.closed = True
+        for probe in self._probes.values():
+            if probe.active():
+                probe.cancel()
+
+        self._probes = {}
+        for replica in self.replicas:
+            factory = replica.client
+            factory.stopTrying()
+            connector = getattr(factory, 'connector', None)
+            if connector is not None:
+                connector.disconnect()
+
+def listen(address, factory, backlog=50):
+    """ Listens with factory on address, (<host>, <port>)
+    or "unix:<path>". Returns the IListeningPort.
+    """
+    from twisted.internet import reactor
+
+    path = unix_path(address)
+    if path is not None:
+        return reactor.listenUNIX(path, factory, backlog=backlog)
+
+    return reactor.listenTCP(address[1], factory, backlog=backlog, interface=address[0])
+
+def connect(address, factory, timeout=30):
+    """ Connects factory (e.g. a SocketRPCClient) to address,
+    (<host>, <port>) or "unix:<path>". Returns the IConnector.
+    """
+    from twisted.internet import reactor
+
+    path = unix_path(address)
+    if path is not None:
+        return reactor.connectUNIX(path, factory, timeout=timeout)
+
+    return reactor.connectTCP(address[0], address[1], factory, timeout=timeout)
+
+def socketpair():
+    """ Returns two connected Unix sockets, create them before forking
+    and pass one to connect_socket in the parent, the other one in
+    the child. Either side can call the other.
+    """
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+def connect_socket(sock, factory):
+    """ Runs a protocol of factory on the connected socket sock (see
+    socketpair), a SocketRPCClient gets it as "remote". sock gets
+    closed, the reactor keeps a duplicate of it.
+    """
+    from twisted.internet import reactor
+
+    reactor.adoptStreamConnection(sock.fileno(), socket.AF_UNIX, factory)
+    sock.close()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+""" Loopback tests of the backends, a server and a client
+protocol on the two ends of a socketpair().
+
+    $ python -m unittest discover     # gevent, Twisted, shared code
+    $ python3 -m unittest discover    # asyncio, shared code
+"""
+
+import logging
+
+# The protocols log lost connections and crashed handlers
+logging.getLogger().addHandler(logging.NullHandler())
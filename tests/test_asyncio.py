@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from socketrpc import Fault, APPLICATION_ERROR, CANCELLED_ERROR, TIMEOUT_ERROR
+
+try:
+    # The backend needs Python >= 3.7
+    import asyncio
+    from socketrpc.asyncio_srpc import SocketRPCProtocol, SocketRPCServer, SocketRPCClient, \
+                                       socketpair, connect_socket, set_serializer
+except (ImportError, SyntaxError):
+    asyncio = None
+    SocketRPCProtocol = object
+
+
+class EchoProtocol(SocketRPCProtocol):
+    def docall_echo(self, value):
+        return value
+
+    def docall_unserializable(self):
+        return object()
+
+    def docall_fail(self):
+        raise ValueError('fail')
+
+    def docall_numbers(self, count):
+        return iter(range(count))
+
+    def docall_slow(self, value):
+        # Awaitables returned by methods get awaited
+        return asyncio.sleep(0.1, result=value)
+
+
+@unittest.skipIf(asyncio is None, 'The asyncio backend needs Python >= 3.7')
+class LoopbackTestCase(unittest.TestCase):
+    """ A server protocol and a client protocol connected by a
+    socketpair, the tests run coroutines and futures with wait().
+    """
+
+    serverProtocol = EchoProtocol
+    clientProtocol = EchoProtocol
+
+    def setUp(self):
+        set_serializer('json')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        a, b = socketpair()
+        self.server = self.wait(connect_socket(a, self.serverProtocol))
+        self.client = self.wait(connect_socket(b, self.clientProtocol))
+
+    def tearDown(self):
+        for proto in (self.client, self.server):
+            if proto.transport is not None:
+                proto.transport.close()
+
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def wait(self, awaitable, timeout=5):
+        return self.loop.run_until_complete(asyncio.wait_for(awaitable, timeout))
+
+    def assertFault(self, awaitable, code):
+        try:
+            self.wait(awaitable)
+        except Fault as e:
+            self.assertEqual(e.faultCode, code)
+        else:
+            self.fail('No Fault')
+
+    def collect(self, stream):
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.wait(stream.__anext__()))
+            except StopAsyncIteration:
+                return chunks
+
+
+class CallTest(LoopbackTestCase):
+    def test_call(self):
+        self.assertEqual(self.wait(self.client.call('echo', 'hello')), 'hello')
+
+    def test_server_calls_client(self):
+        self.assertEqual(self.wait(self.server.call('echo', [1, 2])), [1, 2])
+
+    def test_application_error(self):
+        self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+
+
+class BatchTest(LoopbackTestCase):
+    def test_call_many(self):
+        results = self.client.call_many([('echo', ['a']), ('echo', ['b'])])
+        self.assertEqual([self.wait(result) for result in results], ['a', 'b'])
+
+    def test_errors_fail_alone(self):
+        results = self.client.call_many([('echo', ['a']), ('fail', []), ('missing', [])])
+        self.assertEqual(self.wait(results[0]), 'a')
+        self.assertFault(results[1], APPLICATION_ERROR)
+        self.assertRaises(Fault, self.wait, results[2])
+
+    def test_unserializable_reply_fails_alone(self):
+        results = self.client.call_many([('echo', ['a']), ('unserializable', [])])
+        self.assertEqual(self.wait(results[0]), 'a')
+        self.assertFault(results[1], APPLICATION_ERROR)
+
+
+class StreamTest(LoopbackTestCase):
+    def test_call_stream(self):
+        stream = self.client.call_stream('numbers', 100)
+        self.assertEqual(stream.id, self.client.id)
+        self.assertEqual(self.collect(stream), list(range(100)))
+
+    def test_cancel(self):
+        stream = self.client.call_stream('numbers', 100)
+        self.assertTrue(stream.cancel())
+        self.assertNotIn(stream.id, self.client.calls)
+        self.assertFault(stream.__anext__(), CANCELLED_ERROR)
+
+
+class ZlibProtocol(EchoProtocol):
+    compression = ['zlib']
+
+
+class CompressionTest(LoopbackTestCase):
+    serverProtocol = ZlibProtocol
+    clientProtocol = ZlibProtocol
+
+    def test_compressed(self):
+        value = 'x' * 100000
+        self.assertEqual(self.wait(self.client.call('echo', value)), value)
+        self.assertEqual(self.client.handshake.send, {'compression': 'zlib'})
+        self.assertEqual(self.client.handshake.recv, {'compression': 'zlib'})
+        self.assertTrue(self.client.stats()['bytes_out'] < 10000)
+
+
+class OneSidedCompressionTest(LoopbackTestCase):
+    clientProtocol = ZlibProtocol
+
+    def test_uncompressed(self):
+        value = 'x' * 100000
+        self.assertEqual(self.wait(self.client.call('echo', value)), value)
+        self.assertEqual(self.client.handshake.send, {})
+        self.assertTrue(self.client.stats()['bytes_out'] > 100000)
+
+
+class Version2Protocol(EchoProtocol):
+    messageVersion = 2
+
+
+class Version2Test(LoopbackTestCase):
+    serverProtocol = Version2Protocol
+    clientProtocol = Version2Protocol
+
+    def test_messages(self):
+        self.assertEqual(self.wait(self.client.call('echo', [1, 'a'])), [1, 'a'])
+        self.assertEqual((self.client._sendVersion, self.client._recvVersion), (2, 2))
+        self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+        self.assertEqual(self.collect(self.client.call_stream('numbers', 10)), list(range(10)))
+
+        results = self.client.call_many([('echo', ['a']), ('echo', ['b'])])
+        self.assertEqual([self.wait(result) for result in results], ['a', 'b'])
+
+
+class OneSidedVersion2Test(LoopbackTestCase):
+    clientProtocol = Version2Protocol
+
+    def test_version_1(self):
+        self.assertEqual(self.wait(self.client.call('echo', 'a')), 'a')
+        self.assertEqual((self.client._sendVersion, self.client._recvVersion), (1, 1))
+
+
+class InternProtocol(EchoProtocol):
+    internMethods = True
+
+    def find_method(self, method):
+        self.__dict__.setdefault('asked', []).append(method)
+        return EchoProtocol.find_method(self, method)
+
+
+class InternTest(LoopbackTestCase):
+    serverProtocol = InternProtocol
+    clientProtocol = InternProtocol
+
+    def test_interned(self):
+        self.assertEqual(self.wait(self.client.call('echo', 'a')), 'a')
+        self.assertEqual(self.wait(self.client.call('echo', 'b')), 'b')
+        self.assertEqual(set(self.server.asked), set([self.server._methodNames.index('echo')]))
+
+    def test_unlisted_by_name(self):
+        self.assertRaises(Fault, self.wait, self.client.call('missing'))
+        self.assertEqual(set(self.server.asked), set(['missing']))
+
+
+class MarshalProtocol(EchoProtocol):
+    serializers = ['marshal', 'json']
+
+
+class JSONProtocol(EchoProtocol):
+    serializers = ['json', 'marshal']
+
+
+class SerializerTest(LoopbackTestCase):
+    serverProtocol = JSONProtocol
+    clientProtocol = MarshalProtocol
+
+    def test_own_choice(self):
+        self.assertEqual(self.wait(self.client.call('echo', [1, 'a'])), [1, 'a'])
+        self.assertEqual((self.client._sendSerializer, self.client._recvSerializer), ('marshal', 'json'))
+        self.assertEqual(set(self.client.stats()['serializers']), set(['marshal', 'json']))
+
+
+class DeadlineTest(LoopbackTestCase):
+    def test_call_timeout(self):
+        self.assertFault(self.client.call_timeout(0.02, 'slow', 'a'), TIMEOUT_ERROR)
+        self.assertEqual(self.client.calls, {})
+        self.assertEqual(self.client.callsExpired, 1)
+        self.assertEqual(self.wait(self.client.call_timeout(5, 'echo', 'b')), 'b')
+
+    def test_default_timeout(self):
+        self.client.callTimeout = 0.02
+        self.assertFault(self.client.call('slow', 'a'), TIMEOUT_ERROR)
+
+    def test_cancel(self):
+        result = self.client.call('slow', 'a')
+        self.assertTrue(self.client.cancel(self.client.id))
+        self.assertFalse(self.client.cancel(self.client.id))
+        self.assertFault(result, CANCELLED_ERROR)
+
+        result = self.client.call('slow', 'b')
+        result.cancel()
+        self.wait(asyncio.sleep(0))
+        self.assertEqual(self.client.calls, {})
+        self.assertEqual(self.client.callsCancelled, 2)
+
+        # The server drops their replies
+        self.wait(asyncio.sleep(0.2))
+        self.assertEqual(self.server.callsSkipped, 2)
+        self.assertEqual(self.client.lateReplies, 0)
+
+    def test_late_reply(self):
+        # The server doesn't know this deadline, it answers after all
+        result = self.client.call('slow', 'a')
+        self.client.track_deadline(self.client.id, 0.02)
+        self.assertFault(result, TIMEOUT_ERROR)
+
+        self.wait(asyncio.sleep(0.2))
+        self.assertEqual(self.client.lateReplies, 1)
+
+    def test_expired_call_skipped(self):
+        self.wait(self.server.dispatch_call('echo', 1000, ['a'], {}, time.time() - 1))
+        self.assertEqual(self.server.callsSkipped, 1)
+
+    def test_expired_batch_entry_skipped(self):
+        received = time.time() - 1
+        self.wait(self.server.dispatch_batch([{'call': ['echo', ['late'], {}, 1000, 0.5]},
+                                              {'call': ['echo', ['early'], {}, 1001, 5.0]}], received))
+        self.assertEqual(self.server.callsSkipped, 1)
+        self.assertEqual(self.server.metrics.snapshot()['server']['echo']['count'], 1)
+
+
+class MetricsTest(LoopbackTestCase):
+    def test_stats(self):
+        self.assertEqual(self.wait(self.client.call('echo', 'a')), 'a')
+        self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+
+        stats = self.client.stats()
+        self.assertEqual(stats['client']['echo']['count'], 1)
+        self.assertEqual(stats['client']['fail']['errors'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['frames_out'], 2)
+
+        stats = self.wait(self.client.call('stats'))
+        self.assertEqual(stats['server']['echo']['count'], 1)
+        self.assertFalse('total' in stats)
+
+
+class ClientTest(LoopbackTestCase):
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.listener = SocketRPCServer(('127.0.0.1', 0), EchoProtocol)
+        server = self.wait(self.listener.start())
+        self.remote = SocketRPCClient(server.sockets[0].getsockname(), EchoProtocol)
+
+    def tearDown(self):
+        self.remote.close()
+        self.listener.close()
+        LoopbackTestCase.tearDown(self)
+
+    def test_call_stream_waits_for_connection(self):
+        stream = self.remote.call_stream('numbers', 10)
+        call = self.remote.call('echo', 'a')
+        self.wait(self.remote.connect())
+        self.assertEqual(self.collect(stream), list(range(10)))
+        self.assertEqual(self.wait(call), 'a')
+
+    def test_server_total(self):
+        self.wait(self.remote.connect())
+        self.assertEqual(self.wait(self.remote.call('echo', 'a')), 'a')
+        stats = self.wait(self.remote.call('stats'))
+        self.assertEqual(stats['total']['server']['echo']['count'], 1)
+
+
+class UnixTest(LoopbackTestCase):
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.sock')
+        self.listener = SocketRPCServer('unix:' + self.path, EchoProtocol)
+        self.wait(self.listener.start())
+        self.remote = SocketRPCClient('unix:' + self.path, EchoProtocol)
+
+    def tearDown(self):
+        self.remote.close()
+        self.listener.close()
+        LoopbackTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_call(self):
+        self.wait(self.remote.connect())
+        self.assertEqual(self.wait(self.remote.call('echo', 'a')), 'a')
+        self.assertEqual([protocol.address for protocol in self.listener.protocols], [('unix', self.path)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+import os
+import sys
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('The benchmark is Python 2 only')
+
+from socketrpc.bench import payload, percentiles, SMALL_PARAMS
+from socketrpc.bench.runner import CSV_HEADER, case_requests, format_row, process_usage, run_case, run_matrix
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+
+class HelperTest(unittest.TestCase):
+    def test_payload(self):
+        self.assertEqual(payload(0), SMALL_PARAMS)
+        self.assertEqual(payload(100), 'x' * 100)
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles([]), [0.0, 0.0, 0.0])
+        latencies = [i / 1000.0 for i in range(101, 0, -1)]
+        self.assertEqual(percentiles(latencies), [0.051, 0.091, 0.1])
+        self.assertEqual(percentiles([0.5], (50, 99)), [0.5, 0.5])
+
+    def test_case_requests(self):
+        self.assertEqual(case_requests(0, 1000, 1024), 1000)
+        self.assertEqual(case_requests(100, 1000, None), 1000)
+        self.assertEqual(case_requests(100, 1000, 10000), 100)
+        # Never less than 10
+        self.assertEqual(case_requests(10000, 1000, 10000), 10)
+
+    def test_format_row(self):
+        self.assertEqual(format_row(['gevent', u'say "hi"', 1.005, 0.5, 42]),
+                         '"gevent"\t"say ""hi"""\t1,00\t0,50\t42')
+
+    def test_process_usage(self):
+        usage = process_usage(os.getpid())
+        if usage is None:
+            self.skipTest('No /proc file system')
+
+        user, system, rss = usage
+        self.assertTrue(user >= 0.0 and system >= 0.0)
+        self.assertTrue(rss > 0)
+        self.assertEqual(process_usage(2 ** 22 + 1), None)
+
+
+@unittest.skipIf(gevent is None, 'gevent is not installed')
+class RunTest(unittest.TestCase):
+    def test_run_case(self):
+        for transport in ('tcp', 'unix'):
+            result = run_case('gevent', 'gevent', 'json', 'parallel', 100, 20, 4, transport)
+            self.assertEqual(result['calls'], 20)
+            self.assertEqual(len(result['percentiles']), 3)
+            self.assertTrue(result['server_rss'] > 0)
+
+    def test_run_matrix(self):
+        progress = []
+        rows = list(run_matrix(['gevent'], ['gevent', 'sync'], ['json', 'nonexistent'], ['serial'], [0], 10, 2,
+                               progress=progress.append))
+        self.assertEqual([row[:4] for row in rows], [['gevent', 'gevent', 'Socketrpc-json', 'serial'],
+                                                     ['gevent', 'sync', 'Socketrpc-json', 'serial']])
+        self.assertEqual(len(rows[0]), len(CSV_HEADER))
+        # "Mem" is the server's, like in the historical rows
+        self.assertEqual(CSV_HEADER[7], 'Mem')
+        self.assertTrue(rows[0][7] > 0)
+        self.assertTrue(rows[0][CSV_HEADER.index('Client Mem')] > 0)
+        self.assertEqual(progress[-1], 'nonexistent skipped: not available\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
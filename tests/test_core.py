@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from socketrpc import STRUCT_INT, FRAME_COMPRESSED, FRAME_CONTROL, FRAME_LENGTH, MESSAGE_HEADER, FrameBuffer, tobytes
+from socketrpc import rpcmethod, dispatch_table, bind_dispatch, Handshake, SERIALIZERS, Fault
+from socketrpc import encode_message, decode_message, register_serializer, call_deadline, DeadlineHeap, \
+                      Metrics, unix_path, address_tuple, peer_address
+from socketrpc import Replica, ReplicaSet, HedgePolicy, ResultCache
+
+import json
+
+
+def frame(payload, flags=0):
+    return STRUCT_INT.pack(flags | len(payload)) + payload
+
+
+class FrameBufferTest(unittest.TestCase):
+    def feed(self, buf, data):
+        return [(flags, tobytes(payload)) for flags, payload in buf.feed(data)]
+
+    def test_whole_frames(self):
+        data = frame(b'abc') + frame(b'', FRAME_CONTROL) + frame(b'de', FRAME_COMPRESSED)
+        self.assertEqual(self.feed(FrameBuffer(), data),
+                         [(0, b'abc'), (FRAME_CONTROL, b''), (FRAME_COMPRESSED, b'de')])
+
+    def test_split_frames(self):
+        data = frame(b'hello') + frame(b'x' * 100) + frame(b'world')
+        buf = FrameBuffer()
+
+        received = []
+        for i in range(len(data)):
+            received.extend(self.feed(buf, data[i:i + 1]))
+
+        self.assertEqual(received, [(0, b'hello'), (0, b'x' * 100), (0, b'world')])
+        self.assertEqual(len(buf), 0)
+
+    def test_partial_tail(self):
+        data = frame(b'abc') + frame(b'defgh')
+        buf = FrameBuffer()
+        self.assertEqual(self.feed(buf, data[:9]), [(0, b'abc')])
+        self.assertEqual(len(buf), 2)
+        self.assertEqual(self.feed(buf, data[9:]), [(0, b'defgh')])
+
+
+class Methods(object):
+    def docall_plain(self):
+        return 'plain'
+
+    @rpcmethod('tools.named')
+    def named(self):
+        return 'named'
+
+    @rpcmethod(inline=True, offload=True)
+    def docall_flagged(self):
+        return 'flagged'
+
+    def helper(self):
+        pass
+
+
+class DispatchTableTest(unittest.TestCase):
+    def test_table(self):
+        self.assertEqual(dispatch_table(Methods), {'plain': ('docall_plain', False, False),
+                                                   'tools.named': ('named', False, False),
+                                                   'flagged': ('docall_flagged', True, True),
+                                                  })
+        self.assertTrue(dispatch_table(Methods) is dispatch_table(Methods))
+
+    def test_bind(self):
+        dispatch = bind_dispatch(Methods())
+        self.assertEqual(sorted((name, entry[0]()) for name, entry in dispatch.items()),
+                         [('flagged', 'flagged'), ('plain', 'plain'), ('tools.named', 'named')])
+
+
+def handshake(ours, theirs):
+    """ Runs the handshake of two offers, returns both Handshakes.
+    """
+    a, b = Handshake(ours), Handshake(theirs)
+    use_a = a.received(b.hello())
+    use_b = b.received(a.hello())
+    a.received(use_b)
+    b.received(use_a)
+
+    return a, b
+
+
+class CompressionNegotiationTest(unittest.TestCase):
+    def test_common(self):
+        a, b = handshake({'compression': ['nonexistent', 'zlib']}, {'compression': ['zlib']})
+        self.assertEqual(a.send, {'compression': 'zlib'})
+        self.assertEqual(b.recv, {'compression': 'zlib'})
+        self.assertTrue(a.used and b.used)
+
+    def test_nothing_in_common(self):
+        a, b = handshake({'compression': ['zlib']}, {'compression': ['nonexistent']})
+        self.assertEqual(a.send, {})
+        self.assertEqual(b.send, {})
+
+    def test_no_offer(self):
+        a = Handshake({})
+        self.assertEqual(a.hello(), None)
+        self.assertEqual(a.received(Handshake({'compression': ['zlib']}).hello()), None)
+
+
+class Huge(object):
+    """ Stands in for an encoded message larger than a frame.
+    """
+
+    length = FRAME_LENGTH + 1
+
+    def __len__(self):
+        return self.length
+
+
+class MessageTest(unittest.TestCase):
+    messages = [('call', ['echo', ['a', 1], {'b': 2}, 7]),
+                ('call', ['echo', [], {}, 8, 2.5]),
+                ('reply', [0, {'a': [1, 2]}, 7]),
+                ('reply', [-32500, 'error', 8]),
+                ('stream', [9, 'chunk']),
+                ('stream_end', [0, None, 9]),
+                ('stream_credit', [9, 4]),
+                ('batch', [{'call': ['echo', ['a'], {}, 10]}, {'reply': [0, 'b', 3]}]),
+               ]
+
+    def roundtrip(self, version, serializer='json'):
+        encode, decode, documents = SERIALIZERS[serializer]
+        for transaction, obj in self.messages:
+            data = encode_message(encode, transaction, obj, version, documents)
+            self.assertFalse(isinstance(data, Fault))
+            self.assertEqual(decode_message(decode, data, version, documents), (transaction, obj))
+
+    def test_version_1(self):
+        self.roundtrip(1)
+
+    def test_version_2(self):
+        self.roundtrip(2)
+
+    def test_version_2_documents(self):
+        if 'bson' not in SERIALIZERS:
+            self.skipTest('bson is not installed')
+
+        self.roundtrip(2, 'bson')
+
+    def test_version_2_smaller(self):
+        encode = SERIALIZERS['json'][0]
+        obj = ['echo', ['a'], {}, 12345]
+        self.assertTrue(len(encode_message(encode, 'call', obj, 2)) < len(encode_message(encode, 'call', obj, 1)))
+
+    def test_oversized(self):
+        huge = Huge()
+        for version in (1, 2):
+            fault = encode_message(lambda obj: huge, 'reply', [0, 'x', 1], version)
+            self.assertTrue(isinstance(fault, Fault))
+
+        # Just fits
+        huge.length = FRAME_LENGTH - MESSAGE_HEADER.size
+        self.assertTrue(encode_message(lambda obj: huge, 'reply', [0, 'x', 1], 1) is huge)
+
+    def test_broken_header(self):
+        decode = SERIALIZERS['json'][1]
+        self.assertTrue(isinstance(decode_message(decode, b'\x01', 2), Fault))
+        self.assertTrue(isinstance(decode_message(decode, b'\xff' * 10, 2), Fault))
+
+    def test_negotiation(self):
+        a, b = handshake({'version': 2}, {'version': 2})
+        self.assertEqual(a.send, {'version': 2})
+        self.assertEqual(b.recv, {'version': 2})
+
+        a, b = handshake({'version': 2}, {'compression': ['zlib']})
+        self.assertEqual(a.send, {})
+        self.assertEqual(b.recv, {})
+
+
+class SerializerTest(unittest.TestCase):
+    def test_negotiation(self):
+        a, b = handshake({'serializers': ['marshal', 'json']}, {'serializers': ['json', 'marshal']})
+        self.assertEqual(a.send, {'serializer': 'marshal'})
+        self.assertEqual(b.send, {'serializer': 'json'})
+        self.assertEqual(a.recv, {'serializer': 'json'})
+
+    def test_unknown(self):
+        a, b = handshake({'serializers': ['nonexistent', 'json']}, {'serializers': ['nonexistent']})
+        self.assertEqual(a.send, {})
+        self.assertEqual(b.send, {})
+
+    def test_register(self):
+        register_serializer('test-json', lambda obj: json.dumps(obj).encode('utf-8'),
+                            lambda data: json.loads(data.decode('utf-8')))
+        try:
+            encode, decode, documents = SERIALIZERS['test-json']
+            data = encode_message(encode, 'reply', [0, [1, 'a'], 3], 2)
+            # Copied out of receive buffers unless it takes buffers
+            self.assertEqual(decode_message(decode, memoryview(data), 2), ('reply', [0, [1, 'a'], 3]))
+        finally:
+            del SERIALIZERS['test-json']
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_heap(self):
+        heap = DeadlineHeap()
+        self.assertEqual(heap.earliest(), None)
+        self.assertTrue(heap.push(10.0, 1))
+        self.assertFalse(heap.push(12.0, 2))
+        self.assertTrue(heap.push(9.0, 3))
+        self.assertEqual(heap.earliest(), 9.0)
+
+        self.assertEqual(heap.expired(10.0), [3, 1])
+        self.assertEqual(heap.expired(11.0), [])
+        self.assertEqual(len(heap), 1)
+
+    def test_compact(self):
+        heap = DeadlineHeap()
+        for id in range(10):
+            heap.push(float(id), id)
+
+        heap.compact(set([4, 7]))
+        self.assertEqual(len(heap), 2)
+        self.assertEqual(heap.expired(100.0), [4, 7])
+
+    def test_call_deadline(self):
+        self.assertEqual(call_deadline(['echo', [], {}, 1]), None)
+        self.assertEqual(call_deadline(['echo', [], {}, 1, None]), None)
+        self.assertEqual(call_deadline(['echo', [], {}, 1, 2.5], 100.0), 102.5)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class MetricsTest(unittest.TestCase):
+    def test_calls(self):
+        clock = Clock()
+        metrics = Metrics(buckets=(0.1, 1.0), clock=clock)
+        metrics.call_sent(1, 'echo')
+        metrics.call_sent(2, 'echo')
+        clock.now += 0.5
+        metrics.call_finished(1)
+        clock.now += 1.0
+        metrics.call_finished(2, True)
+        # Not pending (anymore)
+        metrics.call_finished(2)
+
+        echo = metrics.snapshot()['client']['echo']
+        self.assertEqual(echo['count'], 2)
+        self.assertEqual(echo['errors'], 1)
+        self.assertAlmostEqual(echo['seconds'], 2.0)
+        self.assertAlmostEqual(echo['max'], 1.5)
+        self.assertEqual(echo['histogram'], [0, 1, 1])
+
+    def test_calls_lost(self):
+        metrics = Metrics()
+        metrics.call_sent(1, 'echo')
+        metrics.calls_lost()
+        self.assertEqual(metrics.started, {})
+        self.assertEqual(metrics.snapshot()['client']['echo']['errors'], 1)
+
+    def test_merge(self):
+        a, b = Metrics(), Metrics()
+        a.observe('server', 'echo', 0.001)
+        b.observe('server', 'echo', 0.2, True)
+        b.observe('server', 'fail', 0.002, True)
+        a.serialized('json', 0.01)
+        b.serialized('json', 0.02, encoded=False)
+        a.received(1, 10)
+        b.sent(2, 20)
+
+        total = Metrics()
+        total.merge(a)
+        total.merge(b)
+        snapshot = total.snapshot()
+        self.assertEqual(snapshot['server']['echo']['count'], 2)
+        self.assertEqual(snapshot['server']['echo']['errors'], 1)
+        self.assertEqual(snapshot['server']['echo']['max'], 0.2)
+        self.assertEqual(sum(snapshot['server']['echo']['histogram']), 2)
+        self.assertEqual(snapshot['server']['fail']['count'], 1)
+        self.assertEqual(snapshot['serializers']['json']['encoded'], 1)
+        self.assertEqual(snapshot['serializers']['json']['decoded'], 1)
+        self.assertEqual((snapshot['frames_in'], snapshot['bytes_in']), (1, 10))
+        self.assertEqual((snapshot['frames_out'], snapshot['bytes_out']), (2, 20))
+
+    def test_serializable(self):
+        metrics = Metrics()
+        metrics.observe('client', 'echo', 0.001)
+        snapshot = metrics.snapshot()
+        self.assertEqual(json.loads(json.dumps(snapshot)), snapshot)
+
+
+class AddressTest(unittest.TestCase):
+    def test_unix_path(self):
+        self.assertEqual(unix_path('unix:/run/test.sock'), '/run/test.sock')
+        self.assertEqual(unix_path(u'unix:relative.sock'), 'relative.sock')
+        self.assertEqual(unix_path(('127.0.0.1', 9990)), None)
+        self.assertEqual(unix_path('/run/test.sock'), None)
+
+    def test_address_tuple(self):
+        self.assertEqual(address_tuple('unix:/run/test.sock'), ('unix', '/run/test.sock'))
+        self.assertEqual(address_tuple(('::1', 9990, 0, 0)), ('::1', 9990))
+        self.assertEqual(address_tuple(['127.0.0.1', 9990]), ('127.0.0.1', 9990))
+
+    def test_peer_address(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'test.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            listener.listen(1)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            accepted = listener.accept()[0]
+            # Unnamed peers get the path of the listening socket
+            self.assertEqual(peer_address(accepted), ('unix', path))
+            self.assertEqual(peer_address(client), ('unix', path))
+            accepted.close()
+            client.close()
+        finally:
+            listener.close()
+            shutil.rmtree(directory)
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            client = socket.create_connection(listener.getsockname())
+            self.assertEqual(peer_address(client), listener.getsockname())
+            client.close()
+        finally:
+            listener.close()
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResultCache({'get': 10, 'other': 0}, max_entries=3, clock=self.clock)
+
+    def test_key(self):
+        cache = self.cache
+        self.assertEqual(cache.key('get', [1], {'b': 1, 'a': 2}), cache.key('get', [1], {'a': 2, 'b': 1}))
+        self.assertNotEqual(cache.key('get', [1], {}), cache.key('get', [2], {}))
+        # Not JSON serializable
+        self.assertEqual(cache.key('get', [object], {}), cache.key('get', [object], {}))
+
+    def test_ttl(self):
+        cache = self.cache
+        self.assertEqual(cache.get('a'), (False, None))
+        cache.set('a', 'get', [1])
+        cache.set('b', 'other', [2])
+        cache.set('c', 'unlisted', [3])
+        self.assertEqual(cache.get('a'), (True, [1]))
+        self.assertEqual(len(cache), 1)
+
+        self.clock.now += 10
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(cache.stats(), {'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 2, 'joined': 0,
+                                         'evictions': 0, 'expired': 1})
+
+    def test_lru(self):
+        cache = self.cache
+        for key in 'abc':
+            cache.set(key, 'get', key)
+        # "a" is the most recently used now
+        cache.get('a')
+        cache.set('d', 'get', 'd')
+
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual([cache.get(key)[0] for key in 'acd'], [True, True, True])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+        cache = ResultCache({'get': 10}, max_bytes=10, sizeof=len, clock=self.clock)
+        cache.set('a', 'get', 'x' * 4)
+        cache.set('b', 'get', 'x' * 4)
+        cache.set('a', 'get', 'x' * 5)
+        self.assertEqual(cache.bytes, 9)
+
+        cache.set('c', 'get', 'x' * 3)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.bytes, 8)
+
+        # Larger than the whole cache
+        cache.set('d', 'get', 'x' * 11)
+        self.assertEqual(cache.get('d'), (False, None))
+        self.assertEqual(len(cache), 2)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+
+class Backoff(object):
+    initialDelay = 1.0
+    factor = 2.0
+    jitter = 0
+    maxDelay = 3.0
+    maxRetries = 4
+
+
+class ReplicaTest(unittest.TestCase):
+    def test_latency(self):
+        replica = Replica(('127.0.0.1', 9990), None)
+        replica.succeeded(0.1)
+        self.assertEqual(replica.ewma, 0.1)
+        replica.succeeded(0.2)
+        self.assertAlmostEqual(replica.ewma, 0.13)
+        self.assertAlmostEqual(replica.score(2, 'ewma'), 0.39)
+        self.assertEqual(replica.score(2, 'outstanding'), 2)
+
+    def test_health(self):
+        replica = Replica(('127.0.0.1', 9990), None)
+        self.assertEqual([replica.failed() for i in range(3)], [1, 2, 3])
+        replica.succeeded(0.1)
+        self.assertEqual(replica.failures, 0)
+
+        self.assertEqual([replica.down(Backoff) for i in range(5)], [1.0, 2.0, 3.0, 3.0, None])
+        self.assertFalse(replica.healthy)
+        replica.up()
+        self.assertTrue(replica.healthy)
+        self.assertEqual(replica.down(Backoff), 1.0)
+        self.assertEqual(replica.stats(), {'healthy': False, 'ewma': 0.1, 'calls': 4, 'errors': 3, 'removed': 2})
+
+
+class ReplicaSetTest(unittest.TestCase):
+    def setUp(self):
+        self.replicas = ReplicaSet()
+        self.a = self.replicas.add(('10.0.0.1', 9990), None)
+        self.b = self.replicas.add(('10.0.0.2', 9990), None)
+        self.c = self.replicas.add('unix:/run/test.sock', None)
+        self.outstanding = {self.a: 2, self.b: 1, self.c: 3}
+
+    def choose(self, exclude=None):
+        return self.replicas.choose(self.outstanding.get, exclude)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, ReplicaSet, 'random')
+
+    def test_outstanding(self):
+        self.assertTrue(self.choose() is self.b)
+        self.assertTrue(self.choose(exclude=self.b) is self.a)
+
+        # Unhealthy and unconnected replicas get skipped
+        self.b.healthy = False
+        self.outstanding[self.a] = None
+        self.assertTrue(self.choose() is self.c)
+        self.c.healthy = False
+        self.assertEqual(self.choose(), None)
+
+    def test_ties_round_robin(self):
+        self.outstanding = dict.fromkeys(self.outstanding, 0)
+        self.assertEqual(set(self.choose() for i in range(3)), set([self.a, self.b, self.c]))
+
+    def test_ewma(self):
+        self.replicas.policy = 'ewma'
+        self.a.ewma, self.b.ewma, self.c.ewma = 0.01, 0.05, 0.01
+        # 0.03, 0.1 and 0.04
+        self.assertTrue(self.choose() is self.a)
+        # Without a reply yet it comes first
+        self.b.ewma = None
+        self.assertTrue(self.choose() is self.b)
+
+    def test_stats(self):
+        self.assertEqual(sorted(self.replicas.stats()), ['10.0.0.1:9990', '10.0.0.2:9990', 'unix:/run/test.sock'])
+
+
+class HedgePolicyTest(unittest.TestCase):
+    def test_delay(self):
+        hedge = HedgePolicy({'search': 0.05, 'get': None})
+        self.assertEqual(hedge.delay('other'), None)
+        self.assertEqual(hedge.delay('search'), 0.05)
+        self.assertEqual(hedge.delay('get'), None)
+
+        for i in range(100):
+            hedge.observe('get', i / 1000.0)
+        self.assertEqual(hedge.delay('get'), 0.095)
+        self.assertEqual(hedge.stats()['calls'], 3)
+
+    def test_budget(self):
+        hedge = HedgePolicy({'get': 0.0}, max_ratio=0.5, burst=2)
+        self.assertEqual([hedge.allow() for i in range(3)], [True, True, False])
+        hedge.delay('get')
+        hedge.delay('get')
+        self.assertEqual([hedge.allow() for i in range(2)], [True, False])
+        self.assertEqual((hedge.hedged, hedge.throttled), (3, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
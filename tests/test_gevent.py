@@ -0,0 +1,979 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('The gevent backend is Python 2 only')
+
+try:
+    import gevent
+except ImportError:
+    raise unittest.SkipTest('gevent is not installed')
+
+from socket import SHUT_WR, error as socket_error
+
+from gevent.event import AsyncResult
+
+from socketrpc import Fault, HedgePolicy, ResultCache, rpcmethod, APPLICATION_ERROR, CANCELLED_ERROR, METHOD_NOT_FOUND, \
+                      TIMEOUT_ERROR, OVERLOADED_ERROR, TRANSPORT_ERROR
+from socketrpc import STRUCT_INT, FRAME_COMPRESSED
+from socketrpc import gevent_srpc
+from socketrpc.gevent_srpc import SocketRPCProtocol, SocketRPCServer, SocketRPCPreforkServer, SocketRPCClient, \
+                                  SocketRPCClientPool, ClusterClient, HedgedResult, \
+                                  socketpair, connect_socket, set_serializer
+
+
+class EchoProtocol(SocketRPCProtocol):
+    def docall_echo(self, value):
+        return value
+
+    def docall_unserializable(self):
+        return object()
+
+    def docall_fail(self):
+        raise ValueError('fail')
+
+    @rpcmethod('tools.upper')
+    def upper(self, value):
+        return value.upper()
+
+    @rpcmethod('tools.length', inline=True)
+    def length(self, value):
+        return len(value)
+
+    def helper(self):
+        pass
+
+
+class TestCase(unittest.TestCase):
+    def assertFault(self, result, code):
+        try:
+            result.get(timeout=5)
+        except Fault as e:
+            self.assertEqual(e.faultCode, code)
+        else:
+            self.fail('No Fault')
+
+
+class LoopbackTestCase(TestCase):
+    """ A server protocol and a client protocol connected by a socketpair.
+    """
+
+    serverProtocol = EchoProtocol
+    clientProtocol = EchoProtocol
+
+    def setUp(self):
+        set_serializer('json')
+        a, b = socketpair()
+        self.server = connect_socket(a, self.serverProtocol)
+        self.client = connect_socket(b, self.clientProtocol)
+
+    def tearDown(self):
+        for proto in (self.client, self.server):
+            try:
+                proto.socket.shutdown(SHUT_WR)
+            except socket_error:
+                pass
+
+        gevent.sleep(0.01)
+
+
+class CallTest(LoopbackTestCase):
+    def test_call(self):
+        self.assertEqual(self.client.call('echo', 'hello').get(timeout=5), 'hello')
+
+    def test_server_calls_client(self):
+        self.assertEqual(self.server.call('echo', [1, 2]).get(timeout=5), [1, 2])
+
+    def test_application_error(self):
+        self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+
+    def test_unknown_method(self):
+        self.assertFault(self.client.call('missing'), METHOD_NOT_FOUND)
+        self.assertFault(self.client.call('helper'), METHOD_NOT_FOUND)
+
+    def test_named_method(self):
+        self.assertEqual(self.client.call('tools.upper', 'a').get(timeout=5), 'A')
+        self.assertEqual(self.client.call('tools.length', 'abc').get(timeout=5), 3)
+
+
+class WriteTest(LoopbackTestCase):
+    def test_coalescing(self):
+        # Queued without yielding, the writer sends them in one go
+        results = [self.client.call('echo', i) for i in range(50)]
+        self.assertEqual([result.get(timeout=5) for result in results], range(50))
+        self.assertEqual(self.client.writeFrames, 50)
+        self.assertTrue(self.client.writeBatches < 5)
+
+
+class ReceiveTest(LoopbackTestCase):
+    def test_frames_across_reads(self):
+        a, b = socketpair()
+        frames = [(0, 'x' * size) for size in (0, 3, 20, 100, 5)] + [(FRAME_COMPRESSED, 'abc')]
+        data = ''.join(STRUCT_INT.pack(flags | len(payload)) + payload for flags, payload in frames)
+
+        def send():
+            for i in range(0, len(data), 7):
+                a.sendall(data[i:i + 7])
+                gevent.sleep(0)
+            a.shutdown(SHUT_WR)
+
+        gevent.spawn(send)
+        # A buffer smaller than some frames gets compacted and grown
+        received = [(flags, payload.tobytes()) for flags, payload in gevent_srpc._recvframes(b, 16)]
+        self.assertEqual(received, frames)
+
+    def test_large_message(self):
+        value = 'x' * (3 * self.client.recvBufferSize + 1)
+        self.assertEqual(self.client.call('echo', value).get(timeout=5), value)
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+
+
+class ReconnectTest(LoopbackTestCase):
+    def test_stale_writer_stops_alone(self):
+        old = self.client.writeQueue
+        for proto in (self.client, self.server):
+            proto.socket.shutdown(SHUT_WR)
+        gevent.sleep(0.01)
+
+        a, b = socketpair()
+        self.server = connect_socket(a, self.serverProtocol)
+        self.client.make_connection(b, ('unix', ''), None)
+        gevent.spawn(self.client.handle_read)
+        gevent.spawn(self.client.handle_write)
+
+        # A late stop of the lost connection's writer
+        old.put(None)
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertEqual(self.client.writeBytes, 0)
+
+
+class SharedLimitProtocol(EchoProtocol):
+    running = 0
+    peak = 0
+
+    def docall_slow(self, value):
+        cls = SharedLimitProtocol
+        cls.running += 1
+        cls.peak = max(cls.peak, cls.running)
+        gevent.sleep(0.01)
+        cls.running -= 1
+        return value
+
+
+class ServerHandlerLimitTest(TestCase):
+    def setUp(self):
+        set_serializer('json')
+        SharedLimitProtocol.peak = 0
+        self.server = SocketRPCServer(('127.0.0.1', 0), SharedLimitProtocol, max_handlers=3)
+        self.server.start()
+        self.clients = [SocketRPCClient(('127.0.0.1', self.server.server_port), EchoProtocol) for i in range(3)]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        gevent.sleep(0.01)
+        self.server.stop(timeout=1)
+
+    def test_limit_over_connections(self):
+        results = [client.call('slow', i) for i in range(5) for client in self.clients]
+        self.assertEqual(sorted(result.get(timeout=5) for result in results), sorted(range(5) * 3))
+        self.assertEqual(SharedLimitProtocol.peak, 3)
+
+
+class ZlibProtocol(EchoProtocol):
+    compression = ['zlib']
+
+
+class CompressionTest(LoopbackTestCase):
+    serverProtocol = ZlibProtocol
+    clientProtocol = ZlibProtocol
+
+    def test_compressed(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertEqual(self.client.handshake.send, {'compression': 'zlib'})
+
+        value = 'x' * 100000
+        self.assertEqual(self.client.call('echo', value).get(timeout=5), value)
+        self.assertTrue(self.client.metrics.bytesOut < 10000)
+
+
+class OneSidedCompressionTest(LoopbackTestCase):
+    serverProtocol = ZlibProtocol
+
+    def test_uncompressed(self):
+        value = 'x' * 100000
+        self.assertEqual(self.client.call('echo', value).get(timeout=5), value)
+        self.assertEqual(self.server.handshake.send, {})
+        self.assertTrue(self.client.metrics.bytesOut > 100000)
+
+
+class StreamProtocol(EchoProtocol):
+    streamWindow = 4
+    produced = 0
+
+    def docall_numbers(self, count):
+        for i in range(count):
+            StreamProtocol.produced = i + 1
+            yield i
+
+    def docall_broken(self):
+        yield 1
+        raise ValueError('broken')
+
+
+class StreamTest(LoopbackTestCase):
+    serverProtocol = StreamProtocol
+    clientProtocol = StreamProtocol
+
+    def test_call_stream(self):
+        self.assertEqual(list(self.client.call_stream('numbers', 100)), range(100))
+
+    def test_call_collects(self):
+        self.assertEqual(self.client.call('numbers', 10).get(timeout=5), range(10))
+
+    def test_plain_reply(self):
+        self.assertEqual(list(self.client.call_stream('echo', [1, 2])), [1, 2])
+
+    def test_credit(self):
+        stream = self.client.call_stream('numbers', 100)
+        self.assertEqual(stream.next(), 0)
+        gevent.sleep(0.05)
+        # Consumed ones plus the window, credit is granted in halves
+        self.assertTrue(StreamProtocol.produced <= 1 + 2 * StreamProtocol.streamWindow)
+        self.assertEqual(list(stream), range(1, 100))
+
+    def test_error_after_chunks(self):
+        stream = self.client.call_stream('broken')
+        self.assertEqual(stream.next(), 1)
+        with self.assertRaises(Fault) as context:
+            stream.next()
+        self.assertEqual(context.exception.faultCode, APPLICATION_ERROR)
+
+    def test_cancel(self):
+        stream = self.client.call_stream('numbers', 100)
+        self.assertEqual(stream.next(), 0)
+        self.assertTrue(stream.cancel())
+        self.assertRaises(Fault, list, stream)
+
+
+class SingleHandlerStreamProtocol(StreamProtocol):
+    maxHandlers = 1
+
+
+class StreamCancelTest(LoopbackTestCase):
+    """ The sender of a cancelled stream gets no more credit,
+    it has to stop and free its handler.
+    """
+
+    serverProtocol = SingleHandlerStreamProtocol
+    clientProtocol = StreamProtocol
+
+    def assertHandlerFree(self):
+        self.assertEqual(self.client.call('echo', 'x').get(timeout=5), 'x')
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.handler_stats()['active'], 0)
+        self.assertEqual(self.server._streams, {})
+
+    def test_cancel(self):
+        stream = self.client.call_stream('numbers', 100)
+        self.assertEqual(stream.next(), 0)
+        self.assertTrue(stream.cancel())
+        self.assertHandlerFree()
+
+    def test_dropped(self):
+        stream = self.client.call_stream('numbers', 100)
+        self.assertEqual(stream.next(), 0)
+        del stream
+        self.assertEqual(self.client.callsCancelled, 1)
+        self.assertHandlerFree()
+
+    def test_cancel_collected(self):
+        # Collected by call() the chunks get credit right away,
+        # the cancel reaches the server before the stream starts
+        result = self.client.call('numbers', 100)
+        self.assertTrue(result.cancel())
+        self.assertHandlerFree()
+        self.assertEqual(self.server.callsSkipped, 1)
+
+
+class Version2Protocol(StreamProtocol):
+    messageVersion = 2
+
+
+class Version2Test(LoopbackTestCase):
+    serverProtocol = Version2Protocol
+    clientProtocol = Version2Protocol
+
+    def test_messages(self):
+        self.assertEqual(self.client.call('echo', {'a': [1, 2]}).get(timeout=5), {'a': [1, 2]})
+        self.assertEqual(self.client.handshake.send, {'version': 2})
+        self.assertEqual(self.server.handshake.send, {'version': 2})
+
+        self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+        results = self.client.call_many([('echo', ['a']), ('echo', ['b'])])
+        self.assertEqual([result.get(timeout=5) for result in results], ['a', 'b'])
+        self.assertEqual(list(self.client.call_stream('numbers', 20)), range(20))
+        self.assertEqual(self.client.call_timeout(5, 'echo', 'a').get(timeout=5), 'a')
+
+
+class OneSidedVersion2Test(LoopbackTestCase):
+    serverProtocol = Version2Protocol
+    clientProtocol = StreamProtocol
+
+    def test_version_1(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertEqual(self.server.handshake.send, {})
+
+
+class InternProtocol(EchoProtocol):
+    internMethods = True
+
+    def find_method(self, method):
+        self.__dict__.setdefault('asked', []).append(method)
+        return EchoProtocol.find_method(self, method)
+
+
+class InternTest(LoopbackTestCase):
+    serverProtocol = InternProtocol
+    clientProtocol = InternProtocol
+
+    def test_interned(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertTrue('echo' in self.client._methodIds)
+
+        del self.server.asked[:]
+        self.assertEqual(self.client.call('echo', 'b').get(timeout=5), 'b')
+        self.assertEqual(self.client.call('tools.upper', 'c').get(timeout=5), 'C')
+        self.assertEqual(set(self.server.asked), set([self.client._methodIds['echo'], self.client._methodIds['tools.upper']]))
+
+    def test_unlisted_by_name(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertFault(self.client.call('missing'), METHOD_NOT_FOUND)
+        self.assertEqual(self.server.asked[-1], 'missing')
+
+
+class MarshalProtocol(EchoProtocol):
+    serializers = ['marshal', 'json']
+
+
+class JSONProtocol(EchoProtocol):
+    serializers = ['json', 'marshal']
+
+
+class SerializerTest(LoopbackTestCase):
+    serverProtocol = MarshalProtocol
+    clientProtocol = JSONProtocol
+
+    def test_own_choice(self):
+        self.assertEqual(self.client.call('echo', {'a': [1, 2.5]}).get(timeout=5), {'a': [1, 2.5]})
+        self.assertEqual(self.client.handshake.send, {'serializer': 'json'})
+        self.assertEqual(self.server.handshake.send, {'serializer': 'marshal'})
+        self.assertEqual(self.server.call('echo', 'b').get(timeout=5), 'b')
+        self.assertEqual(sorted(self.client.metrics.serializers), ['json', 'marshal'])
+
+
+class OffloadProtocol(EchoProtocol):
+    offloadThreshold = 1000
+
+    def docall_record(self, value):
+        self.__dict__.setdefault('seen', []).append(len(value))
+        return len(value)
+
+    @rpcmethod(offload=True)
+    def docall_large(self, size):
+        return 'x' * size
+
+
+class OffloadTest(LoopbackTestCase):
+    serverProtocol = OffloadProtocol
+    clientProtocol = OffloadProtocol
+
+    def test_order(self):
+        results = [self.client.call('record', 'x' * 100000), self.client.call('record', 'y')]
+        self.assertEqual([result.get(timeout=5) for result in results], [100000, 1])
+        self.assertEqual(self.server.seen, [100000, 1])
+
+    def test_offloaded_reply(self):
+        self.assertEqual(self.client.call('large', 100000).get(timeout=5), 'x' * 100000)
+
+
+class DeadlineProtocol(EchoProtocol):
+    maxHandlers = 1
+
+    def docall_slow(self, value):
+        gevent.sleep(0.1)
+        self.__dict__.setdefault('seen', []).append(value)
+        return value
+
+
+class DeadlineTest(LoopbackTestCase):
+    serverProtocol = DeadlineProtocol
+
+    def test_call_timeout(self):
+        self.assertFault(self.client.call_timeout(0.02, 'slow', 'a'), TIMEOUT_ERROR)
+        self.assertEqual(self.client.calls, {})
+        self.assertEqual(self.client.callsExpired, 1)
+        self.assertEqual(self.client.call_timeout(5, 'echo', 'b').get(timeout=5), 'b')
+
+    def test_default_timeout(self):
+        self.client.callTimeout = 0.02
+        self.assertFault(self.client.call('slow', 'a'), TIMEOUT_ERROR)
+
+    def test_expired_call_skipped(self):
+        first = self.client.call_timeout(5, 'slow', 'a')
+        # Expires while the only handler is busy
+        second = self.client.call_timeout(0.05, 'slow', 'b')
+        self.assertEqual(first.get(timeout=5), 'a')
+        self.assertFault(second, TIMEOUT_ERROR)
+
+        gevent.sleep(0.05)
+        self.assertEqual(self.server.seen, ['a'])
+        self.assertEqual(self.server.callsSkipped, 1)
+
+    def test_cancel(self):
+        result = self.client.call('slow', 'a')
+        self.assertTrue(result.cancel())
+        self.assertFalse(result.cancel())
+        self.assertFault(result, CANCELLED_ERROR)
+        self.assertEqual(self.client.callsCancelled, 1)
+        self.assertEqual(self.client.call('echo', 'b').get(timeout=5), 'b')
+
+        # The server drops its reply
+        gevent.sleep(0.2)
+        self.assertEqual(self.server.callsSkipped, 1)
+        self.assertEqual(self.client.lateReplies, 0)
+
+    def test_late_reply(self):
+        # The server doesn't know this deadline, it answers after all
+        result = self.client.call('slow', 'a')
+        self.client.track_deadline(result.id, 0.02)
+        self.assertFault(result, TIMEOUT_ERROR)
+
+        gevent.sleep(0.2)
+        self.assertEqual(self.client.lateReplies, 1)
+
+
+class MetricsTest(LoopbackTestCase):
+    def test_stats(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+
+        stats = self.client.stats()
+        self.assertEqual(stats['client']['echo']['count'], 1)
+        self.assertEqual(stats['client']['fail']['errors'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['frames_out'], 2)
+        self.assertEqual(stats['serializers']['json']['encoded'], 2)
+
+        stats = self.server.stats()
+        self.assertEqual(stats['server']['echo'], dict(stats['server']['echo'], count=1, errors=0))
+        self.assertEqual(stats['server']['fail']['errors'], 1)
+        self.assertEqual(stats['frames_in'], 2)
+
+    def test_remote_stats(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        stats = self.client.call('stats').get(timeout=5)
+        self.assertEqual(stats['server']['echo']['count'], 1)
+        self.assertFalse('total' in stats)
+
+
+class ServerMetricsTest(TestCase):
+    def setUp(self):
+        set_serializer('json')
+        self.server = SocketRPCServer(('127.0.0.1', 0), EchoProtocol)
+        self.server.start()
+        self.clients = [SocketRPCClient(('127.0.0.1', self.server.server_port), EchoProtocol) for i in range(2)]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        gevent.sleep(0.01)
+        self.server.stop(timeout=1)
+
+    def test_total(self):
+        for client in self.clients:
+            self.assertEqual(client.call('echo', 'a').get(timeout=5), 'a')
+
+        stats = self.clients[0].call('stats').get(timeout=5)
+        self.assertEqual(stats['server']['echo']['count'], 1)
+        self.assertEqual(stats['total']['server']['echo']['count'], 2)
+
+        # Closed connections stay in the total
+        self.clients.pop().close()
+        gevent.sleep(0.05)
+        self.assertEqual(self.server.metrics().snapshot()['server']['echo']['count'], 2)
+
+
+class UnixTest(TestCase):
+    def setUp(self):
+        set_serializer('json')
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.sock')
+        self.server = SocketRPCServer('unix:' + self.path, EchoProtocol)
+        self.server.start()
+        self.client = SocketRPCClient('unix:' + self.path, EchoProtocol)
+
+    def tearDown(self):
+        self.client.close()
+        gevent.sleep(0.01)
+        self.server.stop(timeout=1)
+        shutil.rmtree(self.directory)
+
+    def test_call(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertEqual(self.client.target, ('unix', self.path))
+        self.assertEqual([protocol.address for protocol in self.server.protocols], [('unix', self.path)])
+
+    def test_stale_socket_replaced(self):
+        # A server which died without removing its socket file
+        self.client.close()
+        gevent.sleep(0.01)
+        self.server.stop(timeout=1)
+        self.assertTrue(os.path.exists(self.path))
+
+        self.server = SocketRPCServer('unix:' + self.path, EchoProtocol)
+        self.server.start()
+        self.client = SocketRPCClient('unix:' + self.path, EchoProtocol)
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+
+
+class BatchProtocol(EchoProtocol):
+    def _execute_call(self, method, id, args, kwargs):
+        if method == 'crash':
+            raise RuntimeError('crash')
+
+        return EchoProtocol._execute_call(self, method, id, args, kwargs)
+
+
+class BatchTest(LoopbackTestCase):
+    serverProtocol = BatchProtocol
+
+    def test_call_many(self):
+        results = self.client.call_many([('echo', ['a']), ('echo', ['b']), ('echo', [], {'value': 'c'})])
+        self.assertEqual([result.get(timeout=5) for result in results], ['a', 'b', 'c'])
+
+    def test_errors_fail_alone(self):
+        results = self.client.call_many([('echo', ['a']), ('fail', []), ('missing', [])])
+        self.assertEqual(results[0].get(timeout=5), 'a')
+        self.assertFault(results[1], APPLICATION_ERROR)
+        self.assertRaises(Fault, results[2].get, timeout=5)
+
+    def test_unserializable_reply_fails_alone(self):
+        results = self.client.call_many([('echo', ['a']), ('unserializable', [])])
+        self.assertEqual(results[0].get(timeout=5), 'a')
+        self.assertFault(results[1], APPLICATION_ERROR)
+
+    def test_crashed_handler_gets_answered(self):
+        results = self.client.call_many([('crash', []), ('echo', ['a'])])
+        self.assertFault(results[0], APPLICATION_ERROR)
+        self.assertEqual(results[1].get(timeout=5), 'a')
+
+
+class LimitedProtocol(EchoProtocol):
+    maxHandlers = 2
+
+    running = 0
+    peak = 0
+
+    def docall_slow(self, value):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        gevent.sleep(0.01)
+        self.running -= 1
+        return value
+
+
+class HandlerLimitTest(LoopbackTestCase):
+    serverProtocol = LimitedProtocol
+
+    def test_batch_stays_within_limit(self):
+        results = self.client.call_many([('slow', [i]) for i in range(10)])
+        self.assertEqual([result.get(timeout=5) for result in results], range(10))
+        self.assertEqual(self.server.peak, 2)
+
+
+class SharedMemoryProtocol(EchoProtocol):
+    sharedMemory = True
+    sharedMemorySize = 1024 * 1024
+    sharedMemoryThreshold = 1024
+
+
+class SharedMemoryTest(LoopbackTestCase):
+    serverProtocol = SharedMemoryProtocol
+    clientProtocol = SharedMemoryProtocol
+
+    def test_large_messages(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertTrue(self.client._shmSend is not None)
+        self.assertTrue(self.server._shmSend is not None)
+
+        value = 'x' * 10000
+        self.assertEqual(self.client.call('echo', value).get(timeout=5), value)
+
+
+class UnmappableSharedMemoryTest(SharedMemoryTest):
+    """ Neither side can map the other's segment.
+    """
+
+    def setUp(self):
+        def broken(path, token):
+            raise EnvironmentError('broken')
+
+        self.reader, gevent_srpc.ShmReader = gevent_srpc.ShmReader, broken
+        SharedMemoryTest.setUp(self)
+
+    def tearDown(self):
+        gevent_srpc.ShmReader = self.reader
+        SharedMemoryTest.tearDown(self)
+
+    def test_large_messages(self):
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+        self.assertEqual(self.client._shmSend, None)
+        self.assertEqual(self.server._shmRecv, None)
+
+        value = 'x' * 10000
+        self.assertEqual(self.client.call('echo', value).get(timeout=5), value)
+
+
+class SlowProtocol(EchoProtocol):
+    executed = 0
+
+    def docall_slow(self, value):
+        SlowProtocol.executed += 1
+        gevent.sleep(0.05)
+        return value
+
+
+class WindowProtocol(EchoProtocol):
+    maxInflight = 2
+
+
+class WindowTest(LoopbackTestCase):
+    serverProtocol = SlowProtocol
+    clientProtocol = WindowProtocol
+
+    def test_waits_for_room(self):
+        callers = [gevent.spawn(lambda i=i: self.client.call('slow', i).get(timeout=5)) for i in range(5)]
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.client.calls), 2)
+
+        self.assertEqual([caller.get(timeout=5) for caller in callers], range(5))
+        stats = self.client.flow_stats()
+        self.assertEqual(stats['inflight'], 0)
+        self.assertEqual(stats['max_inflight'], 2)
+        self.assertEqual(stats['stalls'], 3)
+        self.assertEqual(stats['rejected'], 0)
+
+    def test_fail_policy(self):
+        self.client.flowPolicy = 'fail'
+        results = [self.client.call('slow', i) for i in range(3)]
+        self.assertFault(results[2], OVERLOADED_ERROR)
+        self.assertEqual([result.get(timeout=5) for result in results[:2]], [0, 1])
+        self.assertEqual(self.client.flow_stats()['rejected'], 1)
+
+    def test_write_bytes(self):
+        self.client.maxInflight = None
+        self.client.maxWriteBytes = 100
+        self.client.writeBytes = 100
+        self.client.flowPolicy = 'fail'
+        self.assertFault(self.client.call('echo', 'a'), OVERLOADED_ERROR)
+
+        self.client.writeBytes = 0
+        self.assertEqual(self.client.call('echo', 'a').get(timeout=5), 'a')
+
+    def test_connection_lost_wakes_callers(self):
+        results = [self.client.call('slow', i) for i in range(2)]
+        caller = gevent.spawn(self.client.call, 'slow', 2)
+        gevent.sleep(0)
+        self.server.socket.shutdown(SHUT_WR)
+
+        self.assertFault(caller.get(timeout=5), TRANSPORT_ERROR)
+        for result in results:
+            self.assertFault(result, TRANSPORT_ERROR)
+
+
+class CacheTest(TestCase):
+    def setUp(self):
+        set_serializer('json')
+        SlowProtocol.executed = 0
+        self.server = SocketRPCServer(('127.0.0.1', 0), SlowProtocol)
+        self.server.start()
+
+        self.cache = ResultCache({'slow': 30})
+        self.client = SocketRPCClient(('127.0.0.1', self.server.server_port), EchoProtocol, cache=self.cache)
+
+    def tearDown(self):
+        self.client.close()
+        gevent.sleep(0.01)
+        self.server.stop(timeout=1)
+
+    def test_hit(self):
+        self.assertEqual(self.client.call('slow', 'a').get(timeout=5), 'a')
+        hit = self.client.call('slow', 'a')
+        self.assertEqual(hit.get(timeout=5), 'a')
+        self.assertEqual(hit.id, None)
+        self.assertEqual(hit.cancel(), False)
+        self.assertEqual(SlowProtocol.executed, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_shared_miss(self):
+        results = [self.client.call('slow', 'a') for i in range(2)]
+        self.assertEqual([result.get(timeout=5) for result in results], ['a', 'a'])
+        self.assertEqual(SlowProtocol.executed, 1)
+        self.assertEqual(self.cache.stats()['joined'], 1)
+
+    def test_cancel_one_caller(self):
+        first = self.client.call('slow', 'a')
+        second = self.client.call('slow', 'a')
+        self.assertEqual(first.id, second.id)
+
+        self.assertTrue(first.cancel())
+        self.assertFault(first, CANCELLED_ERROR)
+        self.assertEqual(second.get(timeout=5), 'a')
+        self.assertEqual(SlowProtocol.executed, 1)
+        self.assertEqual(self.client.protocol.callsCancelled, 0)
+
+    def test_cancel_every_caller(self):
+        results = [self.client.call('slow', 'a') for i in range(2)]
+        for result in results:
+            self.assertTrue(result.cancel())
+            self.assertFault(result, CANCELLED_ERROR)
+
+        self.assertEqual(self.client.protocol.callsCancelled, 1)
+
+
+class PoolTest(TestCase):
+    def setUp(self):
+        set_serializer('json')
+        SlowProtocol.executed = 0
+        self.server = SocketRPCServer(('127.0.0.1', 0), SlowProtocol)
+        self.server.start()
+
+        self.pool = SocketRPCClientPool(('127.0.0.1', self.server.server_port), EchoProtocol, min_size=1, max_size=3)
+        self.pool.growOutstanding = 2
+
+    def tearDown(self):
+        self.pool.close()
+        gevent.sleep(0.01)
+        self.server.stop(timeout=1)
+
+    def test_grows_under_load(self):
+        results = []
+        for i in range(12):
+            results.append(self.pool.call('slow', i))
+            # Room for a new member to connect
+            gevent.sleep(0.005)
+
+        self.assertEqual([result.get(timeout=5) for result in results], range(12))
+        self.assertEqual(len(self.pool.members), 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_reconnects(self):
+        self.assertEqual(self.pool.call('echo', 'a').get(timeout=5), 'a')
+        for protocol in list(self.server.protocols):
+            protocol.socket.shutdown(SHUT_WR)
+
+        for i in range(100):
+            gevent.sleep(0.01)
+            if self.server.connections == 2 and self.pool.outstanding() == [0]:
+                break
+
+        self.assertEqual(self.pool.call('echo', 'b').get(timeout=5), 'b')
+        self.assertEqual(self.server.connections, 2)
+
+
+class PreforkTest(unittest.TestCase):
+    def setUp(self):
+        self.server = SocketRPCPreforkServer(('127.0.0.1', 0), EchoProtocol, workers=2)
+        self.server.restartDelay = 0.05
+        self.server.running = True
+        self.started = []
+        self.server._start_worker = self.started.append
+
+    def test_restarts_dont_stall_reaping(self):
+        for number in range(2):
+            pid = os.fork()
+            if pid == 0:
+                os._exit(1)
+
+            self.server.pids[pid] = number
+            self.server.stats[number] = {'restarts': 0}
+
+        while self.server.pids:
+            started = time.time()
+            self.server._reap()
+            self.assertTrue(time.time() - started < self.server.restartDelay)
+            gevent.sleep(0.01)
+
+        self.server._restart_due()
+        self.assertEqual(self.started, [])
+
+        gevent.sleep(0.05)
+        self.server._restart_due()
+        self.assertEqual(sorted(self.started), [0, 1])
+        self.assertEqual(self.server.stats[0]['restarts'], 1)
+
+
+class ClusterTestCase(TestCase):
+    """ A ClusterClient on "replicas" servers on loopback ports.
+    """
+
+    replicas = 2
+    serverProtocol = EchoProtocol
+    clusterClient = ClusterClient
+    policy = 'outstanding'
+    hedge = None
+
+    def setUp(self):
+        set_serializer('json')
+        self.servers = []
+        for i in range(self.replicas):
+            server = SocketRPCServer(('127.0.0.1', 0), self.serverProtocol)
+            server.start()
+            self.servers.append(server)
+
+        self.cluster = self.clusterClient([('127.0.0.1', server.server_port) for server in self.servers],
+                                          EchoProtocol, policy=self.policy, hedge=self.hedge)
+
+    def tearDown(self):
+        self.cluster.close()
+        gevent.sleep(0.01)
+        for server in self.servers:
+            server.stop(timeout=1)
+
+
+class RoutingTest(ClusterTestCase):
+    serverProtocol = SlowProtocol
+
+    def test_fewest_outstanding(self):
+        results = [self.cluster.call('slow', i) for i in range(4)]
+        self.assertEqual(self.cluster.outstanding(), [2, 2])
+        self.assertEqual([result.get(timeout=5) for result in results], range(4))
+        gevent.sleep(0)
+        self.assertEqual([replica['calls'] for replica in self.cluster.stats().values()], [2, 2])
+
+    def test_call_many_on_one_replica(self):
+        results = self.cluster.call_many([('slow', [i]) for i in range(3)])
+        self.assertEqual(sorted(self.cluster.outstanding()), [0, 3])
+        self.assertEqual([result.get(timeout=5) for result in results], range(3))
+
+    def test_timeouts_leave_rotation(self):
+        self.cluster.maxFailures = 1
+        self.assertFault(self.cluster.call_timeout(0.01, 'slow', 'a'), TIMEOUT_ERROR)
+        gevent.sleep(0)
+        self.assertEqual(sorted(replica.healthy for replica in self.cluster.replicas), [False, True])
+
+        results = [self.cluster.call('slow', i) for i in range(2)]
+        self.assertEqual(sorted(self.cluster.outstanding()), [0, 2])
+        self.assertEqual([result.get(timeout=5) for result in results], range(2))
+
+
+class ProbedClient(SocketRPCClient):
+    initialDelay = 0.05
+    factor = 1.0
+    jitter = 0
+
+
+class ProbedClusterClient(ClusterClient):
+    client = ProbedClient
+
+
+class HealthTest(ClusterTestCase):
+    clusterClient = ProbedClusterClient
+
+    def kill(self, server):
+        """ Stops server and drops its connections.
+        """
+        server.stop(timeout=1)
+        for protocol in list(server.protocols):
+            protocol.socket.shutdown(SHUT_WR)
+        gevent.sleep(0.01)
+
+    def test_lost_replica_comes_back(self):
+        port = self.servers[0].server_port
+        self.kill(self.servers[0])
+
+        self.assertEqual([self.cluster.call('echo', i).get(timeout=5) for i in range(4)], range(4))
+        self.assertEqual(self.cluster.stats()['127.0.0.1:%d' % port]['healthy'], False)
+
+        self.servers[0] = SocketRPCServer(('127.0.0.1', port), EchoProtocol)
+        self.servers[0].start()
+        for i in range(100):
+            if self.cluster.replicas.replicas[0].healthy:
+                break
+            gevent.sleep(0.01)
+
+        self.assertEqual(self.cluster.stats()['127.0.0.1:%d' % port]['removed'], 1)
+        self.assertEqual([self.cluster.call('echo', i).get(timeout=5) for i in range(4)], range(4))
+        gevent.sleep(0)
+        self.assertEqual(self.cluster.stats()['127.0.0.1:%d' % port]['calls'], 2)
+
+    def test_no_healthy_replica(self):
+        for server in self.servers:
+            self.kill(server)
+
+        self.assertFault(self.cluster.call('echo', 'a'), TRANSPORT_ERROR)
+        self.assertEqual(self.cluster.outstanding(), [None, None])
+
+
+class StallingProtocol(EchoProtocol):
+    executed = 0
+
+    def docall_lookup(self, value):
+        # Only the first call stalls
+        StallingProtocol.executed += 1
+        if StallingProtocol.executed == 1:
+            gevent.sleep(0.2)
+        return value
+
+
+class HedgeTest(ClusterTestCase):
+    serverProtocol = StallingProtocol
+
+    def setUp(self):
+        StallingProtocol.executed = 0
+        self.hedge = HedgePolicy({'echo': 0.0, 'fail': None, 'lookup': 0.02})
+        ClusterTestCase.setUp(self)
+
+    def test_hedge_wins(self):
+        finished = self.cluster.call('lookup', 'a')
+        self.assertEqual(finished.get(timeout=5), 'a')
+        self.assertEqual(self.hedge.stats()['won'], 1)
+
+        # The stalling call got cancelled
+        gevent.sleep(0)
+        self.assertEqual(sorted(replica.client.protocol.callsCancelled for replica in self.cluster.replicas), [0, 1])
+        self.assertEqual(self.cluster.outstanding(), [0, 0])
+
+    def test_zero_delay_hedges(self):
+        self.assertEqual(self.cluster.call('echo', 'a').get(timeout=5), 'a')
+        self.assertEqual(self.hedge.stats()['hedged'], 1)
+
+    def test_no_latencies_no_hedge(self):
+        self.assertEqual(self.hedge.delay('fail'), None)
+        self.assertFault(self.cluster.call('fail'), APPLICATION_ERROR)
+        self.assertEqual(self.hedge.stats()['hedged'], 0)
+
+    def test_cancel_plain_results(self):
+        finished = HedgedResult()
+        finished.results.append(AsyncResult())
+        self.assertEqual(finished.cancel(), False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from socketrpc import Fault, APPLICATION_ERROR, CANCELLED_ERROR, METHOD_NOT_FOUND, TIMEOUT_ERROR, TRANSPORT_ERROR
+from socketrpc import unix_path
+from socketrpc import sync_client
+from socketrpc.sync_client import SocketRPCClient
+
+# The server runs in a thread of its own, on asyncio with
+# Python 3 and on gevent (with a hub of its own) with Python 2
+try:
+    import asyncio
+    from socketrpc.asyncio_srpc import SocketRPCProtocol, SocketRPCServer, set_serializer
+
+    def sleep(seconds, value):
+        return asyncio.sleep(seconds, result=value)
+
+    def ask(protocol, method, *args):
+        return protocol.call(method, *args)
+
+    class ServerThread(threading.Thread):
+        def serve(self, server):
+            loop = self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+
+            listener = loop.run_until_complete(server.start())
+            self.address = listener.sockets[0].getsockname()
+            self.started.set()
+
+            loop.run_forever()
+            server.close()
+            loop.run_until_complete(asyncio.sleep(0.01))
+            loop.close()
+
+        def stop(self):
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.join(5)
+
+except (ImportError, SyntaxError):
+    try:
+        import gevent
+        from socketrpc.gevent_srpc import SocketRPCProtocol, SocketRPCServer, set_serializer
+    except ImportError:
+        gevent = None
+        SocketRPCProtocol = object
+
+    def sleep(seconds, value):
+        gevent.sleep(seconds)
+        return value
+
+    def ask(protocol, method, *args):
+        return protocol.call(method, *args).get(timeout=5)
+
+    class ServerThread(threading.Thread):
+        def serve(self, server):
+            self.stopping = threading.Event()
+
+            server.start()
+            self.address = ('127.0.0.1', server.server_port)
+            self.started.set()
+
+            while not self.stopping.is_set():
+                gevent.sleep(0.01)
+            server.stop(timeout=1)
+
+        def stop(self):
+            self.stopping.set()
+            self.join(5)
+
+
+class EchoProtocol(SocketRPCProtocol):
+    def docall_echo(self, value):
+        return value
+
+    def docall_fail(self):
+        raise ValueError('fail')
+
+    def docall_numbers(self, count):
+        return iter(range(count))
+
+    def docall_slow(self, value):
+        return sleep(0.1, value)
+
+    def docall_ask(self, value):
+        # We serve no methods
+        return ask(self, 'echo', value)
+
+
+class NegotiatingProtocol(EchoProtocol):
+    compression = ['zlib']
+    compressThreshold = 1024
+    messageVersion = 2
+    serializers = ['json', 'marshal']
+    internMethods = True
+
+
+class Server(ServerThread):
+    def __init__(self, listener, protocol):
+        ServerThread.__init__(self)
+        self.daemon = True
+        self.listener = listener
+        self.protocol = protocol
+        self.started = threading.Event()
+
+    def run(self):
+        self.serve(SocketRPCServer(self.listener, self.protocol))
+
+
+@unittest.skipIf(SocketRPCProtocol is object, 'Neither asyncio nor gevent is available')
+class SyncTestCase(unittest.TestCase):
+    """ A SocketRPCClient of serverProtocol on a server thread.
+    """
+
+    serverProtocol = EchoProtocol
+    listener = ('127.0.0.1', 0)
+
+    def setUp(self):
+        set_serializer('json')
+        sync_client.set_serializer('json')
+
+        self.server = Server(self.listener, self.serverProtocol)
+        self.server.start()
+        self.assertTrue(self.server.started.wait(5))
+
+        self.client = self.make_client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def make_client(self, **kwargs):
+        if unix_path(self.listener) is not None:
+            return SocketRPCClient(self.listener, **kwargs)
+
+        return SocketRPCClient(self.server.address, **kwargs)
+
+    def assertFault(self, func, code, *args):
+        try:
+            func(*args)
+        except Fault as e:
+            self.assertEqual(e.faultCode, code)
+        else:
+            self.fail('No Fault')
+
+
+class CallTest(SyncTestCase):
+    def test_call(self):
+        self.assertEqual(self.client.call('echo', 'hello'), 'hello')
+        self.assertEqual(self.client.call('echo', value=[1, 'a']), [1, 'a'])
+
+    def test_faults(self):
+        self.assertFault(self.client.call, APPLICATION_ERROR, 'fail')
+        self.assertFault(self.client.call, METHOD_NOT_FOUND, 'missing')
+
+    def test_server_call_refused(self):
+        self.assertFault(self.client.call, METHOD_NOT_FOUND, 'ask', 'a')
+
+    def test_call_many(self):
+        results = self.client.call_many([('echo', ['a']), ('fail', []), ('echo', [], {'value': 'b'})])
+        self.assertEqual(results[0].get(), 'a')
+        self.assertFault(results[1].get, APPLICATION_ERROR)
+        self.assertEqual(results[2].get(), 'b')
+
+    def test_stream(self):
+        # More chunks than fit into the window, needs credit
+        self.assertEqual(self.client.call('numbers', 100), list(range(100)))
+
+    def test_stats(self):
+        self.client.call('echo', 'a')
+        stats = self.client.stats()
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['client']['echo']['count'], 1)
+
+
+class DeadlineTest(SyncTestCase):
+    def test_call_timeout(self):
+        self.assertFault(self.client.call_timeout, TIMEOUT_ERROR, 0.02, 'slow', 'a')
+
+        connection = self.client.connections[0]
+        self.assertEqual(connection.calls, {})
+        self.assertEqual(connection.call_stats()['expired'], 1)
+        self.assertEqual(self.client.call_timeout(5, 'echo', 'b'), 'b')
+
+    def test_default_timeout(self):
+        self.client.close()
+        self.client = self.make_client(default_timeout=0.02)
+        self.assertFault(self.client.call, TIMEOUT_ERROR, 'slow', 'a')
+
+    def test_get_timeout(self):
+        result = self.client.call_async(None, 'slow', 'a')
+        self.assertFault(result.get, TIMEOUT_ERROR, 0.02)
+
+        # The server doesn't know this deadline, it answers after all
+        time.sleep(0.2)
+        self.assertEqual(self.client.connections[0].call_stats()['late'], 1)
+
+    def test_cancel(self):
+        result = self.client.call_async(None, 'slow', 'a')
+        self.assertTrue(result.cancel())
+        self.assertFalse(result.cancel())
+        self.assertFault(result.get, CANCELLED_ERROR)
+        self.assertEqual(self.client.call('echo', 'b'), 'b')
+
+        # The server drops its reply
+        time.sleep(0.2)
+        self.assertEqual(self.client.connections[0].call_stats()['late'], 0)
+
+
+class PoolTest(SyncTestCase):
+    def test_threads_share_pool(self):
+        self.client.close()
+        self.client = self.make_client(pool_size=2)
+
+        results = []
+
+        def caller(number):
+            for i in range(20):
+                results.append(self.client.call('echo', [number, i]) == [number, i])
+
+        threads = [threading.Thread(target=caller, args=(number,)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(results, [True] * 160)
+        self.assertTrue(1 <= len(self.client.connections) <= 2)
+        self.assertEqual(self.client.stats()['client']['echo']['count'], 160)
+
+    def test_lost_connection_replaced(self):
+        result = self.client.call_async(None, 'slow', 'a')
+        connection = self.client.connections[0]
+        connection.close()
+        self.assertFault(result.get, TRANSPORT_ERROR)
+
+        self.assertEqual(self.client.call('echo', 'b'), 'b')
+        self.assertFalse(connection in self.client.connections)
+        self.assertEqual(self.client.stats()['client']['slow']['errors'], 1)
+
+    def test_connect_outside_lock(self):
+        hanging = threading.Event()
+        release = threading.Event()
+        connect = sync_client.connect_socket
+
+        def hanging_connect(address, timeout=None):
+            # Only the first one hangs
+            if not hanging.is_set():
+                hanging.set()
+                release.wait(5)
+            return connect(address, timeout)
+
+        busy = self.client.call_async(None, 'slow', 'a')
+        sync_client.connect_socket = hanging_connect
+        thread = threading.Thread(target=self.client.call, args=('echo', 'b'))
+        try:
+            thread.start()
+            self.assertTrue(hanging.wait(5))
+            self.assertEqual(self.client.call('echo', 'c'), 'c')
+            self.assertTrue(thread.is_alive())
+        finally:
+            release.set()
+            sync_client.connect_socket = connect
+            thread.join(5)
+
+        self.assertEqual(busy.get(), 'a')
+        self.assertEqual(len(self.client.connections), 3)
+
+    def test_failed_connect_uses_busy(self):
+        busy = self.client.call_async(None, 'slow', 'a')
+
+        # Nothing listens there
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        self.client.address = sock.getsockname()
+        sock.close()
+
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual(self.client.call('echo', 'b'), 'b')
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(len(self.client.connections), 1)
+        self.assertEqual(busy.get(), 'a')
+
+        self.client.connections[0].close()
+        self.assertFault(self.client.call, TRANSPORT_ERROR, 'echo', 'c')
+
+
+class NegotiationTest(SyncTestCase):
+    serverProtocol = NegotiatingProtocol
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.client.compression = ['zlib']
+        self.client.messageVersion = 2
+        self.client.serializers = ['marshal', 'json']
+
+    def test_options(self):
+        # The server's hello comes before the reply
+        self.assertEqual(self.client.call('echo', 'a'), 'a')
+
+        value = 'x' * 100000
+        self.assertEqual(self.client.call('echo', value), value)
+        self.assertEqual(self.client.call('numbers', 10), list(range(10)))
+
+        connection = self.client.connections[0]
+        self.assertEqual(connection.handshake.send, {'compression': 'zlib', 'version': 2, 'serializer': 'marshal'})
+        self.assertEqual(connection.handshake.recv, {'compression': 'zlib', 'version': 2, 'serializer': 'json'})
+        self.assertTrue('echo' in connection._methodIds)
+        self.assertTrue(self.client.stats()['bytes_out'] < 10000)
+
+
+class UnixTest(SyncTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.listener = 'unix:' + os.path.join(self.directory, 'test.sock')
+        SyncTestCase.setUp(self)
+
+    def tearDown(self):
+        SyncTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_call(self):
+        self.assertEqual(self.client.call('echo', 'a'), 'a')
+        self.assertEqual(self.client.connections[0].address, ('unix', unix_path(self.listener)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,781 @@
+# -*- coding: utf-8 -*-
+# vim: set et sts=4 sw=4 encoding=utf-8:
+#
+###############################################################################
+#
+# This file is part of socketrpc.
+#
+# Copyright (C) 2011  Rene Jochum <rene@jrit.at>
+#
+###############################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('The Twisted backend is Python 2 only')
+
+try:
+    from twisted.trial.unittest import TestCase as TrialTestCase
+except ImportError:
+    raise unittest.SkipTest('Twisted is not installed')
+
+from twisted.internet import defer, protocol, reactor, task
+
+from socketrpc import Fault, HedgePolicy, ResultCache, STRUCT_INT, rpcmethod, APPLICATION_ERROR, CANCELLED_ERROR, \
+                      METHOD_NOT_FOUND, TIMEOUT_ERROR, TRANSPORT_ERROR
+from socketrpc import twisted_srpc
+from socketrpc.twisted_srpc import SocketRPCProtocol, SocketRPCClient, ClusterClient, \
+                                   socketpair, connect_socket, set_serializer
+
+
+class EchoProtocol(SocketRPCProtocol):
+    def docall_echo(self, value):
+        return value
+
+    def docall_unserializable(self):
+        return object()
+
+    def docall_fail(self):
+        raise ValueError('fail')
+
+    @rpcmethod('tools.upper')
+    def upper(self, value):
+        return value.upper()
+
+    @rpcmethod('tools.length', inline=True)
+    def length(self, value):
+        return len(value)
+
+    def helper(self):
+        pass
+
+
+class ServerFactory(protocol.ServerFactory):
+    """ Keeps the protocol it built as "remote".
+    """
+
+    def buildProtocol(self, addr):
+        self.remote = protocol.ServerFactory.buildProtocol(self, addr)
+        return self.remote
+
+
+class TestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def assertFault(self, d, code):
+        try:
+            yield d
+        except Fault as e:
+            self.assertEqual(e.faultCode, code)
+        else:
+            self.fail('No Fault')
+
+
+class LoopbackTestCase(TestCase):
+    """ A server protocol and a client protocol connected by a socketpair.
+    """
+
+    serverProtocol = EchoProtocol
+    clientProtocol = EchoProtocol
+
+    def setUp(self):
+        set_serializer('json')
+        a, b = socketpair()
+
+        self.serverFactory = ServerFactory()
+        self.serverFactory.protocol = self.serverProtocol
+        connect_socket(a, self.serverFactory)
+        self.server = self.serverFactory.remote
+
+        self.factory = SocketRPCClient()
+        self.factory.protocol = self.clientProtocol
+        connect_socket(b, self.factory)
+        self.client = self.factory.remote
+
+    def tearDown(self):
+        for proto in (self.client, self.server):
+            if proto.connected:
+                proto.transport.loseConnection()
+
+        return task.deferLater(reactor, 0.01, lambda: None)
+
+
+class CallTest(LoopbackTestCase):
+    @defer.inlineCallbacks
+    def test_call(self):
+        self.assertEqual((yield self.client.call('echo', 'hello')), 'hello')
+
+    @defer.inlineCallbacks
+    def test_server_calls_client(self):
+        self.assertEqual((yield self.server.call('echo', [1, 2])), [1, 2])
+
+    def test_application_error(self):
+        return self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+
+    @defer.inlineCallbacks
+    def test_unknown_method(self):
+        yield self.assertFault(self.client.call('missing'), METHOD_NOT_FOUND)
+        yield self.assertFault(self.client.call('helper'), METHOD_NOT_FOUND)
+
+    @defer.inlineCallbacks
+    def test_named_method(self):
+        self.assertEqual((yield self.client.call('tools.upper', 'a')), 'A')
+        self.assertEqual((yield self.client.call('tools.length', 'abc')), 3)
+
+
+class ZlibProtocol(EchoProtocol):
+    compression = ['zlib']
+
+
+class CompressionTest(LoopbackTestCase):
+    serverProtocol = ZlibProtocol
+    clientProtocol = ZlibProtocol
+
+    @defer.inlineCallbacks
+    def test_compressed(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        self.assertEqual(self.client.handshake.send, {'compression': 'zlib'})
+
+        value = 'x' * 100000
+        self.assertEqual((yield self.client.call('echo', value)), value)
+        self.assertTrue(self.client.metrics.bytesOut < 10000)
+
+
+class OneSidedCompressionTest(LoopbackTestCase):
+    serverProtocol = ZlibProtocol
+
+    @defer.inlineCallbacks
+    def test_uncompressed(self):
+        value = 'x' * 100000
+        self.assertEqual((yield self.client.call('echo', value)), value)
+        self.assertEqual(self.server.handshake.send, {})
+        self.assertTrue(self.client.metrics.bytesOut > 100000)
+
+
+class StreamProtocol(EchoProtocol):
+    streamWindow = 4
+    produced = 0
+
+    def docall_numbers(self, count):
+        for i in range(count):
+            StreamProtocol.produced = i + 1
+            yield i
+
+    def docall_broken(self):
+        yield 1
+        raise ValueError('broken')
+
+
+class StreamTest(LoopbackTestCase):
+    serverProtocol = StreamProtocol
+    clientProtocol = StreamProtocol
+
+    @defer.inlineCallbacks
+    def test_call_stream(self):
+        chunks = []
+        yield self.client.call_stream(chunks.append, 'numbers', 100)
+        self.assertEqual(chunks, range(100))
+
+    @defer.inlineCallbacks
+    def test_call_collects(self):
+        self.assertEqual((yield self.client.call('numbers', 10)), range(10))
+
+    @defer.inlineCallbacks
+    def test_credit(self):
+        chunks = []
+        waiting = []
+
+        def received(chunk):
+            chunks.append(chunk)
+            if waiting is not None:
+                # No credit for the chunk until it fires
+                d = defer.Deferred()
+                waiting.append(d)
+                return d
+
+        finished = self.client.call_stream(received, 'numbers', 100)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(len(chunks), StreamProtocol.streamWindow)
+        self.assertTrue(StreamProtocol.produced <= 1 + StreamProtocol.streamWindow)
+
+        held, waiting = waiting, None
+        for d in held:
+            d.callback(None)
+        yield finished
+        self.assertEqual(chunks, range(100))
+
+    @defer.inlineCallbacks
+    def test_error_after_chunks(self):
+        chunks = []
+        yield self.assertFault(self.client.call_stream(chunks.append, 'broken'), APPLICATION_ERROR)
+        self.assertEqual(chunks, [1])
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        chunks = []
+
+        def received(chunk):
+            chunks.append(chunk)
+            # Holds the credit
+            return defer.Deferred()
+
+        d = self.client.call_stream(received, 'numbers', 100)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(len(self.server._streams), 1)
+
+        d.cancel()
+        yield self.assertFault(d, CANCELLED_ERROR)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        # The server dropped the stream waiting for credit
+        self.assertEqual(self.server._streams, {})
+        self.assertEqual(len(chunks), StreamProtocol.streamWindow)
+
+    @defer.inlineCallbacks
+    def test_deadline(self):
+        # Holds the credit, the server stops at the caller's deadline
+        self.client.callTimeout = 0.05
+        d = self.client.call_stream(lambda chunk: defer.Deferred(), 'numbers', 100)
+        yield self.assertFault(d, TIMEOUT_ERROR)
+
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(self.server._streams, {})
+        self.assertEqual(self.server.callsSkipped, 1)
+
+
+class Version2Protocol(StreamProtocol):
+    messageVersion = 2
+
+
+class Version2Test(LoopbackTestCase):
+    serverProtocol = Version2Protocol
+    clientProtocol = Version2Protocol
+
+    @defer.inlineCallbacks
+    def test_messages(self):
+        self.assertEqual((yield self.client.call('echo', {'a': [1, 2]})), {'a': [1, 2]})
+        self.assertEqual(self.client.handshake.send, {'version': 2})
+        self.assertEqual(self.server.handshake.send, {'version': 2})
+
+        yield self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+        results = yield defer.gatherResults(self.client.call_many([('echo', ['a']), ('echo', ['b'])]))
+        self.assertEqual(results, ['a', 'b'])
+        chunks = []
+        yield self.client.call_stream(chunks.append, 'numbers', 20)
+        self.assertEqual(chunks, range(20))
+        self.assertEqual((yield self.client.call_timeout(5, 'echo', 'a')), 'a')
+
+
+class OneSidedVersion2Test(LoopbackTestCase):
+    serverProtocol = Version2Protocol
+    clientProtocol = StreamProtocol
+
+    @defer.inlineCallbacks
+    def test_version_1(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        self.assertEqual(self.server.handshake.send, {})
+
+
+class InternProtocol(EchoProtocol):
+    internMethods = True
+
+    def find_method(self, method):
+        self.__dict__.setdefault('asked', []).append(method)
+        return EchoProtocol.find_method(self, method)
+
+
+class InternTest(LoopbackTestCase):
+    serverProtocol = InternProtocol
+    clientProtocol = InternProtocol
+
+    @defer.inlineCallbacks
+    def test_interned(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        self.assertTrue('echo' in self.client._methodIds)
+
+        del self.server.asked[:]
+        self.assertEqual((yield self.client.call('echo', 'b')), 'b')
+        self.assertEqual((yield self.client.call('tools.upper', 'c')), 'C')
+        self.assertEqual(set(self.server.asked), set([self.client._methodIds['echo'], self.client._methodIds['tools.upper']]))
+
+    @defer.inlineCallbacks
+    def test_unlisted_by_name(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        yield self.assertFault(self.client.call('missing'), METHOD_NOT_FOUND)
+        self.assertEqual(self.server.asked[-1], 'missing')
+
+
+class MarshalProtocol(EchoProtocol):
+    serializers = ['marshal', 'json']
+
+
+class JSONProtocol(EchoProtocol):
+    serializers = ['json', 'marshal']
+
+
+class SerializerTest(LoopbackTestCase):
+    serverProtocol = MarshalProtocol
+    clientProtocol = JSONProtocol
+
+    @defer.inlineCallbacks
+    def test_own_choice(self):
+        self.assertEqual((yield self.client.call('echo', {'a': [1, 2.5]})), {'a': [1, 2.5]})
+        self.assertEqual(self.client.handshake.send, {'serializer': 'json'})
+        self.assertEqual(self.server.handshake.send, {'serializer': 'marshal'})
+        self.assertEqual((yield self.server.call('echo', 'b')), 'b')
+        self.assertEqual(sorted(self.client.metrics.serializers), ['json', 'marshal'])
+
+
+class OffloadProtocol(EchoProtocol):
+    offloadThreshold = 1000
+
+    def docall_record(self, value):
+        self.__dict__.setdefault('seen', []).append(len(value))
+        return len(value)
+
+    @rpcmethod(offload=True)
+    def docall_large(self, size):
+        return 'x' * size
+
+
+class OffloadTest(LoopbackTestCase):
+    serverProtocol = OffloadProtocol
+    clientProtocol = OffloadProtocol
+
+    @defer.inlineCallbacks
+    def test_order(self):
+        results = yield defer.gatherResults([self.client.call('record', 'x' * 100000), self.client.call('record', 'y')])
+        self.assertEqual(results, [100000, 1])
+        self.assertEqual(self.server.seen, [100000, 1])
+
+    @defer.inlineCallbacks
+    def test_offloaded_reply(self):
+        self.assertEqual((yield self.client.call('large', 100000)), 'x' * 100000)
+
+
+class MetricsTest(LoopbackTestCase):
+    @defer.inlineCallbacks
+    def test_stats(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        yield self.assertFault(self.client.call('fail'), APPLICATION_ERROR)
+
+        stats = self.client.stats()
+        self.assertEqual(stats['client']['echo']['count'], 1)
+        self.assertEqual(stats['client']['fail']['errors'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['frames_out'], 2)
+        self.assertEqual(stats['serializers']['json']['encoded'], 2)
+
+        stats = self.server.stats()
+        self.assertEqual(stats['server']['echo'], dict(stats['server']['echo'], count=1, errors=0))
+        self.assertEqual(stats['server']['fail']['errors'], 1)
+        self.assertEqual(stats['frames_in'], 2)
+
+    @defer.inlineCallbacks
+    def test_remote_stats(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        stats = yield self.client.call('stats')
+        self.assertEqual(stats['server']['echo']['count'], 1)
+
+
+class UnixTest(TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        set_serializer('json')
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.sock')
+
+        self.serverFactory = ServerFactory()
+        self.serverFactory.protocol = EchoProtocol
+        self.port = twisted_srpc.listen('unix:' + self.path, self.serverFactory)
+
+        self.factory = SocketRPCClient()
+        self.factory.protocol = EchoProtocol
+        self.connector = twisted_srpc.connect('unix:' + self.path, self.factory)
+
+        for i in range(500):
+            if self.factory.remote is not None:
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.factory.stopTrying()
+        self.connector.disconnect()
+        yield self.port.stopListening()
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        shutil.rmtree(self.directory)
+
+    @defer.inlineCallbacks
+    def test_call(self):
+        self.assertEqual((yield self.factory.call('echo', 'a')), 'a')
+        self.assertEqual(self.factory.remote.transport.getPeer().name, self.path)
+
+
+class BatchTest(LoopbackTestCase):
+    @defer.inlineCallbacks
+    def test_call_many(self):
+        results = yield defer.gatherResults(self.client.call_many([('echo', ['a']), ('echo', ['b'])]))
+        self.assertEqual(results, ['a', 'b'])
+
+    @defer.inlineCallbacks
+    def test_errors_fail_alone(self):
+        results = self.client.call_many([('echo', ['a']), ('fail', []), ('missing', [])])
+        self.assertEqual((yield results[0]), 'a')
+        yield self.assertFault(results[1], APPLICATION_ERROR)
+        yield self.assertFailure(results[2], Fault)
+
+    @defer.inlineCallbacks
+    def test_unserializable_reply_fails_alone(self):
+        results = self.client.call_many([('echo', ['a']), ('unserializable', [])])
+        self.assertEqual((yield results[0]), 'a')
+        yield self.assertFault(results[1], APPLICATION_ERROR)
+
+
+class RecordingProtocol(EchoProtocol):
+    def docall_echo(self, value):
+        self.__dict__.setdefault('seen', []).append(value)
+        return value
+
+
+class ReceiveTest(LoopbackTestCase):
+    serverProtocol = RecordingProtocol
+
+    def test_split_frames(self):
+        data = self.client.encode_message('call', ['echo', ['a'], {}, 1000])
+        data = STRUCT_INT.pack(len(data)) + data
+        for i in range(len(data)):
+            self.server.dataReceived(data[i:i + 1])
+
+        self.assertEqual(self.server.seen, ['a'])
+
+    @defer.inlineCallbacks
+    def test_large_message(self):
+        value = 'x' * 300000
+        self.assertEqual((yield self.client.call('echo', value)), value)
+
+
+class DeadlineTest(LoopbackTestCase):
+    serverProtocol = RecordingProtocol
+
+    def test_expired_call_skipped(self):
+        received = time.time() - 1
+        self.server.message_received(('call', ['echo', ['late'], {}, 1000, 0.5]), received)
+        self.server.message_received(('call', ['echo', ['early'], {}, 1001, 5.0]), received)
+        self.assertEqual(self.server.seen, ['early'])
+        self.assertEqual(self.server.callsSkipped, 1)
+
+    def test_expired_batch_entry_skipped(self):
+        self.server.message_received(('batch', [{'call': ['echo', ['late'], {}, 1000, 0.5]},
+                                                {'call': ['echo', ['early'], {}, 1001, 5.0]}]),
+                                     time.time() - 1)
+        self.assertEqual(self.server.seen, ['early'])
+        self.assertEqual(self.server.callsSkipped, 1)
+
+    @defer.inlineCallbacks
+    def test_call_timeout(self):
+        self.assertEqual((yield self.client.call_timeout(5, 'echo', 'hello')), 'hello')
+        self.assertEqual(self.server.callsSkipped, 0)
+
+
+class SlowProtocol(EchoProtocol):
+    executed = 0
+
+    def docall_slow(self, value):
+        SlowProtocol.executed += 1
+        return task.deferLater(reactor, 0.05, lambda: value)
+
+
+class CacheTest(LoopbackTestCase):
+    serverProtocol = SlowProtocol
+
+    def setUp(self):
+        SlowProtocol.executed = 0
+        LoopbackTestCase.setUp(self)
+        self.cache = self.factory.cache = ResultCache({'slow': 30})
+
+    @defer.inlineCallbacks
+    def test_hit(self):
+        self.assertEqual((yield self.factory.call('slow', 'a')), 'a')
+        self.assertEqual((yield self.factory.call('slow', 'a')), 'a')
+        self.assertEqual(SlowProtocol.executed, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    @defer.inlineCallbacks
+    def test_shared_miss(self):
+        results = [self.factory.call('slow', 'a') for i in range(2)]
+        self.assertEqual((yield defer.gatherResults(results)), ['a', 'a'])
+        self.assertEqual(SlowProtocol.executed, 1)
+        self.assertEqual(self.cache.stats()['joined'], 1)
+
+    @defer.inlineCallbacks
+    def test_cancel_one_caller(self):
+        first = self.factory.call('slow', 'a')
+        second = self.factory.call('slow', 'a')
+
+        first.cancel()
+        yield self.assertFault(first, CANCELLED_ERROR)
+        self.assertEqual((yield second), 'a')
+        self.assertEqual(SlowProtocol.executed, 1)
+        self.assertEqual(self.client.callsCancelled, 0)
+
+    @defer.inlineCallbacks
+    def test_cancel_every_caller(self):
+        results = [self.factory.call('slow', 'a') for i in range(2)]
+        for d in results:
+            d.cancel()
+            yield self.assertFault(d, CANCELLED_ERROR)
+
+        self.assertEqual(self.client.callsCancelled, 1)
+
+
+class TimeoutTest(LoopbackTestCase):
+    serverProtocol = SlowProtocol
+
+    def settle(self):
+        """ Waits for the server's reply, which comes too late.
+        """
+        return task.deferLater(reactor, 0.1, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_call_timeout(self):
+        yield self.assertFault(self.client.call_timeout(0.02, 'slow', 'a'), TIMEOUT_ERROR)
+        self.assertEqual(self.client.calls, {})
+        self.assertEqual(self.client.callsExpired, 1)
+        yield self.settle()
+
+    @defer.inlineCallbacks
+    def test_default_timeout(self):
+        self.client.callTimeout = 0.02
+        yield self.assertFault(self.client.call('slow', 'a'), TIMEOUT_ERROR)
+        yield self.settle()
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        d = self.client.call('slow', 'a')
+        d.cancel()
+        yield self.assertFault(d, CANCELLED_ERROR)
+        self.assertFalse(self.client.cancel(self.client.id))
+        self.assertEqual(self.client.callsCancelled, 1)
+        self.assertEqual((yield self.client.call('echo', 'b')), 'b')
+
+        # The server drops its reply
+        yield self.settle()
+        self.assertEqual(self.server.callsSkipped, 1)
+        self.assertEqual(self.client.lateReplies, 0)
+
+    @defer.inlineCallbacks
+    def test_late_reply(self):
+        # The server doesn't know this deadline, it answers after all
+        d = self.client.call('slow', 'a')
+        self.client.track_deadline(self.client.id, 0.02)
+        yield self.assertFault(d, TIMEOUT_ERROR)
+
+        yield self.settle()
+        self.assertEqual(self.client.lateReplies, 1)
+
+
+class SharedMemoryProtocol(EchoProtocol):
+    sharedMemory = True
+    sharedMemorySize = 1024 * 1024
+    sharedMemoryThreshold = 1024
+
+
+class SharedMemoryTest(LoopbackTestCase):
+    serverProtocol = SharedMemoryProtocol
+    clientProtocol = SharedMemoryProtocol
+
+    @defer.inlineCallbacks
+    def test_large_messages(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        self.assertTrue(self.client._shmSend is not None)
+        self.assertTrue(self.server._shmSend is not None)
+
+        value = 'x' * 10000
+        self.assertEqual((yield self.client.call('echo', value)), value)
+
+
+class UnmappableSharedMemoryTest(SharedMemoryTest):
+    """ Neither side can map the other's segment.
+    """
+
+    def setUp(self):
+        def broken(path, token):
+            raise EnvironmentError('broken')
+
+        self.patch(twisted_srpc, 'ShmReader', broken)
+        return SharedMemoryTest.setUp(self)
+
+    @defer.inlineCallbacks
+    def test_large_messages(self):
+        self.assertEqual((yield self.client.call('echo', 'a')), 'a')
+        self.assertEqual(self.client._shmSend, None)
+        self.assertEqual(self.server._shmRecv, None)
+
+        value = 'x' * 10000
+        self.assertEqual((yield self.client.call('echo', value)), value)
+
+
+class ClusterTestCase(TestCase):
+    """ A ClusterClient on "replicas" servers on loopback ports.
+    """
+
+    replicas = 2
+    serverProtocol = EchoProtocol
+    clusterClient = ClusterClient
+    policy = 'outstanding'
+    hedge = None
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        set_serializer('json')
+        self.serverFactories = []
+        self.ports = []
+        for i in range(self.replicas):
+            factory = ServerFactory()
+            factory.protocol = self.serverProtocol
+            self.serverFactories.append(factory)
+            self.ports.append(reactor.listenTCP(0, factory, interface='127.0.0.1'))
+
+        self.cluster = self.clusterClient([('127.0.0.1', port.getHost().port) for port in self.ports],
+                                          EchoProtocol, policy=self.policy, hedge=self.hedge)
+
+        yield self.poll(lambda: all(replica.client.connected for replica in self.cluster.replicas))
+
+    @defer.inlineCallbacks
+    def poll(self, condition):
+        """ Waits up to 5 seconds for condition() to become true.
+        """
+        for i in range(500):
+            if condition():
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.cluster.close()
+        for port in self.ports:
+            yield port.stopListening()
+
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+
+class RoutingTest(ClusterTestCase):
+    serverProtocol = SlowProtocol
+
+    @defer.inlineCallbacks
+    def test_fewest_outstanding(self):
+        results = [self.cluster.call('slow', i) for i in range(4)]
+        self.assertEqual(self.cluster.outstanding(), [2, 2])
+        self.assertEqual((yield defer.gatherResults(results)), range(4))
+        self.assertEqual([replica['calls'] for replica in self.cluster.stats().values()], [2, 2])
+
+    @defer.inlineCallbacks
+    def test_call_many_on_one_replica(self):
+        results = self.cluster.call_many([('slow', [i]) for i in range(3)])
+        self.assertEqual(sorted(self.cluster.outstanding()), [0, 3])
+        self.assertEqual((yield defer.gatherResults(results)), range(3))
+
+    @defer.inlineCallbacks
+    def test_timeouts_leave_rotation(self):
+        self.cluster.maxFailures = 1
+        yield self.assertFault(self.cluster.call_timeout(0.01, 'slow', 'a'), TIMEOUT_ERROR)
+        self.assertEqual(sorted(replica.healthy for replica in self.cluster.replicas), [False, True])
+
+        results = [self.cluster.call('slow', i) for i in range(2)]
+        self.assertEqual(sorted(self.cluster.outstanding()), [0, 2])
+        self.assertEqual((yield defer.gatherResults(results)), range(2))
+
+
+class ProbedClient(SocketRPCClient):
+    initialDelay = 0.05
+    factor = 1.0
+    jitter = 0
+
+
+class ProbedClusterClient(ClusterClient):
+    client = ProbedClient
+
+
+class HealthTest(ClusterTestCase):
+    clusterClient = ProbedClusterClient
+
+    def kill(self, number):
+        """ Stops listening on the port of replica number
+        and drops its connection.
+        """
+        self.serverFactories[number].remote.transport.loseConnection()
+        return self.ports[number].stopListening()
+
+    @defer.inlineCallbacks
+    def test_lost_replica_comes_back(self):
+        replica = self.cluster.replicas.replicas[0]
+        replica.client.remote.transport.loseConnection()
+        yield self.poll(lambda: not replica.client.connected)
+
+        self.assertEqual((yield defer.gatherResults([self.cluster.call('echo', i) for i in range(4)])), range(4))
+        self.assertEqual(replica.stats()['healthy'], False)
+
+        yield self.poll(lambda: replica.healthy)
+        self.assertEqual(replica.stats()['removed'], 1)
+        self.assertEqual((yield defer.gatherResults([self.cluster.call('echo', i) for i in range(4)])), range(4))
+        self.assertEqual(replica.stats()['calls'], 2)
+
+    @defer.inlineCallbacks
+    def test_no_healthy_replica(self):
+        for number in range(self.replicas):
+            yield self.kill(number)
+        yield self.poll(lambda: not any(replica.client.connected for replica in self.cluster.replicas))
+
+        yield self.assertFault(self.cluster.call('echo', 'a'), TRANSPORT_ERROR)
+        self.assertEqual(self.cluster.outstanding(), [None, None])
+
+
+class StallingProtocol(EchoProtocol):
+    executed = 0
+
+    def docall_lookup(self, value):
+        # Only the first call stalls
+        StallingProtocol.executed += 1
+        if StallingProtocol.executed == 1:
+            return task.deferLater(reactor, 0.2, lambda: value)
+        return value
+
+
+class HedgeTest(ClusterTestCase):
+    serverProtocol = StallingProtocol
+
+    def setUp(self):
+        StallingProtocol.executed = 0
+        self.hedge = HedgePolicy({'echo': 0.0, 'fail': None, 'lookup': 0.02})
+        return ClusterTestCase.setUp(self)
+
+    @defer.inlineCallbacks
+    def test_hedge_wins(self):
+        self.assertEqual((yield self.cluster.call('lookup', 'a')), 'a')
+        self.assertEqual(self.hedge.stats()['won'], 1)
+
+        # The stalling call got cancelled
+        self.assertEqual(sorted(replica.client.remote.callsCancelled for replica in self.cluster.replicas), [0, 1])
+        self.assertEqual(self.cluster.outstanding(), [0, 0])
+
+        # Its reply comes too late
+        yield task.deferLater(reactor, 0.2, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_zero_delay_hedges(self):
+        self.assertEqual((yield self.cluster.call('echo', 'a')), 'a')
+        self.assertEqual(self.hedge.stats()['hedged'], 1)
+
+    @defer.inlineCallbacks
+    def test_no_latencies_no_hedge(self):
+        self.assertEqual(self.hedge.delay('fail'), None)
+        yield self.assertFault(self.cluster.call('fail'), APPLICATION_ERROR)
+        self.assertEqual(self.hedge.stats()['hedged'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()